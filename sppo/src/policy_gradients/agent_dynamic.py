@@ -6,6 +6,8 @@ from torch.nn.functional import mse_loss
 import tqdm
 import sys
 import time
+import threading
+import contextlib
 import dill
 import torch.nn as nn
 import torch.optim as optim
@@ -13,6 +15,8 @@ from torch.autograd import Variable
 import numpy as np
 from scipy.special import lambertw
 import random
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from copy import deepcopy
 import gym
 from auto_LiRPA import BoundedModule
@@ -23,12 +27,19 @@ from auto_LiRPA.bounded_tensor import BoundedTensor
 from auto_LiRPA.perturbations import PerturbationLpNorm
 from .models import *
 from .torch_utils import *
-from .steps import value_step, step_with_mode, pack_history
+from .steps import value_step, step_with_mode, pack_history, behavior_weights
+from .pgd import pgd_maximize
+from .smoothing import smoothed_forward, smoothing_chunk, ADivEstimator
 from .logging import *
 
 from multiprocessing import Process, Queue
 from .custom_env import Env
+from .subproc_env import SubprocEnvPool
+from .resources import ResourcePlan
+from .inference import InferencePolicy, fastest_precision
+from .checkpoints import agent_params_from_store, load_checkpoint
 from .convex_relaxation import get_kl_bound as get_state_kl_bound
+from .convex_relaxation import NativeRelaxedCtsPolicy, get_kl_bound_native
 
 from scipy.stats import norm
 
@@ -140,7 +151,7 @@ class Trainer():
     library
     '''
     def __init__(self, policy_net_class, value_net_class, params,
-                 store, advanced_logging=True, log_every=5):
+                 store, advanced_logging=True, log_every=5, env_instances=None):
         '''
         Initializes a new Trainer class.
         Inputs;
@@ -148,9 +159,24 @@ class Trainer():
         - val, the class of value network to use (inheriting from nn.Module)
         - step, a reference to a function to use for the policy step (see steps.py)
         - params, an dictionary with all of the required hyperparameters
+        - env_instances, an EnvInstancePool to take the environments from (optional)
         '''
         # Parameter Loading
         self.params = Parameters(params)
+        # Worker processes stepping the environments (None when stepped in this process)
+        self.env_pool = None
+        # Guards the environments against concurrent use by the background
+        # rollout thread of the pipelined mode (see pipelined_rollout).
+        self.envs_lock = threading.RLock()
+        self.rollout_executor = None
+        self.pending_rollouts = deque()
+        # Core budget, pinning and per-phase threads of this run (None: torch defaults)
+        self.resource_plan = None
+        if "cpu_cores" in self.params and self.params["cpu_cores"]:
+            self.resource_plan = ResourcePlan(self.params["cpu_cores"], slot=self.params["cpu_slot"],
+                    num_env_workers=self.params["num_env_workers"] if "num_env_workers" in self.params else 0,
+                    overlap_phases="pipeline_lag" in self.params and bool(self.params["pipeline_lag"]))
+            self.resource_plan.apply()
 
         # Whether or not the value network uses the current timestep
         time_in_state = self.VALUE_CALC == "time"
@@ -173,23 +199,61 @@ class Trainer():
                        save_frames=self.SAVE_FRAMES,
                        save_frames_path=self.SAVE_FRAMES_PATH)
 
-        self.envs = [env_constructor() for _ in range(self.NUM_ACTORS)]
+        # Environments reused from a pool of constructed instances (not with env workers).
+        self.env_instances = None
+        if env_instances is not None and not ("num_env_workers" in self.params and self.params["num_env_workers"]):
+            self.env_instances = env_instances
+            env_key = (self.GAME, self.NORM_STATES, self.NORM_REWARDS, self.T if time_in_state else None,
+                       self.CLIP_OBSERVATIONS, self.CLIP_REWARDS, self.GAMMA)
+            self.envs = env_instances.acquire(env_key, env_constructor, self.NUM_ACTORS)
+        else:
+            self.envs = [env_constructor() for _ in range(self.NUM_ACTORS)]
         self.params.AGENT_TYPE = "discrete" if self.envs[0].is_discrete else "continuous"
         self.params.NUM_ACTIONS = self.envs[0].num_actions
         self.params.NUM_FEATURES = self.envs[0].num_features
+        # Move the environments (and their normalizers) to worker processes.
+        # This happens before any model is created, so the workers are forked
+        # without CUDA state.
+        if "num_env_workers" in self.params and self.params["num_env_workers"]:
+            # States carry an extra t/T feature when time is added to the state.
+            state_dim = self.NUM_FEATURES + 1 if time_in_state else self.NUM_FEATURES
+            worker_cores = self.resource_plan.worker_cores() if self.resource_plan is not None else None
+            self.env_pool = SubprocEnvPool(self.envs, self.NUM_ENV_WORKERS, state_dim, worker_cores=worker_cores)
         self.policy_step = step_with_mode(self.MODE, adversary=False)
         self.adversary_policy_step = step_with_mode(self.MODE, adversary=True)
+        if "pipeline_lag" in self.params and self.params["pipeline_lag"]:
+            # Pipelined rollouts are collected in another thread by a snapshot of
+            # the policy, so they must not read any of the models being trained.
+            assert self.MODE in ["ppo", "robust_ppo", "trpo"], "pipeline_lag supports the ppo, robust_ppo and trpo modes"
+            assert self.ATTACK_METHOD == "none", "pipeline_lag does not support attacks during training"
+            assert self.HISTORY_LENGTH < 1, "pipeline_lag does not support recurrent policies"
         self.params.MAX_KL_INCREMENT = (self.params.MAX_KL_FINAL - self.params.MAX_KL) / self.params.TRAIN_STEPS
         self.advanced_logging = advanced_logging
         self.n_steps = 0
         self.log_every = log_every
         self.policy_net_class = policy_net_class
-        self.current_step = 0
+        # Steps taken in the current episode, one counter per actor.
+        self.current_step = np.zeros(self.NUM_ACTORS, dtype=np.int64)
         # Instantiation
         self.policy_model = policy_net_class(self.NUM_FEATURES, self.NUM_ACTIONS,
                                              self.INITIALIZATION,
                                              time_in_state=time_in_state,
                                              activation=self.policy_activation)
+        # Version of the policy weights, bumped whenever they change (see policy_updated)
+        self.policy_version = 0
+        # Low precision view of the policy for acting in rollouts and tests (see rollout_policy)
+        self.inference_policy = None
+        if "inference_precision" in self.params and self.params["inference_precision"] != "none":
+            if InferencePolicy.supports(self.policy_model, self.params):
+                precision = self.params["inference_precision"]
+                if precision == "auto":
+                    # Measured at the batch size of acting, one state per actor.
+                    precision = fastest_precision(self.policy_model, self.NUM_ACTORS)
+                    print(f'Acting with inference precision {precision}')
+                if precision != "none":
+                    self.inference_policy = InferencePolicy(self.policy_model, precision, self.policy_version)
+            else:
+                print(f'inference_precision={self.params["inference_precision"]} needs a memoryless CtsPolicy on CPU, acting with the training policy')
 
         # Instantiate convex relaxation model when mode is 'robust_ppo'
         if self.MODE in ['robust_ppo', 'radial_ppo', 'robust_ppo_stdv'] or self.MODE == 'adv_sa_ppo':
@@ -285,6 +349,10 @@ class Trainer():
                 dummy_input1 = torch.randn(1, self.NUM_FEATURES)
                 inputs = (dummy_input1, )
                 self.relaxed_policy_model = BoundedModule(relaxed_policy_model, inputs)
+            elif self.ROBUST_PPO_METHOD in ["native-convex-relax", "native-ibp"]:
+                # Bounds are computed directly on the policy weights, without auto_LiRPA.
+                assert isinstance(self.policy_model, CtsPolicy)
+                self.relaxed_policy_model = NativeRelaxedCtsPolicy(self.policy_model)
             elif self.ROBUST_PPO_METHOD in ["convex-relax_stdv"]:
                 from .convex_relaxation import RelaxedCtsPolicyForState_stdv
                 relaxed_policy_model = RelaxedCtsPolicyForState_stdv(
@@ -405,6 +473,13 @@ class Trainer():
             'entropy_bonus':float,
             'mean_std':float,
         }
+        if "pipeline_lag" in self.params and self.params["pipeline_lag"]:
+            optimization_table['pipeline_lag'] = int
+            optimization_table['pipeline_kl'] = float
+            optimization_table['pipeline_weight'] = float
+        if self.inference_policy is not None:
+            optimization_table['inference_max_dev'] = float
+            optimization_table['inference_mean_dev'] = float
         self.store.add_table('optimization', optimization_table)
 
         if self.advanced_logging:
@@ -444,9 +519,33 @@ class Trainer():
                 'entropy': float,
                 'loss': float,
             }
+            if "robust_ppo_bound_budget" in self.params and self.params["robust_ppo_bound_budget"]:
+                robust_cols['kl_estimate_var'] = float
+            if "sgld_warm_steps" in self.params and self.params["sgld_warm_steps"]:
+                robust_cols['sgld_steps'] = int
+                robust_cols['sgld_warm_kl'] = float
+                robust_cols['sgld_cold_kl'] = float
             self.store.add_table('robust_ppo_data', robust_cols)
 
 
+    @property
+    def envs(self):
+        # When env workers are used, the normalizer statistics of the local
+        # copies are refreshed from the workers (e.g. for checkpointing) after
+        # they have been stepped. The gym state of the workers is not copied.
+        with self.envs_lock:
+            if self.env_pool is not None and self.env_pool.dirty:
+                for env, state in zip(self._envs, self.env_pool.get_normalizer_states()):
+                    env.load_normalizer_state(state)
+            return self._envs
+
+    @envs.setter
+    def envs(self, envs):
+        with self.envs_lock:
+            self._envs = envs
+            if self.env_pool is not None:
+                self.env_pool.set_envs(envs)
+
     def __getattr__(self, x):
         '''
         Allows accessing self.A instead of self.params.A
@@ -475,14 +574,9 @@ class Trainer():
         deltas = rewards + self.GAMMA * V_s_tp1 - values
 
         # now we need to discount each path by gamma * lam
-        advantages = ch.zeros_like(rewards)
-        returns = ch.zeros_like(rewards)
-        indices = get_path_indices(not_dones)
-        for agent, start, end in indices:
-            advantages[agent, start:end] = discount_path( \
-                    deltas[agent, start:end], self.LAMBDA*self.GAMMA)
-            returns[agent, start:end] = discount_path( \
-                    rewards[agent, start:end], self.GAMMA)
+        # (all paths of all actors at once, restarting at each terminal step)
+        advantages = discount_paths(deltas, not_dones, self.LAMBDA*self.GAMMA)
+        returns = discount_paths(rewards, not_dones, self.GAMMA)
 
         return advantages.clone().detach(), returns.clone().detach()
 
@@ -491,51 +585,78 @@ class Trainer():
         Resets environments and returns initial state with shape:
         (# actors, 1, ... state_shape)
 	    '''
+        if isinstance(envs, SubprocEnvPool):
+            initial_states = envs.reset()
+        else:
+            initial_states = [env.reset() for env in envs]
         if self.CPU:
-            return cpu_tensorize([env.reset() for env in envs]).unsqueeze(1)
+            return cpu_tensorize(initial_states).unsqueeze(1)
         else:
-            return cu_tensorize([env.reset() for env in envs]).unsqueeze(1)
+            return cu_tensorize(initial_states).unsqueeze(1)
 
-    def multi_actor_step(self, actions, envs, max_len=20000, t=0):
+    def multi_actor_step(self, actions, envs, max_len=20000, t=0, out=None):
         '''
         Simulate a "step" by several actors on their respective environments
         Inputs:
         - actions, list of actions to take
         - envs, list of the environments in which to take the actions
+        - out, optional (rewards, not_dones, states) numpy arrays indexed by actor,
+            e.g. from RolloutStorage.step_buffers, which the results are written into.
+            Otherwise new arrays are allocated.
         Returns:
         - completed_episode_info, a variable-length list of final rewards and episode lengths
             for the actors which have completed
         - rewards, a actors-length tensor with the rewards collected
         - states, a (actors, ... state_shape) tensor with resulting states
         - not_dones, an actors-length tensor with 0 if terminal, 1 otw
+        - x_velocities, an actors-length numpy array with the forward velocity of each actor
+        On CPU the returned tensors are views of the output arrays.
         '''
-        normed_rewards, states, not_dones = [], [], []
+        num_actors = len(actions)
+        if out is None:
+            out = (np.zeros(num_actors, dtype=np.float32),
+                   np.zeros(num_actors, dtype=np.float32),
+                   np.zeros((num_actors, self.NUM_FEATURES), dtype=np.float32))
+        rewards_out, not_dones_out, states_out = out
         completed_episode_info = []
-        x_velocity = 0
-        for action, env in zip(actions, envs):
-            gym_action = action[0].cpu().numpy()
-            new_state, normed_reward, counter, total_true_reward, is_done, info = env.step(gym_action)
-            is_done = not env.env.is_healthy
-            x_velocity = info['x_velocity']
-            #print(x_velocity)
-            if is_done or self.current_step==max_len:
-                if self.current_step==max_len:
-                    info['done']=(counter, total_true_reward)
-                self.current_step = 0
-                completed_episode_info.append(info['done'])
-                new_state = env.reset()
-
-            # Aggregate
-            normed_rewards.append([normed_reward])
-            not_dones.append([int(not is_done)])
-            states.append([new_state])
-
-        tensor_maker = cpu_tensorize if self.CPU else cu_tensorize
-        data = list(map(tensor_maker, [normed_rewards, states, not_dones]))
-        return [completed_episode_info, *data, x_velocity]
+        # One device-to-host copy for the actions of all actors.
+        gym_actions = actions[:, 0].cpu().numpy()
+        if isinstance(envs, SubprocEnvPool):
+            timeouts = self.current_step == max_len
+            new_states, normed_rewards, dones, episode_info, x_velocities = envs.step(gym_actions, timeouts)
+            ended = dones | timeouts
+            completed_episode_info = [tuple(episode_info[i]) for i in np.flatnonzero(ended)]
+            self.current_step[ended] = 0
+            rewards_out[:] = normed_rewards
+            not_dones_out[:] = ~dones
+            states_out[:] = new_states
+            x_velocities = x_velocities.copy()
+        else:
+            x_velocities = np.zeros(num_actors)
+            # Every actor is reset independently when its own episode terminates.
+            for i, (gym_action, env) in enumerate(zip(gym_actions, envs)):
+                new_state, normed_reward, counter, total_true_reward, is_done, info = env.step(gym_action, state_out=states_out[i])
+                is_done = not env.env.is_healthy
+                x_velocities[i] = info['x_velocity']
+                #print(x_velocity)
+                if is_done or self.current_step[i]==max_len:
+                    if self.current_step[i]==max_len:
+                        info['done']=(counter, total_true_reward)
+                    self.current_step[i] = 0
+                    completed_episode_info.append(info['done'])
+                    new_state = env.reset(state_out=states_out[i])
+
+                # Write in place
+                rewards_out[i] = normed_reward
+                not_dones_out[i] = not is_done
+                states_out[i] = new_state
+
+        tensor_maker = ch.from_numpy if self.CPU else (lambda x: ch.from_numpy(x).cuda())
+        data = [tensor_maker(v).unsqueeze(1) for v in (rewards_out, states_out, not_dones_out)]
+        return [completed_episode_info, *data, x_velocities]
 
     def run_trajectories(self, num_saps, return_rewards=False, should_tqdm=False,
-            collect_adversary_trajectory=False):
+            collect_adversary_trajectory=False, policy_model=None):
         global current_iteration
         """
         Resets environments, and runs self.T steps in each environment in 
@@ -552,59 +673,60 @@ class Trainer():
         - action_logprobs: (# actors, self.T, ) log probabilities of each action
         - states: (# actors, self.T, ... state_shape) states
         """
+        if policy_model is None:
+            # A different (e.g. snapshot) policy may be given for pipelined collection.
+            policy_model = self.rollout_policy()
         if collect_adversary_trajectory:
             # The adversary does not change environment normalization.
             # So a trained adversary can be applied to the original policy when it is trained as an optimal attack.
-            old_env_read_only_flags = []
-            for e in self.envs:
-                old_env_read_only_flags.append(e.normalizer_read_only)
-                e.normalizer_read_only = True
+            if self.env_pool is not None:
+                old_env_read_only_flags = self.env_pool.get_attr('normalizer_read_only')
+                self.env_pool.set_attr('normalizer_read_only', [True] * len(old_env_read_only_flags))
+            else:
+                old_env_read_only_flags = []
+                for e in self.envs:
+                    old_env_read_only_flags.append(e.normalizer_read_only)
+                    e.normalizer_read_only = True
 
         # Arrays to be updated with historic info
-        envs = self.envs
+        envs = self.env_pool if self.env_pool is not None else self.envs
         initial_states = self.reset_envs(envs)
-        self.policy_model.reset()
+        policy_model.reset()
         self.val_model.reset()
 
         # Holds information (length and true reward) about completed episodes
         completed_episode_info = []
         traj_length = int(num_saps // self.NUM_ACTORS)
 
-        shape = (self.NUM_ACTORS, traj_length)
-        all_zeros = [ch.zeros(shape) for i in range(3)]
-        rewards, not_dones, action_log_probs = all_zeros
-
         if collect_adversary_trajectory:
             # collect adversary trajectory is only valid in minimax training mode.
             assert self.MODE == "adv_ppo" or self.MODE == "adv_trpo" or self.MODE == "adv_sa_ppo"
             # For the adversary, action is a state perturbation.
-            actions_shape = shape + (self.NUM_FEATURES,)
+            action_shape = (self.NUM_FEATURES,)
         else:
-            actions_shape = shape + (self.NUM_ACTIONS,)
-        actions = ch.zeros(actions_shape)
-        # Mean of the action distribution. Used for avoid unnecessary recomputation.
-        action_means = ch.zeros(actions_shape)
-        # Log Std of the action distribution.
-        # action_stds = ch.zeros(actions_shape)
-
-        states_shape = (self.NUM_ACTORS, traj_length+1) + initial_states.shape[2:]
-        states =  ch.zeros(states_shape)
+            action_shape = (self.NUM_ACTIONS,)
+        # Preallocated host buffers. The environments write rewards, not_dones
+        # and next states into them directly (see multi_actor_step).
+        storage = RolloutStorage(self.NUM_ACTORS, traj_length, initial_states.shape[2:], action_shape)
+        rewards, not_dones, action_log_probs = storage.rewards, storage.not_dones, storage.action_log_probs
+        # action_means is the mean of the action distribution. Used for avoid unnecessary recomputation.
+        actions, action_means, states = storage.actions, storage.action_means, storage.states
         iterator = range(traj_length) if not should_tqdm else tqdm.trange(traj_length)
 
-        assert self.NUM_ACTORS == 1
+        # Recurrent policies keep a single hidden state, so they can only drive one actor.
+        assert self.NUM_ACTORS == 1 or self.HISTORY_LENGTH < 1
 
         is_advpolicy_training = self.MODE == "adv_ppo" or self.MODE == "adv_trpo" or self.MODE == "adv_sa_ppo"
 
         collect_perturbed_state = ((is_advpolicy_training and not collect_adversary_trajectory)
                 or ((not is_advpolicy_training) and self.COLLECT_PERTURBED_STATES))
 
-        if collect_perturbed_state:
-            # States are collected after the perturbation. We cannot set states[:, 0, :] here as we have not started perturbation yet.
-            last_states = initial_states.squeeze(1)  # Remove the second dimension (number of actions)
-        else:
+        # Remove the second dimension (number of actions)
+        last_states = initial_states.squeeze(1)
+        if not collect_perturbed_state:
             # States are collected before the perturbation.
-            states[:, 0, :] = initial_states
-            last_states = states[:, 0, :]
+            # Otherwise they are collected after the perturbation, so we cannot set states[:, 0, :] yet.
+            states[:, 0, :] = last_states
         current_iteration += 1
         #max_len=500
         #if current_iteration >= 480:
@@ -617,7 +739,7 @@ class Trainer():
             # next_action_probs: (# actors, 1), prob of taken actions
 
             # The adversary may use the policy or value function, so pause history update.
-            self.policy_model.pause_history()
+            policy_model.pause_history()
             self.val_model.pause_history()
 
             if is_advpolicy_training:
@@ -651,23 +773,15 @@ class Trainer():
                     raise RuntimeError(f"{max_eps} > {attack_eps}. Attack implementation has bug and eps is not correctly handled.")
                 last_states = maybe_attacked_last_states
 
-            self.policy_model.continue_history()
+            policy_model.continue_history()
             self.val_model.continue_history()
             if self.SMOOTHING:
-                num = self.TRAINING_M
-                total_action_mean = []
-                total_action_std = []
-                for i in range(num):
-                    noised_states = last_states + ch.normal(0.0, self.SIGMA, last_states.size())
-                    action_pds = self.policy_model(noised_states)
-                    total_action_mean.append(action_pds[0])
-                    total_action_std.append(action_pds[1])
-                action_pds = (ch.median(ch.stack(total_action_mean), dim=0)[0], ch.median(ch.stack(total_action_std), dim=0)[0])
+                action_pds = smoothed_forward(policy_model, last_states, self.TRAINING_M, self.SIGMA, smoothing_chunk(self.params))
             else:
-                action_pds = self.policy_model(last_states)
+                action_pds = policy_model(last_states)
             next_action_means, next_action_stds = action_pds
-            next_actions = self.policy_model.sample(action_pds)
-            next_action_log_probs = self.policy_model.get_loglikelihood(action_pds, next_actions)
+            next_actions = policy_model.sample(action_pds)
+            next_action_log_probs = policy_model.get_loglikelihood(action_pds, next_actions)
 
             next_action_log_probs = next_action_log_probs.unsqueeze(1)
             # shape_equal([self.NUM_ACTORS, 1], next_action_log_probs)
@@ -675,20 +789,20 @@ class Trainer():
             # if discrete, next_actions is (# actors, 1) 
             # otw if continuous (# actors, 1, action dim)
             next_actions = next_actions.unsqueeze(1)
-            # if self.policy_model.discrete:
+            # if policy_model.discrete:
             #     assert shape_equal([self.NUM_ACTORS, 1], next_actions)
             # else:
-            #     assert shape_equal([self.NUM_ACTORS, 1, self.policy_model.action_dim])
+            #     assert shape_equal([self.NUM_ACTORS, 1, policy_model.action_dim])
 
             self.current_step += 1
-            ret = self.multi_actor_step(next_actions, envs, 20000, self.current_step)
+            ret = self.multi_actor_step(next_actions, envs, 20000, self.current_step, out=storage.step_buffers(t))
 
             # done_info = List of (length, reward) pairs for each completed trajectory
             # (next_rewards, next_states, next_dones) act like multi-actor env.step()
-            done_info, next_rewards, next_states, next_not_dones, x_velocity = ret
+            done_info, next_rewards, next_states, next_not_dones, x_velocities = ret
             # Reset the policy (if the policy has memory if we are done)
-            if next_not_dones.item() == 0:
-                self.policy_model.reset()
+            if (next_not_dones == 0).any():
+                policy_model.reset()
                 self.val_model.reset()
             # assert shape_equal([self.NUM_ACTORS, 1], next_rewards, next_not_dones)
             # assert shape_equal([self.NUM_ACTORS, 1, self.NUM_FEATURES], next_states)
@@ -699,52 +813,20 @@ class Trainer():
                 completed_episode_info.extend(done_info)
 
             # Update histories
-            # each shape: (nact, t, ...) -> (nact, t + 1, ...)
-
+            # Rewards, not_dones and the next true environment state are
+            # already in the storage; only the policy outputs are copied here.
             if collect_adversary_trajectory:
-                # negate the reward for minimax training. Collect states before perturbation.
-                next_rewards = -next_rewards
-                pairs = [
-                    (rewards, next_rewards),
-                    (not_dones, next_not_dones),
-                    (actions, next_adv_perturbations), # The sampled actions, which is perturbations.
-                    (action_means, next_adv_perturbation_means), # The Gaussian mean of actions.
-                    # (action_stds, next_action_stds), # The Gaussian std of actions, is a constant, no need to save.
-                    (action_log_probs, next_adv_perturbation_log_probs),
-                    (states, next_states), # we save the true environment state without perturbation.
-                ]
+                actions[:, t] = next_adv_perturbations[:, 0] # The sampled actions, which is perturbations.
+                action_means[:, t] = next_adv_perturbation_means # The Gaussian mean of actions.
+                action_log_probs[:, t] = next_adv_perturbation_log_probs
             else:
+                actions[:, t] = next_actions[:, 0] # The sampled actions.
+                action_means[:, t] = next_action_means # The Gaussian mean of actions.
+                action_log_probs[:, t] = next_action_log_probs[:, 0]
                 if collect_perturbed_state:
-                    # New adversarial training. We save the perturbed environment state.
-                    pairs = [
-                        (rewards, next_rewards),
-                        (not_dones, next_not_dones),
-                        (actions, next_actions), # The sampled actions.
-                        (action_means, next_action_means), # The Gaussian mean of actions.
-                        # (action_stds, next_action_stds), # The Gaussian std of actions, is a constant, no need to save.
-                        (action_log_probs, next_action_log_probs),
-                        (states, last_states.unsqueeze(1)), # perturbed environment state.
-                    ]
-                else:
-                    # Previous naive adversarial training. We save the true environment state.
-                    pairs = [
-                        (rewards, next_rewards),
-                        (not_dones, next_not_dones),
-                        (actions, next_actions), # The sampled actions.
-                        (action_means, next_action_means), # The Gaussian mean of actions.
-                        # (action_stds, next_action_stds), # The Gaussian std of actions, is a constant, no need to save.
-                        (action_log_probs, next_action_log_probs),
-                        (states, next_states), # true environment state.
-                    ]
-
-            for total, v in pairs:
-                if total is states and not collect_perturbed_state:
-                    # Next states, stores in the next position.
-                    total[:, t+1] = v
-                else:
-                    # The current action taken, and reward received.
-                    # When perturbed state is collected, we also do not neeed the +1 shift
-                    total[:, t] = v
+                    # New adversarial training. We save the perturbed environment state
+                    # (the true one written to this slot at the previous step is overwritten).
+                    states[:, t] = last_states
             last_states = next_states[:, 0, :]
 
         if collect_perturbed_state:
@@ -757,12 +839,17 @@ class Trainer():
                 last_states = last_states + ch.nn.functional.hardtanh(next_adv_perturbations) * self.ADV_EPS
             else:
                 last_states = self.apply_attack(last_states)
-            states[:, -1] = last_states.unsqueeze(1)
+            storage.final_states[:] = last_states
 
         if collect_adversary_trajectory:
+            # negate the reward for minimax training.
+            rewards.neg_()
             # Finished adversary step. Take new samples for normalizing environment.
-            for e, flag in zip(self.envs, old_env_read_only_flags):
-                e.normalizer_read_only = flag
+            if self.env_pool is not None:
+                self.env_pool.set_attr('normalizer_read_only', old_env_read_only_flags)
+            else:
+                for e, flag in zip(self.envs, old_env_read_only_flags):
+                    e.normalizer_read_only = flag
 
 
         # Calculate the average episode length and true rewards over all the trajectories
@@ -776,11 +863,8 @@ class Trainer():
             avg_episode_length = -1
             avg_episode_reward = -1
 
-        # Last state is never acted on, discard
-        states = states[:,:-1,:]
-        trajs = Trajectories(rewards=rewards, 
-            action_log_probs=action_log_probs, not_dones=not_dones, 
-            actions=actions, states=states, action_means=action_means, action_std=next_action_stds)
+        trajs = storage.to_trajectories(action_std=next_action_stds,
+                                        device_op=None if self.CPU else (lambda x: x.cuda()))
 
         to_ret = (avg_episode_length, avg_episode_reward, trajs)
         if return_rewards:
@@ -799,6 +883,8 @@ class Trainer():
         else:
             eps = float(eps)
         steps = self.params.ATTACK_STEPS
+        # Number of random starts per state, optimized as one batch (see pgd_maximize).
+        restarts = self.params["attack_restarts"] if "attack_restarts" in self.params and self.params["attack_restarts"] else 1
         if self.params.ATTACK_METHOD == "critic":
             # Find a state that is close the last_states and decreases value most.
             if steps > 0:
@@ -806,21 +892,11 @@ class Trainer():
                     step_eps = eps / steps
                 else:
                     step_eps = float(self.params.ATTACK_STEP_EPS)
-                clamp_min = last_states - eps
-                clamp_max = last_states + eps
-                # Random start.
-                noise = torch.empty_like(last_states).uniform_(-step_eps, step_eps)
-                states = last_states + noise
-                with torch.enable_grad():
-                    for i in range(steps):
-                        states = states.clone().detach().requires_grad_()
-                        value = self.val_model(states).mean(dim=1)
-                        value.backward()
-                        update = states.grad.sign() * step_eps
-                        # Clamp to +/- eps.
-                        states.data = torch.min(torch.max(states.data - update, clamp_min), clamp_max)
-                    self.val_model.zero_grad()
-                return states.detach()
+                def objective(states):
+                    # Decrease the value most.
+                    return -self.val_model(states).mean(dim=1)
+                # Random start, clamped to +/- eps.
+                return pgd_maximize(objective, last_states, eps, step_eps, steps, restarts=restarts)
             else:
                 return last_states
         elif self.params.ATTACK_METHOD == "random":
@@ -833,13 +909,8 @@ class Trainer():
                     step_eps = eps / steps
                 else:
                     step_eps = float(self.params.ATTACK_STEP_EPS)
-                clamp_min = last_states - eps
-                clamp_max = last_states + eps
                 # SGLD noise factor. We simply set beta=1.
                 noise_factor = np.sqrt(2 * step_eps)
-                noise = torch.randn_like(last_states) * noise_factor
-                # The first step has gradient zero, so add the noise and projection directly.
-                states = last_states + noise.sign() * step_eps
                 # Current action at this state.
                 if self.params.ATTACK_METHOD == "action+imit":
                     if not hasattr(self, "imit_network") or self.imit_network == None:
@@ -851,31 +922,24 @@ class Trainer():
                         self.imit_network.load_state_dict(imit_ckpt['state_dict'])
                         self.imit_network.reset()
                         self.imit_network.pause_history()
-                    old_action, old_stdev = self.imit_network(last_states)
+                    attack_network = self.imit_network
                 else:
-                    old_action, old_stdev = self.policy_model(last_states)
+                    attack_network = self.policy_model
+                old_action, old_stdev = attack_network(last_states)
                 # Normalize stdev, avoid numerical issue
                 old_stdev /= (old_stdev.mean())
                 old_action = old_action.detach()
-                with torch.enable_grad():
-                    for i in range(steps):
-                        states = states.clone().detach().requires_grad_()
-                        if self.params.ATTACK_METHOD == "action+imit":
-                            action_change = (self.imit_network(states)[0] - old_action) / old_stdev
-                        else:
-                            action_change = (self.policy_model(states)[0] - old_action) / old_stdev
-                        action_change = (action_change * action_change).sum(dim=1)
-                        action_change.backward()
-                        # Reduce noise at every step.
-                        noise_factor = np.sqrt(2 * step_eps) / (i+2)
-                        # Project noisy gradient to step boundary.
-                        update = (states.grad + noise_factor * torch.randn_like(last_states)).sign() * step_eps
-                        # Clamp to +/- eps.
-                        states.data = torch.min(torch.max(states.data + update, clamp_min), clamp_max)
-                    if self.params.ATTACK_METHOD == "action+imit": 
-                        self.imit_network.zero_grad() 
-                    self.policy_model.zero_grad()
-                return states.detach()
+                # One copy of the targets for every random start.
+                old_action = old_action.repeat(restarts, 1)
+                if old_stdev.dim() > 1:
+                    old_stdev = old_stdev.repeat(restarts, 1)
+                def objective(states):
+                    action_change = (attack_network(states)[0] - old_action) / old_stdev
+                    return (action_change * action_change).sum(dim=1)
+                # The first step has gradient zero, so it starts with a random sign step,
+                # then takes noisy gradient steps clamped to +/- eps.
+                return pgd_maximize(objective, last_states, eps, step_eps, steps, start="sign",
+                                    noise_factor=noise_factor, restarts=restarts)
             else:
                 return last_states
         elif self.params.ATTACK_METHOD == "sarsa" or self.params.ATTACK_METHOD == "sarsa+action":
@@ -903,37 +967,31 @@ class Trainer():
                     step_eps = eps / steps
                 else:
                     step_eps = float(self.params.ATTACK_STEP_EPS)
-                clamp_min = last_states - eps
-                clamp_max = last_states + eps
-                # Random start.
-                noise = torch.empty_like(last_states).uniform_(-step_eps, step_eps)
-                states = last_states + noise
+                # One copy of the true states for every random start.
+                true_states = last_states.repeat(restarts, 1)
                 if use_action:
                     # Current action at this state.
                     old_action, old_stdev = self.policy_model(last_states)
                     old_stdev /= (old_stdev.mean())
-                    old_action = old_action.detach()
-                with torch.enable_grad():
-                    for i in range(steps):
-                        states = states.clone().detach().requires_grad_()
-                        # This is the mean action...
-                        actions = self.policy_model(states)[0]
-                            
-                        value = self.sarsa_network(torch.cat((last_states, actions), dim=1)).mean(dim=1)
-                        if use_action:
-                            action_change = (actions - old_action) / old_stdev
-                            # We want to maximize the action change, thus the minus sign.
-                            action_change = -(action_change * action_change).mean(dim=1)
-                            loss = action_ratio * action_change + (1.0 - action_ratio) * value
-                        else:
-                            action_change = 0.0
-                            loss = value
-                        loss.backward()
-                        update = states.grad.sign() * step_eps
-                        # Clamp to +/- eps.
-                        states.data = torch.min(torch.max(states.data - update, clamp_min), clamp_max)
-                    self.val_model.zero_grad()
-                return states.detach()
+                    old_action = old_action.detach().repeat(restarts, 1)
+                    if old_stdev.dim() > 1:
+                        old_stdev = old_stdev.repeat(restarts, 1)
+                def objective(states):
+                    # This is the mean action...
+                    actions = self.policy_model(states)[0]
+
+                    value = self.sarsa_network(torch.cat((true_states, actions), dim=1)).mean(dim=1)
+                    if use_action:
+                        action_change = (actions - old_action) / old_stdev
+                        # We want to maximize the action change, thus the minus sign.
+                        action_change = -(action_change * action_change).mean(dim=1)
+                        loss = action_ratio * action_change + (1.0 - action_ratio) * value
+                    else:
+                        loss = value
+                    # Decrease the loss most.
+                    return -loss
+                # Random start, clamped to +/- eps.
+                return pgd_maximize(objective, last_states, eps, step_eps, steps, restarts=restarts)
             else:
                 return last_states
         elif self.params.ATTACK_METHOD == "advpolicy":
@@ -966,14 +1024,19 @@ class Trainer():
 
     """Run trajectories and return saps and values for each state."""
     def collect_saps(self, num_saps, should_log=True, return_rewards=False,
-                     should_tqdm=False, test=False, collect_adversary_trajectory=False):
+                     should_tqdm=False, test=False, collect_adversary_trajectory=False,
+                     rollout=None):
         table_name_suffix = "_adv" if collect_adversary_trajectory else ""
         with torch.no_grad():
-            # Run trajectories, get values, estimate advantage
-            output = self.run_trajectories(num_saps,
-                                           return_rewards=return_rewards,
-                                           should_tqdm=should_tqdm,
-                                           collect_adversary_trajectory=collect_adversary_trajectory)
+            # Run trajectories (unless the output of run_trajectories is given), get values, estimate advantage
+            if rollout is None:
+                with self.envs_lock:
+                    output = self.run_trajectories(num_saps,
+                                                   return_rewards=return_rewards,
+                                                   should_tqdm=should_tqdm,
+                                                   collect_adversary_trajectory=collect_adversary_trajectory)
+            else:
+                output = rollout
 
             if not return_rewards:
                 avg_ep_length, avg_ep_reward, trajs = output
@@ -1008,9 +1071,10 @@ class Trainer():
                 advantages, returns = self.advantage_and_return(trajs.rewards,
                                                 values, trajs.not_dones)
 
-                trajs.advantages = advantages
-                trajs.returns = returns
-                trajs.values = values
+                # Written into the packed slots of the rollout (see Trajectories.set_field).
+                trajs.set_field('advantages', advantages)
+                trajs.set_field('returns', returns)
+                trajs.set_field('values', values)
 
                 assert shape_equal_cmp(trajs.advantages, 
                                 trajs.returns, trajs.values)
@@ -1034,6 +1098,106 @@ class Trainer():
         return to_ret
 
 
+    def rollout_policy(self):
+        '''
+        The policy acting in rollouts and tests: the inference view if
+        inference_precision is set, exported again only if the weights have
+        changed since (policy_version); otherwise the policy itself.
+        '''
+        if self.inference_policy is None:
+            return self.policy_model
+        if self.inference_policy.policy_model is not self.policy_model:
+            self.inference_policy = InferencePolicy(self.policy_model, self.inference_policy.precision, self.policy_version)
+        else:
+            self.inference_policy.refresh(self.policy_version)
+        return self.inference_policy
+
+    def policy_updated(self):
+        '''
+        Marks the policy weights as changed (by an optimization step or a
+        loaded checkpoint), so that the inference view is exported again.
+        '''
+        self.policy_version += 1
+
+    def log_inference_deviation(self, states, inference_policy):
+        '''
+        Accuracy check of the inference view that sampled a batch: deviation
+        of its action means from the float32 policy it was exported from, on
+        (up to 1024 of) the rollout states.
+        '''
+        max_dev, mean_dev = inference_policy.deviation(states[:1024])
+        print(f'Inference policy ({inference_policy.precision}) action mean deviation: max={max_dev:.5g}, mean={mean_dev:.5g}')
+        self.store.log_table_and_tb('optimization', {
+            'inference_max_dev': max_dev,
+            'inference_mean_dev': mean_dev,
+        })
+
+    def cpu_phase(self, name):
+        '''
+        Context manager running a phase ("rollout" or "optimization") with the
+        threads of the CPU resource plan; a no-op without a plan.
+        '''
+        if self.resource_plan is None:
+            return contextlib.nullcontext()
+        return self.resource_plan.phase(name)
+
+    def pipelined_rollout(self, num_saps):
+        '''
+        Collects rollouts in a background thread while the learner optimizes,
+        keeping PIPELINE_LAG collections in flight. Each collection uses a copy
+        of the policy taken when it was queued, so the returned batch was
+        sampled by a policy up to PIPELINE_LAG updates old. With
+        inference_precision, the copy acts through its own inference view.
+        Returns:
+        - lag: number of policy updates since the batch's policy snapshot
+        - the policy snapshot (or its inference view) that sampled the batch
+        - the output of run_trajectories for that batch
+        '''
+        if self.rollout_executor is None:
+            self.rollout_executor = ThreadPoolExecutor(max_workers=1)
+        while len(self.pending_rollouts) < self.PIPELINE_LAG + 1:
+            snapshot = copy.deepcopy(self.policy_model)
+            if self.inference_policy is not None:
+                snapshot = InferencePolicy(snapshot, self.inference_policy.precision)
+            future = self.rollout_executor.submit(self.background_rollout, num_saps, snapshot)
+            self.pending_rollouts.append((self.n_steps, snapshot, future))
+        queued_step, snapshot, future = self.pending_rollouts.popleft()
+        return self.n_steps - queued_step, snapshot, future.result()
+
+    def background_rollout(self, num_saps, policy_model):
+        # no_grad is thread local, so it has to be entered in the worker thread.
+        with self.envs_lock, torch.no_grad():
+            return self.run_trajectories(num_saps, policy_model=policy_model)
+
+    def set_proximal_policy(self, saps, lag):
+        '''
+        Marks a stale batch (sampled by a policy snapshot lag updates old) for
+        the decoupled PPO objective: the log probabilities and distributions
+        of the current (proximal) policy are stored next to the behavior log
+        probabilities, which are kept. The policy step clips the ratio around
+        the proximal policy and weights every sample by the truncated ratio
+        min(proximal / behavior, PIPELINE_WEIGHT_CLIP) (see behavior_weights
+        in steps.py). Logs the lag, a sample estimate of KL(behavior ||
+        proximal) and the mean weight.
+        '''
+        with torch.no_grad():
+            if self.SMOOTHING:
+                action_pds = smoothed_forward(self.policy_model, saps.states, self.TRAINING_M, self.SIGMA, smoothing_chunk(self.params))
+            else:
+                action_pds = self.policy_model(saps.states)
+            log_probs = self.policy_model.get_loglikelihood(action_pds, saps.actions)
+        saps.proximal_log_probs = log_probs
+        saps.proximal_pds = action_pds
+        # The actions were sampled from the behavior policy, so this is an unbiased estimate.
+        behavior_kl = (saps.action_log_probs - log_probs).mean().item()
+        mean_weight = behavior_weights(log_probs, saps.action_log_probs, self.params).mean().item()
+        print(f"Pipeline lag: {lag} | KL(behavior || proximal): {behavior_kl:.5g} | mean weight: {mean_weight:.5g}")
+        self.store.log_table_and_tb('optimization', {
+            'pipeline_lag': lag,
+            'pipeline_kl': behavior_kl,
+            'pipeline_weight': mean_weight,
+        })
+
     def sarsa_steps(self, saps):
         # Begin advanged logging code
         assert saps.unrolled
@@ -1046,19 +1210,14 @@ class Trainer():
         self.sarsa_eps_scheduler.step_epoch()
         self.sarsa_beta_scheduler.step_epoch()
         # saps contains state->action->reward and not_done.
+        # Minibatches are shuffled once per epoch (see MinibatchLoader).
+        loader = MinibatchLoader(saps.states, saps.actions, saps.rewards, saps.not_dones,
+                                 num_minibatches=self.params.NUM_MINIBATCHES)
         for i in range(self.params.VAL_EPOCHS):
-            # Create minibatches with shuffuling
-            state_indices = np.arange(saps.rewards.nelement())
-            np.random.shuffle(state_indices)
-            splits = np.array_split(state_indices, self.params.NUM_MINIBATCHES)
-
             # Minibatch SGD
-            for selected in splits:
-                def sel(*args):
-                    return [v[selected] for v in args]
-
+            for _, batch in loader:
                 self.sarsa_opt.zero_grad()
-                sel_states, sel_actions, sel_rewards, sel_not_dones = sel(saps.states, saps.actions, saps.rewards, saps.not_dones)
+                sel_states, sel_actions, sel_rewards, sel_not_dones = batch
                 self.sarsa_eps_scheduler.step_batch()
                 self.sarsa_beta_scheduler.step_batch()
                 
@@ -1184,8 +1343,14 @@ class Trainer():
             # Logging Robust PPO KL, entropy, etc.
             store_to_pass = self.store
 
+        # Pipelined batches are optimized with the decoupled objective (see set_proximal_policy).
+        step_kwargs = {}
+        old_log_probs = saps.action_log_probs
+        if saps.proximal_log_probs is not None and not adversary_step:
+            old_log_probs = saps.proximal_log_probs
+            step_kwargs['behavior_log_ps'] = saps.action_log_probs
         # Take optimizer steps
-        args = [saps.states, saps.actions, saps.action_log_probs,
+        args = [saps.states, saps.actions, old_log_probs,
                 saps.rewards, saps.returns, saps.not_dones, 
                 saps.advantages, policy_model, policy_params, 
                 store_to_pass, self.n_steps]
@@ -1203,7 +1368,8 @@ class Trainer():
         if adversary_step:
             policy_loss, surr_loss, entropy_bonus = self.adversary_policy_step(*args)
         else:
-            policy_loss, surr_loss, entropy_bonus = self.policy_step(*args)
+            policy_loss, surr_loss, entropy_bonus = self.policy_step(*args, **step_kwargs)
+            self.policy_updated()
 
         # If the anneal_lr option is set, then we decrease the 
         # learning rate at each training step
@@ -1213,7 +1379,7 @@ class Trainer():
         if should_adv_log and not adversary_step:
             log_value_losses(self, val_saps, 'heldout')
             log_value_losses(self, saps, 'train')
-            old_pds = saps.action_means, saps.action_std
+            old_pds = saps.proximal_pds if saps.proximal_pds is not None else (saps.action_means, saps.action_std)
             paper_constraints_logging(self, saps, old_pds,
                             table='paper_constraints_train')
             paper_constraints_logging(self, val_saps, val_old_pds,
@@ -1272,8 +1438,18 @@ class Trainer():
             policy_model = self.policy_model
 
         num_saps = self.T * self.NUM_ACTORS
-        saps, avg_ep_reward, avg_ep_length = self.collect_saps(num_saps, collect_adversary_trajectory=adversary_step)
-        policy_loss, surr_loss, entropy_bonus, val_loss = self.take_steps(saps, adversary_step=adversary_step, increment_scheduler=increment_scheduler)
+        if "pipeline_lag" in self.params and self.params["pipeline_lag"]:
+            # The next batches are collected while this one is optimized.
+            lag, acting_policy, rollout = self.pipelined_rollout(num_saps)
+            saps, avg_ep_reward, avg_ep_length = self.collect_saps(num_saps, rollout=rollout)
+            self.set_proximal_policy(saps, lag)
+        else:
+            saps, avg_ep_reward, avg_ep_length = self.collect_saps(num_saps, collect_adversary_trajectory=adversary_step)
+            acting_policy = self.inference_policy
+        if self.inference_policy is not None and not adversary_step:
+            self.log_inference_deviation(saps.states, acting_policy)
+        with self.cpu_phase("optimization"):
+            policy_loss, surr_loss, entropy_bonus, val_loss = self.take_steps(saps, adversary_step=adversary_step, increment_scheduler=increment_scheduler)
         # Logging code
         print(f"Policy Loss: {policy_loss:.5g}, | Entropy Bonus: {entropy_bonus:.5g}, | Value Loss: {val_loss:.5g}")
         print("Time elapsed (s):", time.time() - start_time)
@@ -1318,7 +1494,8 @@ class Trainer():
         num_saps = self.T * self.NUM_ACTORS
         saps, avg_ep_reward, avg_ep_length = self.collect_saps(num_saps, should_log=True, test=True)
          
-        sarsa_loss, q = self.sarsa_steps(saps)
+        with self.cpu_phase("optimization"):
+            sarsa_loss, q = self.sarsa_steps(saps)
         print("Sarsa Loss:", sarsa_loss.item())
         print("Q:", q.item())
         print("Time elapsed (s):", time.time() - start_time)
@@ -1339,15 +1516,23 @@ class Trainer():
             ep_length, ep_reward, ep_avg_adiv, actions, action_means, states, steps, velocities = output
             msg = "Episode reward: %f | episode adiv: %f | episode length: %f"
             print(msg % (ep_reward, ep_avg_adiv, ep_length))
+            if self.inference_policy is not None:
+                max_dev, mean_dev = self.inference_policy.deviation(states[:1024])
+                print(f'Inference policy ({self.inference_policy.precision}) action mean deviation: max={max_dev:.5g}, mean={mean_dev:.5g}')
             if compute_bounds:
                 if original_stdev is None:
                     kl_stdev = torch.exp(self.policy_model.log_stdev)
                 else:
                     kl_stdev = torch.exp(original_stdev)
                 eps = float(self.params.ROBUST_PPO_EPS) if self.params.ATTACK_EPS == "same" else float(self.params.ATTACK_EPS)
-                kl_upper_bound = get_state_kl_bound(self.relaxed_policy_model, states, action_means,
-                        eps=eps, beta=0.0,
-                        stdev=kl_stdev, use_full_backward=use_full_backward).mean()
+                if isinstance(self.relaxed_policy_model, NativeRelaxedCtsPolicy):
+                    kl_bound = get_kl_bound_native
+                else:
+                    kl_bound = get_state_kl_bound
+                with self.cpu_phase("optimization"):
+                    kl_upper_bound = kl_bound(self.relaxed_policy_model, states, action_means,
+                            eps=eps, beta=0.0,
+                            stdev=kl_stdev, use_full_backward=use_full_backward).mean()
                 kl_upper_bound = kl_upper_bound.item()
             else:
                 kl_upper_bound = float("nan")
@@ -1355,16 +1540,32 @@ class Trainer():
         return ep_length, ep_reward, ep_avg_adiv, actions.cpu().numpy(), action_means.cpu().numpy(), states.cpu().numpy(), kl_upper_bound, steps, velocities
 
     def run_test_trajectories(self, max_len, should_tqdm=False):
+        if self.env_pool is None:
+            return self._run_test_trajectories(max_len, should_tqdm)
+        # With env workers, the test episode runs on the local copy of the
+        # first env, so its normalizers are read-only to keep the statistics
+        # equal to those of the worker (and of the checkpoints).
+        env = self.envs[0]
+        read_only = env.normalizer_read_only
+        env.normalizer_read_only = True
+        try:
+            return self._run_test_trajectories(max_len, should_tqdm)
+        finally:
+            env.normalizer_read_only = read_only
+
+    def _run_test_trajectories(self, max_len, should_tqdm=False):
         # Arrays to be updated with historic info
         steps = []
         velocities = []
 
-        envs = self.envs
+        # Test episodes are always run on a single actor.
+        envs = self.envs[:1]
         initial_states = self.reset_envs(envs)
         if hasattr(self, "imit_network"):
             self.imit_network.reset()
         self.policy_model.reset()
         self.val_model.reset()
+        acting_policy = self.rollout_policy()
 
         # Holds information (length and true reward) about completed episodes
         completed_episode_info = []
@@ -1386,6 +1587,8 @@ class Trainer():
         states[:, 0, :] = initial_states
         last_states = states[:, 0, :]
         total_adiv = []
+        if self.SMOOTHING:
+            adiv_estimator = ADivEstimator(self.SIGMA)
         
         for t in iterator:
             # if (t+1) % 100 == 0:
@@ -1409,25 +1612,11 @@ class Trainer():
                 self.imit_network.continue_history()
                 
             if self.SMOOTHING:
-                num = self.TESTING_M
-                total_action_mean = []
-                total_action_std = []
-                for i in range(num):
-                    noised_state = maybe_attacked_last_states + ch.normal(0.0, self.SIGMA, maybe_attacked_last_states.size())
-                    action_pds = self.policy_model(noised_state)
-                    total_action_mean.append(action_pds[0])
-                    total_action_std.append(action_pds[1])
-                action_pds = (ch.median(ch.stack(total_action_mean), dim=0)[0], ch.median(ch.stack(total_action_std), dim=0)[0])
-                p1, q1 = norm.cdf(norm.ppf(0.5-0.1224)-0.1/self.SIGMA), norm.cdf(norm.ppf(0.5+0.1224)+0.1/self.SIGMA)
-                p2, q2 = norm.cdf(norm.ppf(0.5-0.1224)-0.2/self.SIGMA), norm.cdf(norm.ppf(0.5+0.1224)+0.2/self.SIGMA)
-                p3, q3 = norm.cdf(norm.ppf(0.5-0.1224)-0.3/self.SIGMA), norm.cdf(norm.ppf(0.5+0.1224)+0.3/self.SIGMA)
-                adiv1 = np.linalg.norm(np.quantile(ch.stack(total_action_mean).cpu().numpy(), q1, axis=0) - np.quantile(ch.stack(total_action_mean).cpu().numpy(), p1, axis=0))/(2 * 0.1)
-                adiv2 = np.linalg.norm(np.quantile(ch.stack(total_action_mean).cpu().numpy(), q2, axis=0) - np.quantile(ch.stack(total_action_mean).cpu().numpy(), p2, axis=0))/(2 * 0.2)
-                adiv3 = np.linalg.norm(np.quantile(ch.stack(total_action_mean).cpu().numpy(), q3, axis=0) - np.quantile(ch.stack(total_action_mean).cpu().numpy(), p3, axis=0))/(2 * 0.3)
-                adiv = (adiv1 + adiv2 + adiv3) / 3
-                total_adiv.append(adiv)
+                action_pds, mean_samples = smoothed_forward(acting_policy, maybe_attacked_last_states, self.TESTING_M, self.SIGMA, smoothing_chunk(self.params), return_samples=True)
+                # ADiv of this step, kept on the device until the end of the episode.
+                total_adiv.append(adiv_estimator(mean_samples))
             else:
-                action_pds = self.policy_model(maybe_attacked_last_states)
+                action_pds = acting_policy(maybe_attacked_last_states)
 
             if hasattr(self, "imit_network"):
                 _ = self.imit_network(maybe_attacked_last_states) 
@@ -1446,12 +1635,12 @@ class Trainer():
             # otw if continuous (# actors, 1, action dim)
             next_actions = next_actions.unsqueeze(1)
 
-            self.current_step += 1
+            self.current_step[0] += 1
             ret = self.multi_actor_step(next_actions, envs, max_len, self.current_step)
 
             # done_info = List of (length, reward) pairs for each completed trajectory
             # (next_rewards, next_states, next_dones) act like multi-actor env.step()
-            done_info, next_rewards, next_states, next_not_dones, x_velocity = ret
+            done_info, next_rewards, next_states, next_not_dones, x_velocities = ret
 
             # Reset the policy (if the policy has memory if we are done)
             if next_not_dones.item() == 0:
@@ -1479,7 +1668,7 @@ class Trainer():
             
             # If some of the actors finished AND this is not the last step
             # OR some of the actors finished AND we have no episode information
-            velocities.append(x_velocity)
+            velocities.append(x_velocities[0])
             if len(done_info) > 0:
                 steps.append(t+1)
                 completed_episode_info.extend(done_info)
@@ -1496,7 +1685,7 @@ class Trainer():
         states = states[0][:t+1]
         
         if total_adiv:
-            ep_avg_adiv = np.mean(total_adiv)
+            ep_avg_adiv = ch.cat(total_adiv).mean().item()
         else:
             ep_avg_adiv = float("nan")
 
@@ -1524,62 +1713,15 @@ class Trainer():
         - agent_params, the parameters that the agent was constructed with
         '''
 
-        ckpts = store['final_results']
-
-        get_item = lambda x: list(row[x])[0]
-
-        items = ['val_model', 'policy_model', 'val_opt', 'policy_opt']
-        names = {i: get_item(i) for i in items}
-
-        param_keys = list(store['metadata'].df.columns)
-        param_values = list(store['metadata'].df.iloc[0,:])
-
-        def process_item(v):
-            try:
-                return v.item()
-            except:
-                return v
-
-        param_values = [process_item(v) for v in param_values]
-        agent_params = {k:v for k, v in zip(param_keys, param_values)}
-
-        if 'adam_eps' not in agent_params: 
-            agent_params['adam_eps'] = 1e-5
-        if 'cpu' not in agent_params:
-            agent_params['cpu'] = cpu
-
-        # Update extra params if they do not exist in current parameters.
-        if extra_params is not None:
-            for k in extra_params.keys():
-                if k not in agent_params and k not in excluded_params:
-                    print(f'adding key {k}={extra_params[k]}')
-                    agent_params[k] = extra_params[k]
-        if override_params is not None:
-            for k in override_params.keys():
-                if k not in excluded_params and override_params[k] is not None and override_params[k] != agent_params[k]:
-                    print(f'overwriting key {k}: old={agent_params[k]}, new={override_params[k]}')
-                    agent_params[k] = override_params[k]
-
+        agent_params = agent_params_from_store(store, cpu, extra_params=extra_params,
+                override_params=override_params, excluded_params=excluded_params)
         agent = Trainer.agent_from_params(agent_params)
-
-        def load_state_dict(model, ckpt_name):
-            mapper = ch.device('cuda:0') if not cpu else ch.device('cpu')
-            state_dict = ckpts.get_state_dict(ckpt_name, map_location=mapper)
-            model.load_state_dict(state_dict)
-
-        load_state_dict(agent.policy_model, names['policy_model'])
-        load_state_dict(agent.val_model, names['val_model'])
-        if agent.ANNEAL_LR:
-            agent.POLICY_SCHEDULER.last_epoch = get_item('iteration')
-            agent.VALUE_SCHEDULER.last_epoch = get_item('iteration')
-        load_state_dict(agent.POLICY_ADAM, names['policy_opt'])
-        load_state_dict(agent.val_opt, names['val_opt'])
-        agent.envs = ckpts.get_pickle(get_item('envs'))
+        load_checkpoint(agent, store['final_results'], row, cpu)
 
         return agent, agent_params
 
     @staticmethod
-    def agent_from_params(params, store=None):
+    def agent_from_params(params, store=None, env_instances=None):
         '''
         Construct a trainer object given a dictionary of hyperparameters.
         Trainer is in charge of sampling trajectories, updating policy network,
@@ -1587,6 +1729,7 @@ class Trainer():
         Inputs:
         - params, dictionary of required hyperparameters
         - store, a cox.Store object if logging is enabled
+        - env_instances, an EnvInstancePool to take the environments from (optional)
         Outputs:
         - A Trainer object for training a PPO/TRPO agent
         '''
@@ -1603,9 +1746,10 @@ class Trainer():
         advanced_logging = params['advanced_logging'] and store is not None
         log_every = params['log_every'] if store is not None else 0
 
-        if params['cpu']:
+        if params['cpu'] and not ('cpu_cores' in params and params['cpu_cores']):
+            # Otherwise the threads are set by the resource plan of the Trainer.
             torch.set_num_threads(1)
         p = Trainer(agent_policy, agent_value, params, store, log_every=log_every,
-                    advanced_logging=advanced_logging)
+                    advanced_logging=advanced_logging, env_instances=env_instances)
 
         return p
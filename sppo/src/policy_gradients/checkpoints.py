@@ -0,0 +1,167 @@
+import torch as ch
+
+'''
+Loading agents from a cox store. agent_params_from_store and
+load_checkpoint are the two halves of Trainer.agent_from_data;
+CheckpointCatalog uses them to build one agent per store and swap the
+checkpoints of many rows into it. Checkpoints with a "normalizers" column
+(the compact statistics of Env.normalizer_state) are restored without
+unpickling the saved envs.
+'''
+
+def agent_params_from_store(store, cpu, extra_params=None, override_params=None, excluded_params=None):
+    '''
+    Reads the parameters an agent was trained with from the metadata table
+    of a store (see Trainer.agent_from_data for the arguments).
+    '''
+    param_keys = list(store['metadata'].df.columns)
+    param_values = list(store['metadata'].df.iloc[0,:])
+
+    def process_item(v):
+        try:
+            return v.item()
+        except:
+            return v
+
+    param_values = [process_item(v) for v in param_values]
+    agent_params = {k:v for k, v in zip(param_keys, param_values)}
+
+    if 'adam_eps' not in agent_params:
+        agent_params['adam_eps'] = 1e-5
+    if 'cpu' not in agent_params:
+        agent_params['cpu'] = cpu
+
+    # Update extra params if they do not exist in current parameters.
+    if extra_params is not None:
+        for k in extra_params.keys():
+            if k not in agent_params and k not in excluded_params:
+                print(f'adding key {k}={extra_params[k]}')
+                agent_params[k] = extra_params[k]
+    if override_params is not None:
+        for k in override_params.keys():
+            if k not in excluded_params and override_params[k] is not None and override_params[k] != agent_params[k]:
+                print(f'overwriting key {k}: old={agent_params[k]}, new={override_params[k]}')
+                agent_params[k] = override_params[k]
+    return agent_params
+
+
+def swap_normalizers(envs, saved_envs):
+    '''
+    Gives envs the state and reward normalizers of saved_envs (e.g. the env
+    list of a checkpoint), keeping their own gym environments and read-only
+    flags.
+    '''
+    for i, env in enumerate(envs):
+        saved = saved_envs[i % len(saved_envs)]
+        read_only = env.normalizer_read_only
+        env.state_filter = saved.state_filter
+        env.reward_filter = saved.reward_filter
+        env.normalizer_read_only = read_only
+    return envs
+
+
+def load_normalizers(envs, normalizer_states):
+    '''
+    Restores the normalizer statistics of envs in place from the compact
+    form saved in the "normalizers" column (a list of Env.normalizer_state,
+    one per saved env). Returns the state loaded into every env.
+    '''
+    states = [normalizer_states[i % len(normalizer_states)] for i in range(len(envs))]
+    for env, state in zip(envs, states):
+        env.load_normalizer_state(state)
+    return states
+
+
+def load_checkpoint(agent, table, row, cpu, load_optimizers=True, swap_envs=False):
+    '''
+    Loads the models, optimizers and environments saved in a row of a table
+    into an existing agent.
+    Inputs:
+    - agent, the Trainer to load into
+    - table, a cox table of the store (all tables share the object folder)
+    - row, a one-row dataframe of the table
+    - cpu, True/False whether to load tensors to the CPU
+    - load_optimizers, whether to load the optimizer states (not needed
+      for evaluation)
+    - swap_envs, only take the normalizer statistics of the saved envs
+      instead of replacing the agent's envs (from the "normalizers" column
+      if the table has one)
+    '''
+    get_item = lambda x: list(row[x])[0]
+    mapper = ch.device('cuda:0') if not cpu else ch.device('cpu')
+
+    def load_state_dict(model, ckpt_name):
+        state_dict = table.get_state_dict(get_item(ckpt_name), map_location=mapper)
+        model.load_state_dict(state_dict)
+
+    load_state_dict(agent.policy_model, 'policy_model')
+    agent.policy_updated()
+    load_state_dict(agent.val_model, 'val_model')
+    if agent.ANNEAL_LR:
+        agent.POLICY_SCHEDULER.last_epoch = get_item('iteration')
+        agent.VALUE_SCHEDULER.last_epoch = get_item('iteration')
+    if load_optimizers:
+        load_state_dict(agent.POLICY_ADAM, 'policy_opt')
+        load_state_dict(agent.val_opt, 'val_opt')
+    if swap_envs and 'normalizers' in row.columns:
+        states = load_normalizers(agent.envs, table.get_pickle(get_item('normalizers')))
+        if agent.env_pool is not None:
+            agent.env_pool.load_normalizer_states(states)
+        return
+    saved_envs = table.get_pickle(get_item('envs'))
+    if swap_envs:
+        agent.envs = swap_normalizers(agent.envs, saved_envs)
+    else:
+        agent.envs = saved_envs
+
+
+class CheckpointCatalog:
+    '''
+    All checkpoints (rows) of a table of one store, loaded into a single
+    agent. The metadata is read and the agent (models, optimizers and
+    environments) is built once, on first use; load(row_id) then only reads
+    the weights and normalizer statistics of that row. Optimizer states are
+    skipped unless requested. With env_instances (an EnvInstancePool), the
+    environments are taken from and given back to the pool (on close).
+    '''
+    def __init__(self, trainer_class, store, cpu, table='checkpoints',
+                 extra_params=None, override_params=None, excluded_params=None, env_instances=None):
+        self.trainer_class = trainer_class
+        self.env_instances = env_instances
+        self.store = store
+        self.cpu = cpu
+        self.table = store[table]
+        self.df = self.table.df
+        self.params = agent_params_from_store(store, cpu, extra_params=extra_params,
+                override_params=override_params, excluded_params=excluded_params)
+        self.row_id = None
+        self._agent = None
+
+    def __len__(self):
+        return len(self.df)
+
+    @property
+    def agent(self):
+        '''
+        The agent skeleton, with the weights of the last loaded row.
+        '''
+        if self._agent is None:
+            self._agent = self.trainer_class.agent_from_params(self.params, env_instances=self.env_instances)
+        return self._agent
+
+    def row(self, row_id):
+        return self.df.iloc[row_id:row_id+1]
+
+    def load(self, row_id, load_optimizers=False):
+        '''
+        Swaps the checkpoint of row row_id into the agent and returns it.
+        '''
+        load_checkpoint(self.agent, self.table, self.row(row_id), self.cpu,
+                        load_optimizers=load_optimizers, swap_envs=True)
+        self.row_id = row_id
+        return self.agent
+
+    def close(self):
+        if self._agent is not None and self._agent.env_instances is not None:
+            self._agent.env_instances.release(self._agent.envs)
+        self.store.close()
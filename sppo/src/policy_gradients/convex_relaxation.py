@@ -1,6 +1,9 @@
 import random, sys, time, multiprocessing
 from auto_LiRPA import BoundedModule, BoundedTensor, BoundedParameter
 from auto_LiRPA.perturbations import *
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
 
 from policy_gradients.models import activation_with_name
 
@@ -131,6 +134,139 @@ else:
         # iub = cub
         return iub, cub
 
+def _linear_relaxation(activation, lb, ub):
+    '''
+    Linear bounds slope * z + lower <= activation(z) <= slope * z + upper
+    for z in [lb, ub], elementwise. Both bounds use the slope of the chord;
+    the intercepts are the extremes of activation(z) - slope * z on the
+    interval, which are attained at the end points or where the derivative
+    of the activation equals the slope.
+    '''
+    width = ub - lb
+    tiny = width < 1e-6
+    if isinstance(activation, nn.Tanh):
+        f = torch.tanh
+        slope = torch.where(tiny, 1 - torch.tanh(lb) ** 2, (f(ub) - f(lb)) / width.clamp(min=1e-6))
+        # tanh'(z) = slope at z = +/- atanh(sqrt(1 - slope)).
+        a = torch.atanh(torch.sqrt((1 - slope).clamp(min=1e-12, max=1 - 1e-7)))
+        candidates = [lb, ub, torch.max(torch.min(a, ub), lb), torch.max(torch.min(-a, ub), lb)]
+    elif isinstance(activation, nn.ReLU):
+        f = torch.relu
+        slope = torch.where(tiny, (lb > 0).to(lb.dtype), (f(ub) - f(lb)) / width.clamp(min=1e-6))
+        # The kink of ReLU.
+        candidates = [lb, ub, torch.max(torch.min(torch.zeros_like(lb), ub), lb)]
+    else:
+        raise ValueError(f"Native bounds do not support activation {activation}")
+    offsets = torch.stack([f(c) - slope * c for c in candidates])
+    return slope, offsets.min(dim=0)[0], offsets.max(dim=0)[0]
+
+
+class NativeRelaxedCtsPolicy:
+    '''
+    Bounds of the action means of a CtsPolicy (Linear layers with tanh or
+    ReLU activations) under an L_inf perturbation of the states, computed
+    directly on the weights of the policy with batched matrix products,
+    without tracing the model with auto_LiRPA. Both IBP and CROWN (backward
+    linear relaxation, also for the intermediate layers) bounds are
+    differentiable with respect to the weights, for the robustness
+    regularizer.
+    '''
+    def __init__(self, policy_model):
+        assert not policy_model.time_in_state, "time_in_state is not supported"
+        assert not policy_model.use_merged_bias, "use_merged_bias is not supported"
+        self.policy_model = policy_model
+        self.activation = policy_model.activation
+
+    def layers(self):
+        return list(self.policy_model.affine_layers) + [self.policy_model.final_mean]
+
+    def ibp(self, x, eps):
+        center, radius = x, torch.full_like(x, eps)
+        layers = self.layers()
+        for i, layer in enumerate(layers):
+            center = F.linear(center, layer.weight, layer.bias)
+            radius = F.linear(radius, layer.weight.abs())
+            if i == len(layers) - 1:
+                break
+            # Activations are monotonic.
+            lb = self.activation(center - radius)
+            ub = self.activation(center + radius)
+            center, radius = (ub + lb) / 2, (ub - lb) / 2
+        return center - radius, center + radius
+
+    def crown(self, x, eps):
+        # Relaxations (slope, lower intercept, upper intercept) of the activations so far.
+        relaxations = []
+        layers = self.layers()
+        for i, layer in enumerate(layers):
+            lb, ub = self._backward(x, eps, layers[:i+1], relaxations)
+            if i < len(layers) - 1:
+                relaxations.append(_linear_relaxation(self.activation, lb, ub))
+        return lb, ub
+
+    def _backward(self, x, eps, layers, relaxations):
+        '''
+        Bounds of the output of the last of layers, propagating its linear
+        function back to the input through the relaxed activations.
+        '''
+        # A: (batch, outputs, inputs of the current layer)
+        A = layers[-1].weight.unsqueeze(0).expand(x.size(0), -1, -1)
+        const = layers[-1].bias.unsqueeze(0) if layers[-1].bias is not None else 0.0
+        const_lb = const_ub = const
+        for layer, (slope, lower, upper) in zip(reversed(layers[:-1]), reversed(relaxations)):
+            pos, neg = A.clamp(min=0), A.clamp(max=0)
+            const_ub = const_ub + (pos @ upper.unsqueeze(-1) + neg @ lower.unsqueeze(-1)).squeeze(-1)
+            const_lb = const_lb + (pos @ lower.unsqueeze(-1) + neg @ upper.unsqueeze(-1)).squeeze(-1)
+            A = A * slope.unsqueeze(1)
+            if layer.bias is not None:
+                bias = A @ layer.bias
+                const_ub = const_ub + bias
+                const_lb = const_lb + bias
+            A = A @ layer.weight
+        center = (A @ x.unsqueeze(-1)).squeeze(-1)
+        radius = eps * A.abs().sum(dim=-1)
+        return center - radius + const_lb, center + radius + const_ub
+
+    def compute_bounds(self, x, eps, method="IBP"):
+        if method == "IBP":
+            return self.ibp(x, eps)
+        elif method == "backward":
+            return self.crown(x, eps)
+        raise ValueError(f"Unknown bound method {method}")
+
+
+def get_kl_bound_native(model, x, means, eps, beta=None, stdev=None, use_full_backward=False):
+    '''
+    Same as get_kl_bound, for a NativeRelaxedCtsPolicy.
+    '''
+    x = x.detach()
+    if use_full_backward:
+        # Full backward method, tightest bound.
+        ilb, iub = model.compute_bounds(x, eps, method="backward")
+        # Fake beta, avoid backward below.
+        beta = 1.0
+    else:
+        # IBP Pass.
+        ilb, iub = model.compute_bounds(x, eps, method="IBP")
+    if beta is None or (1 - beta) > 1e-20:
+        # CROWN Pass.
+        clb, cub = model.compute_bounds(x, eps, method="backward")
+    if beta is None:
+        # Bound final output neuron.
+        ikl = intermediate_to_kl(ilb, iub, means, stdev=stdev)
+        ckl = intermediate_to_kl(clb, cub, means, stdev=stdev)
+        return ikl, ckl
+    else:
+        # Beta schedule is from 0 to 1.
+        if 1 - beta < 1e-20:
+            lb = ilb
+            ub = iub
+        else:
+            lb = beta * ilb + (1 - beta) * clb
+            ub = beta * iub + (1 - beta) * cub
+        kl = intermediate_to_kl(lb, ub, means, stdev=stdev)
+        return kl
+
 class RelaxedCtsPolicyForState_stdv(nn.Module):
     def __init__(self, state_dim=11, action_dim=3, init=None, hidden_sizes=[64, 64],
                  time_in_state=False, share_weights=False, activation='tanh', policy_model=None):
@@ -1,11 +1,10 @@
-import os
 import numpy as np
-from PIL import Image
 from gym.spaces.discrete import Discrete
 from gym.spaces.box import Box as Continuous
-import gym
 import random
-from .torch_utils import RunningStat, ZFilter, Identity, StateWithTime, RewardFilter
+from .torch_utils import RunningStat, ZFilter, Identity, StateWithTime, RewardFilter, FusedStateFilter
+from .frame_recorder import FrameRecorder
+from .synthetic_env import make_env
 
 class Env:
     '''
@@ -18,10 +17,13 @@ class Env:
     - Size of feature space
     - Size of action space
     Provides the same API (init, step, reset) as the OpenAI gym
+    game is a gym id or one of the synthetic environments (see synthetic_env.py)
+    The state filter chain is applied as one fused call (see filter_state);
+    step and reset can write the state into a given output array.
     '''
     def __init__(self, game, norm_states, norm_rewards, params, add_t_with_horizon=None, clip_obs=None, clip_rew=None, 
             show_env=False, save_frames=False, save_frames_path=""):
-        self.env = gym.make(game)
+        self.env = make_env(game)
         clip_obs = None if clip_obs < 0 else clip_obs
         clip_rew = None if clip_rew < 0 else clip_rew
 
@@ -60,19 +62,49 @@ class Env:
         # Set normalizers to read-write mode by default.
         self._read_only = False
 
-        self.setup_visualization(show_env, save_frames, save_frames_path)
+        frame_options = {k: params[k] for k in ['save_frames_stride', 'save_frames_downscale', 'save_frames_format'] if k in params}
+        self.setup_visualization(show_env, save_frames, save_frames_path, **frame_options)
 
     # For environments that are created from a picked object.
-    def setup_visualization(self, show_env, save_frames, save_frames_path):
+    def setup_visualization(self, show_env, save_frames, save_frames_path,
+                            save_frames_stride=None, save_frames_downscale=None, save_frames_format=None):
+        '''
+        Frames are saved by a FrameRecorder, every save_frames_stride steps
+        (default 1), subsampled by save_frames_downscale (default 1), as
+        save_frames_format ("npz" chunks by default, or "png").
+        '''
         self.save_frames = save_frames
         self.show_env = show_env
         self.save_frames_path = save_frames_path
         self.episode_counter = 0
-        self.frame_counter = 0
+        if getattr(self, 'frame_recorder', None) is not None:
+            self.frame_recorder.close()
+        self.frame_recorder = None
         if self.save_frames:
             print(f'We will save frames to {self.save_frames_path}!')
-            os.makedirs(os.path.join(self.save_frames_path, "000"), exist_ok=True)
+            self.frame_recorder = FrameRecorder(self.save_frames_path, stride=save_frames_stride or 1,
+                                                downscale=save_frames_downscale or 1,
+                                                frame_format=save_frames_format or 'npz')
     
+    def __getstate__(self):
+        # The fused state filter is rebuilt from state_filter after unpickling,
+        # so pickled envs keep the same contents as before it existed.
+        state = self.__dict__.copy()
+        state.pop('_fused_state_filter', None)
+        # The recorder owns a writer thread; setup_visualization creates a new one.
+        state['frame_recorder'] = None
+        return state
+
+    def filter_state(self, state, reset=False, out=None):
+        '''
+        Applies the state filter chain, fused into one call. It is rebuilt
+        whenever state_filter is replaced (e.g. by swap_normalizers).
+        '''
+        fused = getattr(self, '_fused_state_filter', None)
+        if fused is None or fused.source is not self.state_filter:
+            fused = self._fused_state_filter = FusedStateFilter(self.state_filter)
+        return fused(state, reset=reset, out=out)
+
     @property
     def normalizer_read_only(self):
         return self._read_only
@@ -80,19 +112,35 @@ class Env:
     @normalizer_read_only.setter
     def normalizer_read_only(self, value):
         self._read_only = bool(value)
-        if isinstance(self.state_filter, ZFilter):
-            if not hasattr(self.state_filter, 'read_only') and value:
-                print('Warning: requested to set state_filter.read_only=True but the underlying ZFilter does not support it.')
-            elif hasattr(self.state_filter, 'read_only'):
-                self.state_filter.read_only = self._read_only
-        if isinstance(self.reward_filter, ZFilter) or isinstance(self.reward_filter, RewardFilter):
-            if not hasattr(self.reward_filter, 'read_only') and value:
-                print('Warning: requested to set reward_filter.read_only=True but the underlying ZFilter does not support it.')
-            elif hasattr(self.reward_filter, 'read_only'):
-                self.reward_filter.read_only = self._read_only
-    
+        # Every normalizing stage of the chains, including the ones wrapped by
+        # other filters (e.g. the ZFilter inside StateWithTime).
+        for name in ['state_filter', 'reward_filter']:
+            f = getattr(self, name)
+            while f is not None:
+                if isinstance(f, (ZFilter, RewardFilter)):
+                    f.read_only = self._read_only
+                f = getattr(f, 'prev_filter', None)
+
+    def normalizer_state(self):
+        '''
+        Compact form of the normalizer statistics: the RunningStat states of
+        the ZFilter/RewardFilter stages of the state and reward filter chains
+        (no gym state, unlike pickling the Env).
+        '''
+        return {name: [rs.state_dict() for rs in _running_stats(getattr(self, name))]
+                for name in ['state_filter', 'reward_filter']}
 
-    def reset(self):
+    def load_normalizer_state(self, state):
+        '''
+        Restores the statistics saved by normalizer_state, in place.
+        '''
+        for name in ['state_filter', 'reward_filter']:
+            stats = _running_stats(getattr(self, name))
+            assert len(stats) == len(state[name]), f'{name} does not match the saved normalizer state'
+            for rs, saved in zip(stats, state[name]):
+                rs.load_state_dict(saved)
+
+    def reset(self, state_out=None):
         # Set a deterministic random seed for reproduicability
         self.env.seed(random.getrandbits(31))
         # Reset the state, and the running total reward
@@ -100,26 +148,22 @@ class Env:
         self.total_true_reward = 0.0
         self.counter = 0.0
         self.episode_counter += 1
-        if self.save_frames:
-            os.makedirs(os.path.join(self.save_frames_path, f"{self.episode_counter:03d}"), exist_ok=True)
-            self.frame_counter = 0
+        if getattr(self, 'frame_recorder', None) is not None:
+            self.frame_recorder.start_episode(self.episode_counter)
         self.state_filter.reset()
         self.reward_filter.reset()
-        return self.state_filter(start_state, reset=True)
+        return self.filter_state(start_state, reset=True, out=state_out)
 
-    def step(self, action):
+    def step(self, action, state_out=None):
         state, reward, is_done, info = self.env.step(action)
         #oprint(info)
         if self.show_env:
             self.env.render()
-        # Frameskip (every 6 frames, will be rendered at 25 fps)
-        if self.save_frames and int(self.counter) % 1 == 0:
-            image = self.env.render(mode='rgb_array')
-            path = os.path.join(self.save_frames_path, f"{self.episode_counter:03d}", f"{self.frame_counter+1:04d}.bmp")
-            image = Image.fromarray(image)
-            image.save(path)
-            self.frame_counter += 1
-        state = self.state_filter(state)
+        # Frameskip (only every stride-th frame is rendered and queued to the recorder)
+        recorder = getattr(self, 'frame_recorder', None)
+        if recorder is not None and int(self.counter) % recorder.stride == 0:
+            recorder.add(self.env.render(mode='rgb_array'))
+        state = self.filter_state(state, out=state_out)
         self.total_true_reward += reward
         self.counter += 1
         _reward = self.reward_filter(reward)
@@ -127,3 +171,46 @@ class Env:
             info['done'] = (self.counter, self.total_true_reward)
         return state, _reward, self.counter, self.total_true_reward, is_done, info
 
+
+
+def _running_stats(f):
+    '''
+    The RunningStats of a filter chain, from the outermost filter inwards.
+    '''
+    stats = []
+    while f is not None:
+        if hasattr(f, 'rs'):
+            stats.append(f.rs)
+        f = getattr(f, 'prev_filter', None)
+    return stats
+
+
+class EnvInstancePool:
+    '''
+    Constructed Envs kept alive for reuse by later agents (e.g. the agents
+    of the models evaluated one after another by test.py), so that the
+    simulators are not built again. Envs are keyed by their construction
+    arguments; an agent takes them with acquire and gives them back with
+    release. A reused Env keeps the normalizer statistics of its previous
+    user until they are restored (see Env.load_normalizer_state).
+    '''
+    def __init__(self):
+        self.free = {}
+        self.keys = {}
+
+    def acquire(self, key, constructor, n):
+        '''
+        Returns n Envs for key, calling constructor() for the missing ones.
+        '''
+        free = self.free.setdefault(key, [])
+        envs = [free.pop() for _ in range(min(n, len(free)))]
+        envs += [constructor() for _ in range(n - len(envs))]
+        for env in envs:
+            self.keys[id(env)] = key
+        return envs
+
+    def release(self, envs):
+        for env in envs:
+            key = self.keys.pop(id(env), None)
+            if key is not None:
+                self.free[key].append(env)
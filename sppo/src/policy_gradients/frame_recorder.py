@@ -0,0 +1,121 @@
+import os
+import atexit
+import queue
+import threading
+import numpy as np
+from PIL import Image
+
+'''
+Recording of rendered environment frames without stalling the rollout.
+Frames are pushed into a bounded queue and written by a background thread,
+either as compressed .npz chunks of an episode or as a PNG sequence. When
+the writer falls behind and the queue is full, frames are dropped instead
+of blocking the environment step or reset. Every queued frame carries its
+episode and its index in the episode, so that the files a frame goes to do
+not depend on which frames were dropped.
+'''
+
+FRAME_FORMATS = ['npz', 'png']
+
+
+class FrameRecorder:
+    '''
+    Inputs:
+    - path, output folder; episode i is written to path/iii/
+    - stride, record every stride-th step of an episode
+    - downscale, integer factor by which frames are subsampled in both
+      dimensions
+    - frame_format, "npz" for compressed .npz chunks, chunk c holding the
+      recorded frames c*chunk_size...(c+1)*chunk_size-1 of the episode
+      (array "frames" of shape (frames, height, width, 3) and their indices
+      "indices"), or "png" for one PNG file per frame, numbered from 1
+    - queue_size, maximum number of frames waiting to be written
+    - chunk_size, frames per .npz chunk
+    '''
+    def __init__(self, path, stride=1, downscale=1, frame_format='npz', queue_size=256, chunk_size=500):
+        assert frame_format in FRAME_FORMATS, f'unknown frame format {frame_format}'
+        self.path = path
+        self.stride = max(1, int(stride))
+        self.downscale = max(1, int(downscale))
+        self.frame_format = frame_format
+        self.chunk_size = chunk_size
+        self.dropped = 0
+        self.queue_size = queue_size
+        self.thread = None
+        self.episode, self.frame_index = 0, 0
+        os.makedirs(os.path.join(self.path, '000'), exist_ok=True)
+        # Write the queued frames before the interpreter exits.
+        atexit.register(self.close)
+
+    def _start(self):
+        # The writer is started on first use, and again in a forked process
+        # (e.g. an env worker), which does not inherit the thread.
+        if self.thread is None or self.pid != os.getpid():
+            self.pid = os.getpid()
+            self.queue = queue.Queue(maxsize=self.queue_size)
+            self.thread = threading.Thread(target=self._write_frames, daemon=True)
+            self.thread.start()
+
+    def start_episode(self, episode):
+        '''
+        Following frames belong to episode number episode.
+        '''
+        self.episode, self.frame_index = episode, 0
+
+    def add(self, frame):
+        '''
+        Queues an (height, width, 3) frame, or drops it if the queue is full.
+        '''
+        self._start()
+        if self.downscale > 1:
+            frame = frame[::self.downscale, ::self.downscale]
+        index, self.frame_index = self.frame_index, self.frame_index + 1
+        try:
+            self.queue.put_nowait((self.episode, index, np.ascontiguousarray(frame)))
+        except queue.Full:
+            self.dropped += 1
+
+    def close(self):
+        '''
+        Writes the remaining frames and stops the writer thread.
+        '''
+        # Releases the recorder (with its queue and thread) once it is replaced.
+        atexit.unregister(self.close)
+        if self.thread is None or self.pid != os.getpid() or not self.thread.is_alive():
+            return
+        self.queue.put(None)
+        self.thread.join()
+        if self.dropped:
+            print(f'Frame recorder dropped {self.dropped} frames of {self.path}')
+
+    def _write_frames(self):
+        # Frames of the npz chunk (episode, chunk) being collected.
+        episode, chunk, frames, indices = None, None, [], []
+        folder_episode = None
+
+        def flush():
+            nonlocal frames, indices
+            if frames:
+                np.savez_compressed(os.path.join(self.path, f'{episode:03d}', f'{chunk:04d}.npz'),
+                                    frames=np.stack(frames), indices=np.array(indices))
+                frames, indices = [], []
+
+        while True:
+            item = self.queue.get()
+            if item is None:
+                flush()
+                return
+            frame_episode, index, frame = item
+            if frame_episode != folder_episode:
+                folder_episode = frame_episode
+                os.makedirs(os.path.join(self.path, f'{folder_episode:03d}'), exist_ok=True)
+            if self.frame_format == 'png':
+                Image.fromarray(frame).save(os.path.join(self.path, f'{frame_episode:03d}', f'{index + 1:04d}.png'))
+                continue
+            if (frame_episode, index // self.chunk_size) != (episode, chunk):
+                flush()
+                episode, chunk = frame_episode, index // self.chunk_size
+            frames.append(frame)
+            indices.append(index)
+            if index % self.chunk_size == self.chunk_size - 1:
+                flush()
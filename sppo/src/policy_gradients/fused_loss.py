@@ -0,0 +1,56 @@
+import math
+import torch as ch
+from .models import CtsPolicy
+
+'''
+Fused clipped PPO loss of a Gaussian policy with a state independent
+standard deviation (the CtsPolicy family). The log likelihoods, the ratio,
+the advantage normalization, the clipping and the entropy bonus are
+computed by one function, compiled with TorchScript when possible, instead
+of get_loglikelihood, two calls of surrogate_reward and entropies.
+'''
+
+def _gaussian_ppo_loss(means, log_stdev, actions, old_log_ps, advs,
+                       clip_eps: float, entropy_coeff: float):
+    '''
+    Inputs:
+    - means, (B, action_dim) action means of the current policy
+    - log_stdev, (action_dim,) log standard deviations of the current policy
+    - actions, (B, action_dim) actions sampled at rollout time
+    - old_log_ps, (B,) log probabilities of the actions at rollout time
+    - advs, (B,) unnormalized advantages (normalized here, as surrogate_reward)
+    - clip_eps, the clipping boundary of the ratio
+    - entropy_coeff, coefficient of the entropy bonus
+    Returns:
+    - loss, surrogate + entropy term
+    - surrogate, minus the mean of the min of the clipped and unclipped rewards
+    - entropy bonus (the same for every state)
+    '''
+    d = actions.size(-1)
+    log_norm = 0.5 * math.log(2.0 * math.pi) * d
+    new_log_ps = -(0.5 * ((actions - means) / ch.exp(log_stdev)).pow(2).sum(-1)
+                   + log_norm + log_stdev.sum())
+    if advs.numel() > 1:
+        advs = (advs - advs.mean()) / (advs.std() + 1e-8)
+    ratio = ch.exp(new_log_ps - old_log_ps)
+    surrogate = -ch.min(ratio * advs, ch.clamp(ratio, 1 - clip_eps, 1 + clip_eps) * advs).mean()
+    entropy = log_stdev.sum() + 0.5 * d * (1.0 + math.log(2.0 * math.pi))
+    return surrogate - entropy_coeff * entropy, surrogate, entropy
+
+
+try:
+    fused_gaussian_ppo_loss = ch.jit.script(_gaussian_ppo_loss)
+except Exception as e:
+    print(f'Cannot compile the fused PPO loss with TorchScript ({e}), using the Python version')
+    fused_gaussian_ppo_loss = _gaussian_ppo_loss
+
+
+def use_fused_ppo_loss(net, params):
+    '''
+    Whether the fused loss applies: it is enabled, the policy is memoryless
+    and has the log likelihood and entropy of CtsPolicy.
+    '''
+    return ("fused_ppo_loss" in params and params["fused_ppo_loss"]
+            and params.HISTORY_LENGTH < 1
+            and type(net).get_loglikelihood is CtsPolicy.get_loglikelihood
+            and type(net).entropies is CtsPolicy.entropies)
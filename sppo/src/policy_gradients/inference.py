@@ -0,0 +1,137 @@
+import copy
+import time
+import torch as ch
+import torch.nn as nn
+from .models import CtsPolicy
+
+'''
+Inference-only views of a CtsPolicy for rollouts and evaluation on CPU.
+The mean network is exported from the trained module at a given precision
+(float32, bfloat16, or dynamically quantized int8 linear layers) and frozen
+with TorchScript, which fuses the linear layers with their activations.
+The float32 training copy is never modified.
+Exporting takes tens of milliseconds, so the view is only re-exported when
+the weights have changed (see InferencePolicy.refresh). The speed of the
+precisions depends on the CPU and the batch size: at the batch sizes of
+acting (one state per actor), the gain mostly comes from freezing, and
+bfloat16 and int8 are only faster on CPUs with native kernels for them
+(on CPUs without, they were measured slower than float32 eager for
+batches of 8 or more states). fastest_precision measures them at a given
+batch size.
+'''
+
+PRECISIONS = ['float32', 'bfloat16', 'int8']
+
+
+def export_mean_network(policy_model, precision):
+    '''
+    Copies the mean network of policy_model into a frozen nn.Sequential at
+    the given precision (run eagerly if it cannot be frozen).
+    '''
+    layers = []
+    for affine in policy_model.affine_layers:
+        layers += [copy.deepcopy(affine), copy.deepcopy(policy_model.activation)]
+    layers.append(copy.deepcopy(policy_model.final_mean))
+    network = nn.Sequential(*layers).eval()
+    network.requires_grad_(False)
+    if precision == 'bfloat16':
+        network = network.to(ch.bfloat16)
+    elif precision == 'int8':
+        network = ch.ao.quantization.quantize_dynamic(network, {nn.Linear}, dtype=ch.qint8)
+    try:
+        with ch.no_grad():
+            return ch.jit.optimize_for_inference(ch.jit.freeze(ch.jit.script(network)))
+    except Exception as e:
+        print(f'Cannot freeze the {precision} inference policy ({e}), running it eagerly')
+        return network
+
+
+def benchmark_precisions(policy_model, batch_size, repeats=200):
+    '''
+    Mean time (in seconds) of computing the action means of batch_size
+    states with policy_model itself ("none") and with its inference view at
+    every precision.
+    '''
+    states = ch.randn(batch_size, policy_model.affine_layers[0].in_features)
+    candidates = {'none': policy_model}
+    for precision in PRECISIONS:
+        candidates[precision] = InferencePolicy(policy_model, precision)
+    timings = {}
+    with ch.no_grad():
+        for name, policy in candidates.items():
+            for _ in range(10):
+                policy(states)
+            start = time.perf_counter()
+            for _ in range(repeats):
+                policy(states)
+            timings[name] = (time.perf_counter() - start) / repeats
+    return timings
+
+
+def fastest_precision(policy_model, batch_size):
+    '''
+    The fastest of "none" (no inference view) and PRECISIONS for acting on
+    batches of batch_size states, see benchmark_precisions.
+    '''
+    timings = benchmark_precisions(policy_model, batch_size)
+    print('Inference precision timings at batch size {}: {}'.format(
+        batch_size, ', '.join(f'{k}={v * 1e6:.1f}us' for k, v in timings.items())))
+    return min(timings, key=timings.get)
+
+
+class InferencePolicy:
+    '''
+    Acts like policy_model (a CtsPolicy) for sampling actions, but computes
+    the action means with a low precision export of its mean network. The
+    standard deviations, sampling and log likelihoods are those of the
+    float32 policy. Call refresh() after the weights of policy_model change.
+    '''
+    def __init__(self, policy_model, precision, version=0):
+        assert precision in PRECISIONS, f'unknown inference precision {precision}'
+        self.policy_model = policy_model
+        self.precision = precision
+        self.dtype = ch.bfloat16 if precision == 'bfloat16' else ch.float32
+        self.version = None
+        self.refresh(version)
+
+    @staticmethod
+    def supports(policy_model, params):
+        '''
+        Whether policy_model can be exported: a memoryless CtsPolicy MLP on CPU.
+        '''
+        return (params.CPU and params.HISTORY_LENGTH < 1
+                and type(policy_model).forward is CtsPolicy.forward
+                and not policy_model.use_merged_bias)
+
+    def refresh(self, version=None):
+        '''
+        Exports the current weights, unless the view was already exported at
+        the given version of the weights (e.g. Trainer.policy_version).
+        '''
+        if version is not None and version == self.version:
+            return
+        self.mean_network = export_mean_network(self.policy_model, self.precision)
+        self.version = version
+
+    def __call__(self, x):
+        if self.policy_model.time_in_state:
+            x = x[:,:-1]
+        with ch.no_grad():
+            means = self.mean_network(x.to(self.dtype)).float()
+        return means, ch.exp(self.policy_model.log_stdev).detach()
+
+    def __getattr__(self, name):
+        # sample, get_loglikelihood, reset, pause_history, ... of the float32 policy.
+        if name == 'policy_model':
+            raise AttributeError(name)
+        return getattr(self.policy_model, name)
+
+    def deviation(self, states):
+        '''
+        Maximum and mean absolute deviation of the action means from the
+        float32 policy on a reference batch of states.
+        '''
+        with ch.no_grad():
+            reference = self.policy_model(states)[0]
+            deviation = (self(states)[0] - reference).abs()
+        return deviation.max().item(), deviation.mean().item()
@@ -0,0 +1,97 @@
+import torch as ch
+
+'''
+Projected (sign) gradient ascent over input states, shared by the SGLD KL
+bound of SA-PPO and the PGD-style state attacks. Only the gradient with
+respect to the states is computed (torch.autograd.grad on the inputs), so
+no gradients are accumulated into the network parameters and they never
+have to be cleared. Noise and clipping bounds are allocated once and the
+update and projection are done in place.
+'''
+
+def pgd_maximize(objective, states, eps, step_eps, steps, start="uniform",
+                 noise_factor=0.0, restarts=1, init=None):
+    '''
+    Maximizes objective over the L_inf ball of radius eps around states with
+    steps sign gradient steps of size step_eps.
+    Inputs:
+    - objective, function mapping a (K, ...) batch of states to K per-state
+      objective values; the gradient of their sum is used
+    - states, (B, ...) center states
+    - eps, radius of the L_inf ball
+    - step_eps, size of each step
+    - steps, number of steps
+    - start, "uniform" for a uniform random start in [-step_eps, step_eps],
+      "sign" for a random sign step of size step_eps (SGLD)
+    - noise_factor, if > 0, Gaussian noise with standard deviation
+      noise_factor / (i + 2) is added to the gradient of step i (SGLD)
+    - restarts, number of random starts per state. All starts are optimized
+      as one (restarts * B, ...) batch and the one with the largest final
+      objective is returned.
+    - init, optional (B, ...) states to start from instead of a random start
+      (e.g. the result of a previous run, see PerturbationCache); they are
+      projected into the ball first
+    Returns:
+    - (B, ...) perturbed states (detached)
+    '''
+    states = states.detach()
+    batch_shape = (restarts,) + tuple(states.shape)
+    lb = states - eps
+    ub = states + eps
+    x = ch.empty(batch_shape, dtype=states.dtype, device=states.device)
+    noise = ch.empty_like(x)
+    if init is not None:
+        x.copy_(init.detach().expand(batch_shape))
+        ch.max(x, lb, out=x)
+        ch.min(x, ub, out=x)
+    elif start == "uniform":
+        x.uniform_(-step_eps, step_eps).add_(states)
+    elif start == "sign":
+        x.normal_().sign_().mul_(step_eps).add_(states)
+    else:
+        raise ValueError(f"Unknown start {start}")
+    flat_x = x.view(-1, *states.shape[1:])
+    with ch.enable_grad():
+        for i in range(steps):
+            var_x = flat_x.detach().requires_grad_()
+            grad, = ch.autograd.grad(objective(var_x).sum(), var_x)
+            grad = grad.view(batch_shape)
+            if noise_factor > 0:
+                # Reduce noise at every step.
+                grad.add_(noise.normal_(), alpha=noise_factor / (i + 2))
+            # Step to the sign of the (noisy) gradient and project back into the ball.
+            x.add_(grad.sign_(), alpha=step_eps)
+            ch.max(x, lb, out=x)
+            ch.min(x, ub, out=x)
+    if restarts == 1:
+        return x[0]
+    with ch.no_grad():
+        values = objective(flat_x).view(restarts, -1)
+    best = values.argmax(dim=0)
+    return x[best, ch.arange(states.shape[0], device=states.device)]
+
+
+class PerturbationCache:
+    '''
+    The last adversarial perturbation found for every sample of a rollout,
+    indexed by the position of the sample in the (unrolled) rollout. Later
+    PPO epochs revisit the same states, so they can warm-start from these
+    perturbations and converge in a few steps. A new cache is created for
+    every rollout.
+    '''
+    def __init__(self, states):
+        self.perturbations = ch.zeros_like(states)
+        self.valid = ch.zeros(states.shape[0], dtype=ch.bool, device=states.device)
+
+    def ready(self, indices):
+        '''
+        Whether a perturbation is stored for all the given samples.
+        '''
+        return bool(self.valid[indices].all())
+
+    def get(self, indices):
+        return self.perturbations[indices]
+
+    def put(self, indices, perturbations):
+        self.perturbations[indices] = perturbations.detach()
+        self.valid[indices] = True
@@ -0,0 +1,97 @@
+import os
+import contextlib
+import torch
+
+'''
+CPU resource planning for packing several training runs (run.py processes)
+on one node. Every run gets a budget of cores: the process and its env
+workers are pinned to them, and the number of intra-op threads of the
+learner is switched between the rollout phase (single-step forward
+passes, one thread) and the optimization phase (the whole budget, since
+the env workers are idle then).
+'''
+
+def available_cores():
+    '''
+    Cores this process may run on.
+    '''
+    if hasattr(os, 'sched_getaffinity'):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count()))
+
+
+class ResourcePlan:
+    '''
+    Threads and core affinities of one run.
+    Inputs:
+    - cores_per_run, core budget of the run
+    - slot, index of the run on the node: run i is pinned to the cores
+      [i * cores_per_run, (i + 1) * cores_per_run) of the available cores
+      (wrapping around if the node is oversubscribed). -1 to not pin.
+    - num_env_workers, number of env worker processes (see SubprocEnvPool)
+    - overlap_phases, whether rollouts are collected while the learner
+      optimizes (pipeline_lag). The thread count is then fixed, leaving
+      cores to the rollouts.
+    '''
+    def __init__(self, cores_per_run, slot=-1, num_env_workers=0, overlap_phases=False):
+        cores = available_cores()
+        self.cores_per_run = max(1, min(int(cores_per_run), len(cores)))
+        self.cores = None
+        if slot >= 0:
+            start = slot * self.cores_per_run
+            self.cores = [cores[(start + i) % len(cores)] for i in range(self.cores_per_run)]
+        self.num_env_workers = num_env_workers
+        self.overlap_phases = overlap_phases
+        self.threads = {
+            'rollout': 1,
+            'optimization': self.cores_per_run,
+        }
+        if overlap_phases:
+            rollout_cores = max(1, num_env_workers)
+            self.threads['optimization'] = max(1, self.cores_per_run - rollout_cores)
+            self.threads['rollout'] = self.threads['optimization']
+
+    def worker_cores(self):
+        '''
+        Core of every env worker, or None if the run is not pinned. The first
+        core of the run is left to the learner when the budget allows it.
+        '''
+        if self.cores is None or not self.num_env_workers:
+            return None
+        pool = self.cores[1:] if len(self.cores) > 1 else self.cores
+        return [pool[i % len(pool)] for i in range(self.num_env_workers)]
+
+    def apply(self):
+        '''
+        Pins the process and sets the torch thread counts. Must be called
+        before the env workers are started, which inherit the affinity.
+        '''
+        try:
+            # One inter-op thread; ops are parallelized by the intra-op threads.
+            torch.set_num_interop_threads(1)
+        except RuntimeError:
+            # Can only be set before any inter-op parallel work has started.
+            pass
+        if self.cores is not None and hasattr(os, 'sched_setaffinity'):
+            os.sched_setaffinity(0, self.cores)
+        torch.set_num_threads(self.threads['rollout'])
+        print(f'CPU plan: cores={self.cores if self.cores is not None else "any"} ({self.cores_per_run}), '
+              f'rollout threads={self.threads["rollout"]}, optimization threads={self.threads["optimization"]}, '
+              f'env worker cores={self.worker_cores()}')
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        '''
+        Runs the body with the intra-op threads of phase name ("rollout" or
+        "optimization"), restoring the previous count afterwards.
+        '''
+        threads = self.threads[name]
+        previous = torch.get_num_threads()
+        if threads == previous:
+            yield
+            return
+        torch.set_num_threads(threads)
+        try:
+            yield
+        finally:
+            torch.set_num_threads(previous)
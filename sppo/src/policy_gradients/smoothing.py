@@ -0,0 +1,99 @@
+import torch as ch
+from scipy.stats import norm
+
+'''
+Randomized smoothing of the policy. The M noisy copies of a batch of
+states are stacked into one (M*B, obs_dim) batch and evaluated with a
+single forward pass, and the action distribution is reduced with one
+median over the noise dimension.
+'''
+
+def smoothing_chunk(params):
+    '''
+    Number of noise draws evaluated per forward pass (0 means all of them).
+    Recurrent policies update their hidden state on every call, so they are
+    still evaluated one draw at a time.
+    '''
+    if params.HISTORY_LENGTH > 0:
+        return 1
+    if "smoothing_chunk" in params and params["smoothing_chunk"]:
+        return params["smoothing_chunk"]
+    return 0
+
+
+def smoothed_forward(net, states, num_samples, sigma, chunk=0, return_samples=False):
+    '''
+    Median of the action distributions of net over num_samples Gaussian
+    perturbations of states.
+    Inputs:
+    - net, policy network returning (action means, action stds)
+    - states, (B, obs_dim) batch of states
+    - num_samples, number of noise draws M
+    - sigma, standard deviation of the noise
+    - chunk, maximum number of draws per forward pass, to cap memory (0: all M)
+    - return_samples, also return the action means of every draw
+    Returns:
+    - (action means, action stds), medians over the M draws
+    - (only if return_samples) (M, B, action_dim) action means of the draws
+    '''
+    batch_size = states.shape[0]
+    chunk = num_samples if chunk <= 0 else min(chunk, num_samples)
+    all_means, all_stds = [], []
+    for start in range(0, num_samples, chunk):
+        m = min(chunk, num_samples - start)
+        noise = ch.normal(0.0, sigma, (m,) + tuple(states.shape), device=states.device)
+        noised_states = (states.unsqueeze(0) + noise).view(m * batch_size, *states.shape[1:])
+        means, stds = net(noised_states)
+        all_means.append(means.view(m, batch_size, *means.shape[1:]))
+        all_stds.append(stds.view(m, batch_size, *stds.shape[1:]) if stds.dim() == means.dim() else stds)
+    all_means = all_means[0] if len(all_means) == 1 else ch.cat(all_means)
+    if all_stds[0].dim() == all_means.dim():
+        all_stds = all_stds[0] if len(all_stds) == 1 else ch.cat(all_stds)
+        stds = ch.median(all_stds, dim=0)[0]
+    else:
+        # State independent stds (e.g. CtsPolicy) are the same for every draw,
+        # so their median is the std itself.
+        stds = all_stds[0]
+    pds = (ch.median(all_means, dim=0)[0], stds)
+    if return_samples:
+        return pds, all_means
+    return pds
+
+
+class ADivEstimator:
+    '''
+    Action divergence (ADiv) of a smoothed policy from the action means of
+    its noise draws. For every radius eps, the spread between the p_eps and
+    q_eps quantiles of the draws, with
+    p_eps = Phi(Phi^-1(0.5 - margin) - eps / sigma) and
+    q_eps = Phi(Phi^-1(0.5 + margin) + eps / sigma),
+    is normed over the action dimensions and divided by 2 eps. ADiv is the
+    mean over the radii. The quantile levels depend only on sigma and are
+    computed once; all quantiles are taken in a single torch.quantile call.
+    '''
+    def __init__(self, sigma, radii=(0.1, 0.2, 0.3), margin=0.1224):
+        self.sigma = sigma
+        levels = []
+        for eps in radii:
+            levels.append(norm.cdf(norm.ppf(0.5 - margin) - eps / sigma))
+            levels.append(norm.cdf(norm.ppf(0.5 + margin) + eps / sigma))
+        # Levels are ordered (p_1, q_1, p_2, q_2, ...).
+        self.levels = ch.tensor(levels, dtype=ch.float32)
+        self.radii = ch.tensor(radii, dtype=ch.float32)
+
+    def __call__(self, mean_samples):
+        '''
+        Inputs:
+        - mean_samples, (M, ..., action_dim) action means of M noise draws,
+          e.g. (M, 1, action_dim) for one step or (M, T, action_dim) for a
+          recorded episode
+        Returns:
+        - ADiv of every state, shape (...), as a tensor on the input device
+        '''
+        levels = self.levels.to(mean_samples.device, mean_samples.dtype)
+        radii = self.radii.to(mean_samples.device, mean_samples.dtype)
+        # (2 * num radii, ..., action_dim), same linear interpolation as np.quantile.
+        quantiles = ch.quantile(mean_samples, levels, dim=0)
+        spreads = (quantiles[1::2] - quantiles[0::2]).norm(dim=-1)
+        radii = radii.view(-1, *([1] * (spreads.dim() - 1)))
+        return (spreads / (2 * radii)).mean(dim=0)
@@ -9,6 +9,10 @@ from tqdm import tqdm
 from torch.nn.utils import parameters_to_vector as flatten
 from torch.nn.utils import vector_to_parameters as assign
 from .torch_utils import *
+from .smoothing import smoothed_forward, smoothing_chunk
+from .pgd import pgd_maximize, PerturbationCache
+from .models import CtsPolicy
+from .fused_loss import fused_gaussian_ppo_loss, use_fused_ppo_loss
 import matplotlib as mpl
 mpl.use('Agg')  # No display
 import matplotlib.pyplot as plt
@@ -48,7 +52,7 @@ def adv_normalize(adv, mask=None):
     n_advs = (adv - mean)/(std + 1e-8)
     return n_advs
 
-def surrogate_reward(adv, *, new, old, clip_eps=None, mask=None, normalize=True):
+def surrogate_reward(adv, *, new, old, clip_eps=None, mask=None, normalize=True, weights=None):
     '''
     Computes the surrogate reward for TRPO and PPO:
     R(\theta) = E[r_t * A_t]
@@ -59,6 +63,8 @@ def surrogate_reward(adv, *, new, old, clip_eps=None, mask=None, normalize=True)
     - log_ps_new, the log probabilities assigned to taken events by \theta_{new}
     - log_ps_old, the log probabilities assigned to taken events by \theta_{old}
     - clip_EPS, the clipping boundary for PPO loss
+    - weights, optional per sample weights (see behavior_weights), applied
+      after the advantage normalization
     Returns:
     - The surrogate loss as described above
     '''
@@ -78,8 +84,27 @@ def surrogate_reward(adv, *, new, old, clip_eps=None, mask=None, normalize=True)
     # Clamping (for use with PPO)
     if clip_eps is not None:
         ratio_new_old = ch.clamp(ratio_new_old, 1-clip_eps, 1+clip_eps)
+    if weights is not None:
+        return ratio_new_old * n_advs * weights
     return ratio_new_old * n_advs
 
+
+def behavior_weights(old_log_ps, behavior_log_ps, params):
+    '''
+    Truncated importance weights min(pi_old / pi_behavior, c) of actions
+    sampled by an older behavior policy (pipelined rollouts), with
+    c = params.PIPELINE_WEIGHT_CLIP (default 1). As in decoupled PPO
+    (https://arxiv.org/abs/2110.00641), the ratio is clipped around the
+    proximal policy old_log_ps, and every sample is weighted by these
+    weights to correct for the behavior policy.
+    Returns None without a behavior policy.
+    '''
+    if behavior_log_ps is None:
+        return None
+    # Stores saved before the weights existed have no clip parameter.
+    clip = params["pipeline_weight_clip"] if "pipeline_weight_clip" in params else 1.0
+    return ch.exp(old_log_ps - behavior_log_ps).clamp(max=clip)
+
 ######
 # Possible Loss Functions for the value network
 # Supports consistency loss, time-dependent baseline, OpenAI loss
@@ -199,14 +224,12 @@ def value_step(all_states, returns, advantages, not_dones, net,
     # last value was here. If we are sharing weights, this is handled in policy_step
     with ch.no_grad():
         if old_vs is None:
-            state_indices = np.arange(returns.nelement())
-            # No shuffling, just split an sequential list of indices.
-            splits = np.array_split(state_indices, params.NUM_MINIBATCHES)
+            # No shuffling, just split the states in order.
             orig_vs = []
             # Minibatch.
-            for selected in splits:
+            for _, (batch_states,) in MinibatchLoader(all_states, num_minibatches=params.NUM_MINIBATCHES, shuffle=False):
                 # Values of current network prediction.
-                orig_vs.append(net(all_states[selected]).squeeze(-1))
+                orig_vs.append(net(batch_states).squeeze(-1))
             orig_vs = ch.cat(orig_vs)
             old_vs = orig_vs.detach()
         if test_saps is not None:
@@ -229,6 +252,11 @@ def value_step(all_states, returns, advantages, not_dones, net,
         # LSTM policy. Need to go over all episodes instead of states.
         batches, alive_masks, time_masks, lengths = pack_history([all_states, returns, not_dones, advantages, old_vs], not_dones, max_length=params.HISTORY_LENGTH)
         assert not params.SHARE_WEIGHTS
+    else:
+        # The states are permuted once per epoch and split into minibatches.
+        assert shape_equal_cmp(returns, advantages, not_dones, old_vs)
+        loader = MinibatchLoader(returns, advantages, not_dones, old_vs, all_states,
+                                 num_minibatches=params.NUM_MINIBATCHES)
 
     for i in r:
         if params.HISTORY_LENGTH > 0 and params.USE_LSTM_VAL:
@@ -275,25 +303,14 @@ def value_step(all_states, returns, advantages, not_dones, net,
             val_loss.backward()
             val_opt.step()
         else:
-            # Create minibatches with shuffuling
-            state_indices = np.arange(returns.nelement())
-            np.random.shuffle(state_indices)
-            splits = np.array_split(state_indices, params.NUM_MINIBATCHES)
-
-            assert shape_equal_cmp(returns, advantages, not_dones, old_vs)
-
             # Minibatch SGD
-            for selected in splits:
+            for _, tup in loader:
                 val_opt.zero_grad()
 
-                def sel(*args):
-                    return [v[selected] for v in args]
-
                 def to_cuda(*args):
                     return [v.cuda() for v in args]
 
                 # Get a minibatch (64) of returns, advantages, etc.
-                tup = sel(returns, advantages, not_dones, old_vs, all_states)
                 mask = ch.tensor(True)
 
                 if should_cuda: tup = to_cuda(*tup)
@@ -389,7 +406,7 @@ def pack_history(features, not_dones, max_length):
 
 
 def ppo_step(all_states, actions, old_log_ps, rewards, returns, not_dones, 
-                advs, net, params, store, opt_step):
+                advs, net, params, store, opt_step, behavior_log_ps=None):
     '''
     Proximal Policy Optimization
     Runs K epochs of PPO as in https://arxiv.org/abs/1707.06347
@@ -400,6 +417,9 @@ def ppo_step(all_states, actions, old_log_ps, rewards, returns, not_dones,
     - advs, advantages as estimated by GAE
     - net, policy network to train [WILL BE MUTATED]
     - params, additional placeholder for parameters like EPS
+    - behavior_log_ps, the log probability of the actions under the policy
+      that sampled them, if it is older than old_log_ps (memoryless
+      policies only, see behavior_weights)
     Returns:
     - The PPO loss; main job is to mutate the net
     '''
@@ -426,7 +446,14 @@ def ppo_step(all_states, actions, old_log_ps, rewards, returns, not_dones,
         # We normalize all advantages at once instead of batch by batch, since each batch may contain different number of samples.
         normalized_advs = adv_normalize(advs)
         batches, alive_masks, time_masks, lengths = pack_history([all_states, actions, old_log_ps, normalized_advs], not_dones, max_length=params.HISTORY_LENGTH)
+    else:
+        # Memoryless policy. The rollout is permuted once per epoch and split into minibatches.
+        weights = behavior_weights(old_log_ps, behavior_log_ps, params)
+        extra = [] if weights is None else [weights]
+        loader = MinibatchLoader(all_states, actions, old_log_ps, advs, *extra, num_minibatches=params.NUM_MINIBATCHES)
 
+    # The fused loss has no per sample weights.
+    fused_loss = use_fused_ppo_loss(net, params) and behavior_log_ps is None
     for _ in range(params.PPO_EPOCHS):
         if params.HISTORY_LENGTH > 0:
             if params.SMOOTHING:
@@ -499,74 +526,60 @@ def ppo_step(all_states, actions, old_log_ps, rewards, returns, not_dones,
         else:
             # Memoryless policy.
             # State is in shape (experience_size, observation_size). Usually 2048.
-            state_indices = np.arange(all_states.shape[0])
-            np.random.shuffle(state_indices)
             # We use a minibatch of states to do optimization, and each epoch contains several iterations.
-            splits = np.array_split(state_indices, params.NUM_MINIBATCHES)
             # A typical mini-batch size is 2048/32=64
-            for selected in splits:
-                def sel(*args, offset=0):
-                    if offset == 0:
-                        return [v[selected] for v in args]
-                    else:
-                        offset_selected = selected + offset
-                        return [v[offset_selected] for v in args]
-
+            for selected, batch in loader:
                 # old_log_ps: log probabilities of actions sampled based in experience buffer.
                 # advs: advantages of these states.
                 # both old_log_ps and advs are in shape (experience_size,) = 2048.
                 # Using memoryless policy.
-                tup = sel(all_states, actions, old_log_ps, advs)
                 # select log probabilities, advantages of this minibatch.
-                batch_states, batch_actions, batch_old_log_ps, batch_advs = tup
+                batch_states, batch_actions, batch_old_log_ps, batch_advs = batch[:4]
+                batch_weights = batch[4] if weights is not None else None
                 # print(batch_actions.size())
                 # print(batch_advs.size())
 
                 # Forward propagation on current parameters (being constantly updated), to get distribution of these states
                 # dist contains mean and variance of Gaussian.
                 if params.SMOOTHING:
-                    num = params.TRAINING_M
-                    total_action_mean = []
-                    total_action_std = []
-                    for i in range(num):
-                        noised_states = batch_states + ch.normal(0.0, params.SIGMA, batch_states.size())
-                        action_pds = net(noised_states)
-                        total_action_mean.append(action_pds[0])
-                        total_action_std.append(action_pds[1])
-                    dist = (ch.median(ch.stack(total_action_mean), dim=0)[0],
-                            ch.median(ch.stack(total_action_std), dim=0)[0])
+                    dist = smoothed_forward(net, batch_states, params.TRAINING_M, params.SIGMA, smoothing_chunk(params))
                 else:
                     dist = net(batch_states)
-                # print('dist', dist[0].size())
-                # print('batch_actions', batch_actions.size())
-                # Convert state distribution to log likelyhood.
-                new_log_ps = net.get_loglikelihood(dist, batch_actions)
-                # print('new_log_ps', new_log_ps.size())
-                # print('old_log_ps', batch_old_log_ps.size())
-
-                shape_equal_cmp(new_log_ps, batch_old_log_ps)
-
-                # Calculate rewards
-                # the surrogate rewards is basically exp(new_log_ps - old_log_ps) * advantage
-                # dimension is the same as minibatch size.
-                unclp_rew = surrogate_reward(batch_advs, new=new_log_ps, old=batch_old_log_ps)
-                clp_rew = surrogate_reward(batch_advs, new=new_log_ps, old=batch_old_log_ps,
-                                           clip_eps=params.CLIP_EPS)
-
-                # Calculate entropy bonus
-                # So far, the entropy only depends on std and does not depend on time. No need to mask.
-                entropy_bonus = net.entropies(dist).mean()
-
-                # Total loss, is the min of clipped and unclipped reward for each state, averaged.
-                surrogate = (-ch.min(unclp_rew, clp_rew)).mean()
-                entropy = -params.ENTROPY_COEFF * entropy_bonus
-                loss = surrogate + entropy
+                if fused_loss:
+                    # Log likelihoods, clipped surrogate and entropy bonus in one fused function.
+                    loss, surrogate, entropy_bonus = fused_gaussian_ppo_loss(dist[0], net.log_stdev, batch_actions,
+                            batch_old_log_ps, batch_advs, params.CLIP_EPS, params.ENTROPY_COEFF)
+                    entropy = -params.ENTROPY_COEFF * entropy_bonus
+                else:
+                    # print('dist', dist[0].size())
+                    # print('batch_actions', batch_actions.size())
+                    # Convert state distribution to log likelyhood.
+                    new_log_ps = net.get_loglikelihood(dist, batch_actions)
+                    # print('new_log_ps', new_log_ps.size())
+                    # print('old_log_ps', batch_old_log_ps.size())
+
+                    shape_equal_cmp(new_log_ps, batch_old_log_ps)
+
+                    # Calculate rewards
+                    # the surrogate rewards is basically exp(new_log_ps - old_log_ps) * advantage
+                    # dimension is the same as minibatch size.
+                    unclp_rew = surrogate_reward(batch_advs, new=new_log_ps, old=batch_old_log_ps, weights=batch_weights)
+                    clp_rew = surrogate_reward(batch_advs, new=new_log_ps, old=batch_old_log_ps,
+                                               clip_eps=params.CLIP_EPS, weights=batch_weights)
+
+                    # Calculate entropy bonus
+                    # So far, the entropy only depends on std and does not depend on time. No need to mask.
+                    entropy_bonus = net.entropies(dist).mean()
+
+                    # Total loss, is the min of clipped and unclipped reward for each state, averaged.
+                    surrogate = (-ch.min(unclp_rew, clp_rew)).mean()
+                    entropy = -params.ENTROPY_COEFF * entropy_bonus
+                    loss = surrogate + entropy
                 
                 # If we are sharing weights, take the value step simultaneously 
                 # (since the policy and value networks depend on the same weights)
                 if params.SHARE_WEIGHTS:
-                    tup = sel(returns, not_dones, old_vs)
-                    batch_returns, batch_not_dones, batch_old_vs = tup
+                    batch_returns, batch_not_dones, batch_old_vs = [v[selected] for v in (returns, not_dones, old_vs)]
                     val_loss = value_step(batch_states, batch_returns, batch_advs,
                                           batch_not_dones, net.get_value, None, params,
                                           store, old_vs=batch_old_vs, opt_step=opt_step)
@@ -597,8 +610,9 @@ def ppo_step(all_states, actions, old_log_ps, rewards, returns, not_dones,
     return loss.item(), surrogate.item(), entropy.item()
 
 
-"""Computing an estimated upper bound of KL divergence using SGLD."""
-def get_state_kl_bound_sgld(net, batch_states, batch_action_means, eps, steps, stdev, not_dones=None):
+"""Computing an estimated upper bound of KL divergence using SGLD, optionally warm-started from init_states."""
+def get_state_kl_bound_sgld(net, batch_states, batch_action_means, eps, steps, stdev, not_dones=None,
+                            init_states=None, step_eps=None, return_states=False):
     if not_dones is not None:
         # If we have not_dones, the underlying network is a LSTM.
         wrapped_net = functools.partial(net, not_dones=not_dones)
@@ -610,32 +624,21 @@ def get_state_kl_bound_sgld(net, batch_states, batch_action_means, eps, steps, s
             batch_action_means, _ = wrapped_net(batch_states)
     else:
         batch_action_means = batch_action_means.detach()
-    # upper and lower bounds for clipping
-    states_ub = batch_states + eps
-    states_lb = batch_states - eps
-    step_eps = eps / steps
+    batch_size = batch_states.shape[0]
+    def kl(states):
+        # Find a nearby state new_phi that maximize the difference
+        diff = (wrapped_net(states)[0] - batch_action_means) / stdev.detach()
+        return (diff * diff).sum(axis=-1) / batch_size
+    if step_eps is None:
+        step_eps = eps / steps
     # SGLD noise factor. We set (inverse) beta=1e-5 as gradients are relatively small here.
     beta = 1e-5
     noise_factor = np.sqrt(2 * step_eps * beta)
-    noise = ch.randn_like(batch_states) * noise_factor
-    var_states = (batch_states.clone() + noise.sign() * step_eps).detach().requires_grad_()
-    for i in range(steps):
-        # Find a nearby state new_phi that maximize the difference
-        diff = (wrapped_net(var_states)[0] - batch_action_means) / stdev.detach()
-        kl = (diff * diff).sum(axis=-1, keepdim=True).mean()
-        # Need to clear gradients before the backward() for policy_loss
-        kl.backward()
-        # Reduce noise at every step.
-        noise_factor = np.sqrt(2 * step_eps * beta) / (i+2)
-        # Project noisy gradient to step boundary.
-        update = (var_states.grad + noise_factor * ch.randn_like(var_states)).sign() * step_eps
-        var_states.data += update
-        # clip into the upper and lower bounds
-        var_states = ch.max(var_states, states_lb)
-        var_states = ch.min(var_states, states_ub)
-        var_states = var_states.detach().requires_grad_()
-    net.zero_grad()
-    diff = (wrapped_net(var_states.requires_grad_(False))[0] - batch_action_means) / stdev
+    var_states = pgd_maximize(kl, batch_states, eps, step_eps, steps, start="sign",
+                              noise_factor=noise_factor, init=init_states)
+    diff = (wrapped_net(var_states)[0] - batch_action_means) / stdev
+    if return_states:
+        return (diff * diff).sum(axis=-1, keepdim=True), var_states
     return (diff * diff).sum(axis=-1, keepdim=True)
 
 """Computing an estimated upper bound of KL divergence for policy std dependent on state."""
@@ -821,6 +824,9 @@ def radial_ppo_step(all_states, actions, old_log_ps, rewards, returns, not_dones
         # We normalize all advantages at once instead of batch by batch, since each batch may contain different number of samples.
         normalized_advs = adv_normalize(advs)
         batches, alive_masks, time_masks, lengths = pack_history([all_states, actions, old_log_ps, normalized_advs], not_dones, max_length=params.HISTORY_LENGTH)
+    else:
+        # Memoryless policy. The rollout is permuted once per epoch and split into minibatches.
+        loader = MinibatchLoader(all_states, actions, old_log_ps, advs, num_minibatches=params.NUM_MINIBATCHES)
 
 
     for _ in range(params.PPO_EPOCHS):
@@ -909,35 +915,19 @@ def radial_ppo_step(all_states, actions, old_log_ps, rewards, returns, not_dones
         else:
             # Memoryless policy.
             # State is in shape (experience_size, observation_size). Usually 2048.
-            state_indices = np.arange(all_states.shape[0])
-            np.random.shuffle(state_indices)
             # We use a minibatch of states to do optimization, and each epoch contains several iterations.
-            splits = np.array_split(state_indices, params.NUM_MINIBATCHES)
             # A typical mini-batch size is 2048/32=64
-            for selected in splits:
-                def sel(*args):
-                    return [v[selected] for v in args]
-
+            for selected, batch in loader:
                 # old_log_ps: log probabilities of actions sampled based in experience buffer.
                 # advs: advantages of these states.
                 # both old_log_ps and advs are in shape (experience_size,) = 2048.
-                tup = sel(all_states, actions, old_log_ps, advs)
                 # select log probabilities, advantages of this minibatch.
-                batch_states, batch_actions, batch_old_log_ps, batch_advs = tup
+                batch_states, batch_actions, batch_old_log_ps, batch_advs = batch
 
                 # Forward propagation on current parameters (being constantly updated), to get distribution of these states
                 # dist contains mean and variance of Gaussian.
                 if params.SMOOTHING:
-                    num = params.TRAINING_M
-                    total_action_mean = []
-                    total_action_std = []
-                    for i in range(num):
-                        noised_states = batch_states + ch.normal(0.0, params.SIGMA, batch_states.size())
-                        action_pds = net(noised_states)
-                        total_action_mean.append(action_pds[0])
-                        total_action_std.append(action_pds[1])
-                    dist = (ch.median(ch.stack(total_action_mean), dim=0)[0],
-                            ch.median(ch.stack(total_action_std), dim=0)[0])
+                    dist = smoothed_forward(net, batch_states, params.TRAINING_M, params.SIGMA, smoothing_chunk(params))
                 else:
                     dist = net(batch_states)
                 mean, std = dist
@@ -1022,8 +1012,7 @@ def radial_ppo_step(all_states, actions, old_log_ps, rewards, returns, not_dones
                 # If we are sharing weights, take the value step simultaneously 
                 # (since the policy and value networks depend on the same weights)
                 if params.SHARE_WEIGHTS:
-                    tup = sel(returns, not_dones, old_vs)
-                    batch_returns, batch_not_dones, batch_old_vs = tup
+                    batch_returns, batch_not_dones, batch_old_vs = [v[selected] for v in (returns, not_dones, old_vs)]
                     val_loss = value_step(batch_states, batch_returns, batch_advs,
                                           batch_not_dones, net.get_value, None, params,
                                           store, old_vs=batch_old_vs, opt_step=opt_step)
@@ -1119,8 +1108,38 @@ def get_mean_bound(model, x, means, eps, beta=None, stdev=None, use_full_backwar
         ilb, iub = model.compute_bounds(inputs, IBP=True, C=None, method=None, bound_lower=True, bound_upper=True)
         return iub, ilb
 
+"""Choosing the states the robustness regularizer is evaluated on, under a bound budget."""
+def sample_bound_states(num_states, budget, scores=None, device=None):
+    '''
+    Inputs:
+    - num_states, number of states B in the minibatch
+    - budget, fraction (if < 1) or number (if >= 1) of states to evaluate
+    - scores, optional (B,) per-state scores (e.g. the last KL bound of each
+      state, NaN if unknown). States are then sampled with replacement, with
+      probabilities proportional to a half-half mixture of the scores and
+      the uniform distribution. Without scores, they are sampled uniformly
+      without replacement.
+    Returns:
+    - indices of the sampled states
+    - importance weights, such that (bound[indices] * weights).mean() is an
+      unbiased estimate of bound.mean() over the minibatch
+    '''
+    count = int(round(budget * num_states)) if budget < 1 else int(budget)
+    count = max(1, min(num_states, count))
+    if scores is None:
+        indices = ch.randperm(num_states, device=device)[:count]
+        return indices, ch.ones(count, device=device)
+    known = ~ch.isnan(scores)
+    # Unknown scores get the mean of the known ones (all equal if none are known).
+    fill = ch.nansum(scores) / known.sum().clamp(min=1)
+    scores = ch.where(known, scores, fill) + 1e-12
+    probs = 0.5 * scores / scores.sum() + 0.5 / num_states
+    indices = ch.multinomial(probs, count, replacement=True)
+    return indices, 1.0 / (num_states * probs[indices])
+
 def robust_ppo_step(all_states, actions, old_log_ps, rewards, returns, not_dones, 
-                advs, net, params, store, opt_step, relaxed_net, eps_scheduler, beta_scheduler):
+                advs, net, params, store, opt_step, relaxed_net, eps_scheduler, beta_scheduler,
+                behavior_log_ps=None):
     '''
     Proximal Policy Optimization with robustness regularizer
     Runs K epochs of PPO as in https://arxiv.org/abs/1707.06347
@@ -1131,6 +1150,9 @@ def robust_ppo_step(all_states, actions, old_log_ps, rewards, returns, not_dones
     - advs, advantages as estimated by GAE
     - net, policy network to train [WILL BE MUTATED]
     - params, additional placeholder for parameters like EPS
+    - behavior_log_ps, the log probability of the actions under the policy
+      that sampled them, if it is older than old_log_ps (memoryless
+      policies only, see behavior_weights)
     Returns:
     - The PPO loss; main job is to mutate the net
     '''
@@ -1155,8 +1177,39 @@ def robust_ppo_step(all_states, actions, old_log_ps, rewards, returns, not_dones
         # We normalize all advantages at once instead of batch by batch, since each batch may contain different number of samples.
         normalized_advs = adv_normalize(advs)
         batches, alive_masks, time_masks, lengths = pack_history([all_states, actions, old_log_ps, normalized_advs], not_dones, max_length=params.HISTORY_LENGTH)
-
-
+    else:
+        # Memoryless policy. The rollout is permuted once per epoch and split into minibatches.
+        weights = behavior_weights(old_log_ps, behavior_log_ps, params)
+        extra = [] if weights is None else [weights]
+        loader = MinibatchLoader(all_states, actions, old_log_ps, advs, *extra, num_minibatches=params.NUM_MINIBATCHES)
+
+    # Warm-started SGLD: the first epoch runs the full schedule and stores the perturbation of every
+    # state; later epochs start from it and only take sgld_warm_steps steps.
+    sgld_cache = None
+    if params.ROBUST_PPO_METHOD == "sgld" and params.HISTORY_LENGTH < 1 and \
+            "sgld_warm_steps" in params and params["sgld_warm_steps"]:
+        sgld_cache = PerturbationCache(all_states)
+    sgld_steps = params.ROBUST_PPO_PGD_STEPS
+
+    # Bound budget: evaluate the regularizer on a sample of the states of each minibatch only.
+    bound_budget = 0
+    if params.HISTORY_LENGTH < 1 and "robust_ppo_bound_budget" in params and params["robust_ppo_bound_budget"]:
+        bound_budget = params["robust_ppo_bound_budget"]
+    bound_sampling = params["robust_ppo_bound_sampling"] if "robust_ppo_bound_sampling" in params else "uniform"
+    if bound_sampling not in ["uniform", "kl"]:
+        raise ValueError("unknown bound sampling " + str(bound_sampling))
+    # Last KL bound of every state of the rollout (NaN if not evaluated yet), for weighted sampling.
+    kl_scores = None
+    if bound_budget and bound_sampling == "kl":
+        kl_scores = ch.full((all_states.size(0),), float("nan"), device=all_states.device)
+    kl_estimate_var = ch.tensor(0.0)
+    sgld_warm_kl, sgld_cold_kl = None, None
+    # (warm, cold) bounds of the last epoch that compared them.
+    sgld_logged_kls = (np.nan, np.nan)
+
+
+    # The fused loss has no per sample weights.
+    fused_loss = use_fused_ppo_loss(net, params) and behavior_log_ps is None
     for _ in range(params.PPO_EPOCHS):
         if params.HISTORY_LENGTH > 0:
             if params.SMOOTHING:
@@ -1244,51 +1297,41 @@ def robust_ppo_step(all_states, actions, old_log_ps, rewards, returns, not_dones
         else:
             # Memoryless policy.
             # State is in shape (experience_size, observation_size). Usually 2048.
-            state_indices = np.arange(all_states.shape[0])
-            np.random.shuffle(state_indices)
             # We use a minibatch of states to do optimization, and each epoch contains several iterations.
-            splits = np.array_split(state_indices, params.NUM_MINIBATCHES)
             # A typical mini-batch size is 2048/32=64
-            for selected in splits:
-                def sel(*args):
-                    return [v[selected] for v in args]
-
+            for selected, batch in loader:
                 # old_log_ps: log probabilities of actions sampled based in experience buffer.
                 # advs: advantages of these states.
                 # both old_log_ps and advs are in shape (experience_size,) = 2048.
-                tup = sel(all_states, actions, old_log_ps, advs)
                 # select log probabilities, advantages of this minibatch.
-                batch_states, batch_actions, batch_old_log_ps, batch_advs = tup
+                batch_states, batch_actions, batch_old_log_ps, batch_advs = batch[:4]
+                batch_weights = batch[4] if weights is not None else None
 
                 # Forward propagation on current parameters (being constantly updated), to get distribution of these states
                 # dist contains mean and variance of Gaussian.
                 if params.SMOOTHING:
-                    num = params.TRAINING_M
-                    total_action_mean = []
-                    total_action_std = []
-                    for i in range(num):
-                        noised_states = batch_states + ch.normal(0.0, params.SIGMA, batch_states.size())
-                        action_pds = net(noised_states)
-                        total_action_mean.append(action_pds[0])
-                        total_action_std.append(action_pds[1])
-                    dist = (ch.median(ch.stack(total_action_mean), dim=0)[0],
-                            ch.median(ch.stack(total_action_std), dim=0)[0])
+                    dist = smoothed_forward(net, batch_states, params.TRAINING_M, params.SIGMA, smoothing_chunk(params))
                 else:
                     dist = net(batch_states)
-                # Convert state distribution to log likelyhood.
-                new_log_ps = net.get_loglikelihood(dist, batch_actions)
+                if fused_loss:
+                    # Log likelihoods, clipped surrogate and entropy bonus in one fused function.
+                    loss, surrogate, entropy_bonus = fused_gaussian_ppo_loss(dist[0], net.log_stdev, batch_actions,
+                            batch_old_log_ps, batch_advs, params.CLIP_EPS, params.ENTROPY_COEFF)
+                else:
+                    # Convert state distribution to log likelyhood.
+                    new_log_ps = net.get_loglikelihood(dist, batch_actions)
 
-                shape_equal_cmp(new_log_ps, batch_old_log_ps)
+                    shape_equal_cmp(new_log_ps, batch_old_log_ps)
 
-                # Calculate rewards
-                # the surrogate rewards is basically exp(new_log_ps - old_log_ps) * advantage
-                # dimension is the same as minibatch size.
-                unclp_rew = surrogate_reward(batch_advs, new=new_log_ps, old=batch_old_log_ps)
-                clp_rew = surrogate_reward(batch_advs, new=new_log_ps, old=batch_old_log_ps,
-                                           clip_eps=params.CLIP_EPS)
+                    # Calculate rewards
+                    # the surrogate rewards is basically exp(new_log_ps - old_log_ps) * advantage
+                    # dimension is the same as minibatch size.
+                    unclp_rew = surrogate_reward(batch_advs, new=new_log_ps, old=batch_old_log_ps, weights=batch_weights)
+                    clp_rew = surrogate_reward(batch_advs, new=new_log_ps, old=batch_old_log_ps,
+                                               clip_eps=params.CLIP_EPS, weights=batch_weights)
 
-                # Calculate entropy bonus
-                entropy_bonus = net.entropies(dist).mean()
+                    # Calculate entropy bonus
+                    entropy_bonus = net.entropies(dist).mean()
 
                 # Calculate regularizer under state perturbation.
                 eps_scheduler.step_batch()
@@ -1301,35 +1344,79 @@ def robust_ppo_step(all_states, actions, old_log_ps, rewards, returns, not_dones
                 if params.ROBUST_PPO_DETACH_STDEV:
                     # Detach stdev so that it won't be too large.
                     stdev = stdev.detach()
+                # Evaluate the regularizer on all states, or on a sample of them under a bound budget.
+                if bound_budget:
+                    bound_idx, bound_weights = sample_bound_states(batch_states.size(0), bound_budget,
+                            scores=kl_scores[selected] if kl_scores is not None else None, device=batch_states.device)
+                    bound_selected = selected[bound_idx]
+                    bound_states, bound_action_means = batch_states[bound_idx], batch_action_means[bound_idx]
+                else:
+                    bound_selected, bound_states, bound_action_means = selected, batch_states, batch_action_means
                 if params.ROBUST_PPO_METHOD in ["convex-relax"]:
-                    kl_upper_bound = get_state_kl_bound(relaxed_net, batch_states, batch_action_means,
+                    kl_upper_bound = get_state_kl_bound(relaxed_net, bound_states, bound_action_means,
                             eps=current_eps, beta=beta_scheduler.get_eps(),
-                            stdev=stdev).mean()
+                            stdev=stdev)
+                elif params.ROBUST_PPO_METHOD == "sgld" and sgld_cache is not None:
+                    warm = sgld_cache.ready(bound_selected)
+                    sgld_steps = params["sgld_warm_steps"] if warm else params.ROBUST_PPO_PGD_STEPS
+                    # Warm starts keep the step size of the full schedule.
+                    kl_upper_bound, adv_states = get_state_kl_bound_sgld(net, bound_states, bound_action_means,
+                            eps=current_eps, steps=sgld_steps, stdev=stdev,
+                            init_states=bound_states + sgld_cache.get(bound_selected) if warm else None,
+                            step_eps=current_eps / params.ROBUST_PPO_PGD_STEPS, return_states=True)
+                    sgld_cache.put(bound_selected, adv_states - bound_states)
+                    if warm and sgld_warm_kl is None:
+                        # Once per epoch, compare with a cold start of the full schedule on the same minibatch.
+                        sgld_warm_kl = kl_upper_bound.mean().item()
+                        sgld_cold_kl = get_state_kl_bound_sgld(net, bound_states, bound_action_means.detach(),
+                                eps=current_eps, steps=params.ROBUST_PPO_PGD_STEPS, stdev=stdev.detach()).mean().item()
                 elif params.ROBUST_PPO_METHOD == "sgld":
-                    kl_upper_bound = get_state_kl_bound_sgld(net, batch_states, batch_action_means,
+                    kl_upper_bound = get_state_kl_bound_sgld(net, bound_states, bound_action_means,
                             eps=current_eps, steps=params.ROBUST_PPO_PGD_STEPS,
-                            stdev=stdev).mean()
+                            stdev=stdev)
+                elif params.ROBUST_PPO_METHOD == "native-convex-relax":
+                    kl_upper_bound = get_kl_bound_native(relaxed_net, bound_states, bound_action_means,
+                            eps=current_eps, beta=beta_scheduler.get_eps(),
+                            stdev=stdev)
+                elif params.ROBUST_PPO_METHOD == "native-ibp":
+                    # IBP only, as get_state_kl_bound_ibp.
+                    kl_upper_bound = get_kl_bound_native(relaxed_net, bound_states, bound_action_means,
+                            eps=current_eps, beta=1.0, stdev=stdev)
                 elif params.ROBUST_PPO_METHOD == "ibp":
-                    kl_upper_bound = get_state_kl_bound_ibp(relaxed_net, batch_states, batch_action_means,
+                    kl_upper_bound = get_state_kl_bound_ibp(relaxed_net, bound_states, bound_action_means,
                             eps=current_eps, beta=beta_scheduler.get_eps(),
-                            stdev=stdev).mean()
+                            stdev=stdev)
                 elif params.ROBUST_PPO_METHOD == "ibp2":
-                    kl_upper_bound = get_state_kl_bound_ibp2(relaxed_net, batch_states, batch_action_means,
+                    kl_upper_bound = get_state_kl_bound_ibp2(relaxed_net, bound_states, bound_action_means,
                             eps=current_eps, beta=beta_scheduler.get_eps(),
-                            stdev=stdev).mean()
+                            stdev=stdev)
                 else:
                     raise ValueError(f"Unsupported robust PPO method {params.ROBUST_PPO_METHOD}")
+                kl_per_state = kl_upper_bound.view(-1)
+                if bound_budget:
+                    # Importance weighted, unbiased estimate of the mean bound over the minibatch.
+                    kl_estimates = kl_per_state * bound_weights
+                    kl_upper_bound = kl_estimates.mean()
+                    if kl_estimates.numel() > 1:
+                        kl_estimate_var = kl_estimates.detach().var() / kl_estimates.numel()
+                    if kl_scores is not None:
+                        kl_scores[bound_selected] = kl_per_state.detach()
+                else:
+                    kl_upper_bound = kl_per_state.mean()
 
-                # Total loss, is the min of clipped and unclipped reward for each state, averaged.
-                surrogate = -ch.min(unclp_rew, clp_rew).mean()
-                entropy = -params.ENTROPY_COEFF * entropy_bonus
-                loss = surrogate + entropy + params.ROBUST_PPO_REG * kl_upper_bound
+                if fused_loss:
+                    entropy = -params.ENTROPY_COEFF * entropy_bonus
+                    loss = loss + params.ROBUST_PPO_REG * kl_upper_bound
+                else:
+                    # Total loss, is the min of clipped and unclipped reward for each state, averaged.
+                    surrogate = -ch.min(unclp_rew, clp_rew).mean()
+                    entropy = -params.ENTROPY_COEFF * entropy_bonus
+                    loss = surrogate + entropy + params.ROBUST_PPO_REG * kl_upper_bound
                 
                 # If we are sharing weights, take the value step simultaneously 
                 # (since the policy and value networks depend on the same weights)
                 if params.SHARE_WEIGHTS:
-                    tup = sel(returns, not_dones, old_vs)
-                    batch_returns, batch_not_dones, batch_old_vs = tup
+                    batch_returns, batch_not_dones, batch_old_vs = [v[selected] for v in (returns, not_dones, old_vs)]
                     val_loss = value_step(batch_states, batch_returns, batch_advs,
                                           batch_not_dones, net.get_value, None, params,
                                           store, old_vs=batch_old_vs, opt_step=opt_step)
@@ -1352,7 +1439,13 @@ def robust_ppo_step(all_states, actions, old_log_ps, rewards, returns, not_dones
                         ch.nn.utils.clip_grad_norm(net.parameters(), params.CLIP_GRAD_NORM)
                     params.POLICY_ADAM.step()
         # Logging.
+        if sgld_warm_kl is not None:
+            print(f'sgld_steps={sgld_steps}, warm kl={sgld_warm_kl:10.5g}, cold kl={sgld_cold_kl:10.5g}')
+            sgld_logged_kls = (sgld_warm_kl, sgld_cold_kl)
+            sgld_warm_kl = None
         kl_upper_bound = kl_upper_bound.item()
+        if bound_budget:
+            print(f'bound states={bound_states.size(0)}/{batch_states.size(0)}, kl estimate variance={kl_estimate_var.item():10.5g}')
         surrogate = surrogate.item()
         entropy_bonus = entropy_bonus.item()
         print(f'eps={eps_scheduler.get_eps():8.6f}, beta={beta_scheduler.get_eps():8.6f}, kl={kl_upper_bound:10.5g}, '
@@ -1370,6 +1463,12 @@ def robust_ppo_step(all_states, actions, old_log_ps, rewards, returns, not_dones
             'entropy': entropy_bonus,
             'loss': loss.item(),
         }
+        if bound_budget:
+            row['kl_estimate_var'] = kl_estimate_var.item()
+        if sgld_cache is not None:
+            # Steps of the last epoch, and the warm and cold bounds of its first minibatch.
+            row['sgld_steps'] = sgld_steps
+            row['sgld_warm_kl'], row['sgld_cold_kl'] = sgld_logged_kls
         store.log_table_and_tb('robust_ppo_data', row)
 
     return loss.item(), surrogate, entropy_bonus
@@ -1412,6 +1511,9 @@ def robust_ppo_stdv_step(all_states, actions, old_log_ps, rewards, returns, not_
         # We normalize all advantages at once instead of batch by batch, since each batch may contain different number of samples.
         normalized_advs = adv_normalize(advs)
         batches, alive_masks, time_masks, lengths = pack_history([all_states, actions, old_log_ps, normalized_advs], not_dones, max_length=params.HISTORY_LENGTH)
+    else:
+        # Memoryless policy. The rollout is permuted once per epoch and split into minibatches.
+        loader = MinibatchLoader(all_states, actions, old_log_ps, advs, num_minibatches=params.NUM_MINIBATCHES)
 
 
     for _ in range(params.PPO_EPOCHS):
@@ -1499,21 +1601,14 @@ def robust_ppo_stdv_step(all_states, actions, old_log_ps, rewards, returns, not_
         else:
             # Memoryless policy.
             # State is in shape (experience_size, observation_size). Usually 2048.
-            state_indices = np.arange(all_states.shape[0])
-            np.random.shuffle(state_indices)
             # We use a minibatch of states to do optimization, and each epoch contains several iterations.
-            splits = np.array_split(state_indices, params.NUM_MINIBATCHES)
             # A typical mini-batch size is 2048/32=64
-            for selected in splits:
-                def sel(*args):
-                    return [v[selected] for v in args]
-
+            for selected, batch in loader:
                 # old_log_ps: log probabilities of actions sampled based in experience buffer.
                 # advs: advantages of these states.
                 # both old_log_ps and advs are in shape (experience_size,) = 2048.
-                tup = sel(all_states, actions, old_log_ps, advs)
                 # select log probabilities, advantages of this minibatch.
-                batch_states, batch_actions, batch_old_log_ps, batch_advs = tup
+                batch_states, batch_actions, batch_old_log_ps, batch_advs = batch
 
                 # Forward propagation on current parameters (being constantly updated), to get distribution of these states
                 # dist contains mean and variance of Gaussian.
@@ -1578,8 +1673,7 @@ def robust_ppo_stdv_step(all_states, actions, old_log_ps, rewards, returns, not_
                 # If we are sharing weights, take the value step simultaneously 
                 # (since the policy and value networks depend on the same weights)
                 if params.SHARE_WEIGHTS:
-                    tup = sel(returns, not_dones, old_vs)
-                    batch_returns, batch_not_dones, batch_old_vs = tup
+                    batch_returns, batch_not_dones, batch_old_vs = [v[selected] for v in (returns, not_dones, old_vs)]
                     val_loss = value_step(batch_states, batch_returns, batch_advs,
                                           batch_not_dones, net.get_value, None, params,
                                           store, old_vs=batch_old_vs, opt_step=opt_step)
@@ -1624,7 +1718,148 @@ def robust_ppo_stdv_step(all_states, actions, old_log_ps, rewards, returns, not_
 
     return loss.item(), surrogate, entropy_bonus
 
-def trpo_step(all_states, actions, old_log_ps, rewards, returns, not_dones, advs, net, params, store, opt_step):
+def gauss_newton_fisher_product(net, states, damping):
+    '''
+    Fisher-vector products of a Gaussian policy with a state independent
+    standard deviation (e.g. CtsPolicy) in the Gauss-Newton form J^T M J,
+    where J is the Jacobian of the network outputs (means, std) w.r.t. the
+    parameters and M is the (diagonal) Hessian of the mean KL divergence
+    w.r.t. the outputs: 1/std^2 for the means of each state and 2/std^2 for
+    the std. Every product is one JVP and one VJP instead of a double
+    backward through calc_kl. For a plain CtsPolicy MLP, the layer inputs and
+    activation slopes are cached once, so both are a few matrix products;
+    other networks go through torch.func.
+    Inputs:
+    - net, policy network
+    - states, states to average the Fisher over
+    - damping, damping coefficient added to the diagonal
+    Returns:
+    - fisher_product(x, damp_coef=1.), same as the one of trpo_step
+    '''
+    assert not net.discrete, "gauss_newton FVP needs a Gaussian policy"
+    params = list(net.parameters())
+    if type(net).forward is CtsPolicy.forward and not net.use_merged_bias:
+        jvp_vjp = _cts_policy_jvp_vjp(net, states)
+    else:
+        jvp_vjp = _functional_jvp_vjp(net, states)
+
+    def fisher_product(x, damp_coef=1.):
+        tangents = {}
+        offset = 0
+        for p in params:
+            tangents[p] = x[offset:offset + p.numel()].view_as(p)
+            offset += p.numel()
+        grads = jvp_vjp(tangents)
+        hv = ch.cat([grads[p].reshape(-1) if p in grads else ch.zeros_like(p).view(-1) for p in params])
+        return hv + x*damping * damp_coef
+
+    return fisher_product
+
+def _cts_policy_jvp_vjp(net, states):
+    '''
+    J^T M J of a CtsPolicy, with its linearization at states cached.
+    Returns a function mapping tangents {parameter: tensor} to {parameter: J^T M J tangent}.
+    '''
+    layers = list(net.affine_layers) + [net.final_mean]
+    inputs, slopes = [], []
+    x = states[:, :-1] if net.time_in_state else states
+    with ch.no_grad():
+        for affine in net.affine_layers:
+            inputs.append(x)
+            z = affine(x)
+            # Elementwise activation, so the gradient of the sum is the slope.
+            with ch.enable_grad():
+                z.requires_grad_()
+                slope, = ch.autograd.grad(net.activation(z).sum(), z)
+            slopes.append(slope)
+            x = net.activation(z)
+        inputs.append(x)
+        inv_var = ch.exp(-2 * net.log_stdev)
+    num_states = x.size(0)
+
+    def jvp_vjp(tangents):
+        # JVP: tangent of the means; the std tangent is std * tangent of log_stdev.
+        dz = None
+        for i, layer in enumerate(layers):
+            dh = None if i == 0 else slopes[i - 1] * dz
+            dz = inputs[i] @ tangents[layer.weight].t() + tangents[layer.bias]
+            if dh is not None:
+                dz = dz + dh @ layer.weight.detach().t()
+        # VJP of M times the output tangents.
+        grads = {net.log_stdev: 2 * tangents[net.log_stdev]}
+        dz = dz * inv_var / num_states
+        for i in reversed(range(len(layers))):
+            layer = layers[i]
+            grads[layer.weight] = dz.t() @ inputs[i]
+            grads[layer.bias] = dz.sum(dim=0)
+            if i > 0:
+                dz = (dz @ layer.weight.detach()) * slopes[i - 1]
+        return grads
+
+    return jvp_vjp
+
+def _functional_jvp_vjp(net, states):
+    '''
+    J^T M J of any Gaussian policy with a state independent std, through
+    torch.func (one forward-mode JVP and one cached VJP per product).
+    '''
+    from torch.func import functional_call, jvp, vjp
+    names, params = zip(*net.named_parameters())
+    primals = tuple(p.detach() for p in params)
+
+    def forward(*flat_params):
+        return functional_call(net, dict(zip(names, flat_params)), (states,))
+
+    (means, std), vjp_fn = vjp(forward, *primals)
+    if std.dim() != 1:
+        raise ValueError("gauss_newton FVP needs a state independent std, e.g. CtsPolicy")
+    inv_var = std.pow(-2)
+
+    def jvp_vjp(tangents):
+        _, (d_means, d_std) = jvp(forward, primals, tuple(tangents[p] for p in params))
+        # The KL is averaged over states, but the std is shared by all of them.
+        grads = vjp_fn((d_means * inv_var / means.shape[0], 2 * d_std * inv_var))
+        return dict(zip(params, grads))
+
+    return jvp_vjp
+
+def batched_backtrack_fn(net, initial_parameters, all_states, actions, old_log_ps, advs, pds, surr_rew, params, weights=None):
+    '''
+    Batched version of the backtracking function of trpo_step, for Gaussian
+    policies whose log likelihood only depends on the output means and stds
+    (the CtsPolicy family). All candidate parameter vectors are evaluated
+    in one forward pass, vmapped over torch.func.functional_call, without
+    writing them into the network.
+    Returns:
+    - a function mapping (K, # parameters) steps to their K improvements of
+      the objective (-inf for unacceptable steps)
+    '''
+    from torch.func import functional_call, vmap
+    names, shapes = zip(*[(n, p.shape) for n, p in net.named_parameters()])
+    sizes = [int(np.prod(shape)) for shape in shapes]
+    log_norm = 0.5 * np.log(2.0 * np.pi) * actions.shape[-1]
+
+    def evaluate(flat_params):
+        params_dict = {n: t.view(shape) for n, t, shape in zip(names, flat_params.split(sizes), shapes)}
+        mean, std = functional_call(net, params_dict, (all_states,))
+        # Same as CtsPolicy.get_loglikelihood, with the candidate std.
+        test_action_log_probs = -(0.5 * ((actions - mean) / std).pow(2).sum(-1) + log_norm + std.log().sum(-1))
+        new_reward = surrogate_reward(advs, new=test_action_log_probs, old=old_log_ps, weights=weights).mean()
+        kl = net.calc_kl(pds, (mean, std))
+        return new_reward, kl.mean() if params.TRPO_KL_REDUCE_FUNC == 'mean' else kl.max()
+
+    if params.TRPO_KL_REDUCE_FUNC not in ['mean', 'max']:
+        raise ValueError("unknown reduce function " + params.TRPO_KL_REDUCE_FUNC)
+
+    def backtrack_fn(steps):
+        new_rewards, kl_metrics = vmap(evaluate)(initial_parameters + steps)
+        improve = new_rewards - surr_rew
+        return improve.masked_fill((new_rewards <= surr_rew) | (kl_metrics > params.MAX_KL), -float('inf'))
+
+    return backtrack_fn
+
+def trpo_step(all_states, actions, old_log_ps, rewards, returns, not_dones, advs, net, params, store, opt_step,
+              behavior_log_ps=None):
     '''
     Trust Region Policy Optimization
     Runs K epochs of TRPO as in https://arxiv.org/abs/1502.05477
@@ -1635,6 +1870,8 @@ def trpo_step(all_states, actions, old_log_ps, rewards, returns, not_dones, advs
     - advs, advantages as estimated by GAE
     - net, policy network to train [WILL BE MUTATED]
     - params, additional placeholder for parameters like EPS
+    - behavior_log_ps, the log probability of the actions under the policy
+      that sampled them, if it is older than old_log_ps (see behavior_weights)
     Returns:
     - The TRPO loss; main job is to mutate the net
     '''    
@@ -1649,7 +1886,8 @@ def trpo_step(all_states, actions, old_log_ps, rewards, returns, not_dones, advs
     action_log_probs = net.get_loglikelihood(pds, actions)
 
     # Calculate losses
-    surr_rew = surrogate_reward(advs, new=action_log_probs, old=old_log_ps).mean()
+    weights = behavior_weights(old_log_ps, behavior_log_ps, params)
+    surr_rew = surrogate_reward(advs, new=action_log_probs, old=old_log_ps, weights=weights).mean()
     grad = ch.autograd.grad(surr_rew, net.parameters(), retain_graph=True)
     # This represents the computation of gradient, and will be used to obtain 2nd order.
     flat_grad = flatten(grad)
@@ -1658,23 +1896,26 @@ def trpo_step(all_states, actions, old_log_ps, rewards, returns, not_dones, advs
     num_samples = int(all_states.shape[0] * params.FISHER_FRAC_SAMPLES)
     selected = np.random.choice(range(all_states.shape[0]), num_samples, replace=False)
     
-    detached_selected_pds = select_prob_dists(pds, selected, detach=True)
-    selected_pds = select_prob_dists(pds, selected, detach=False)
-    
-    # Construct the KL divergence which we will optimize on. This is essentially 0, but what we care about is the Hessian.
-    # We want to know when the network parameter changes, how the K-L divergence of network output changes.
-    kl = net.calc_kl(detached_selected_pds, selected_pds).mean()
-    # g is the gradient of the KL divergence w.r.t to parameters. It is 0 at the starting point.
-    g = flatten(ch.autograd.grad(kl, net.parameters(), create_graph=True))
-    '''
-    Fisher matrix to vector x product. Essentially, a Hessian-vector product of K-L divergence w.r.t network parameter.
-    '''
-    def fisher_product(x, damp_coef=1.):
-        contig_flat = lambda q: ch.cat([y.contiguous().view(-1) for y in q])
-        # z is the gradient-vector product. Take the derivation of it to get Hessian vector product.
-        z = g @ x
-        hv = ch.autograd.grad(z, net.parameters(), retain_graph=True)
-        return contig_flat(hv).detach() + x*params.DAMPING * damp_coef
+    if "fvp_impl" in params and params["fvp_impl"] == "gauss_newton":
+        fisher_product = gauss_newton_fisher_product(net, all_states[selected], params.DAMPING)
+    else:
+        detached_selected_pds = select_prob_dists(pds, selected, detach=True)
+        selected_pds = select_prob_dists(pds, selected, detach=False)
+
+        # Construct the KL divergence which we will optimize on. This is essentially 0, but what we care about is the Hessian.
+        # We want to know when the network parameter changes, how the K-L divergence of network output changes.
+        kl = net.calc_kl(detached_selected_pds, selected_pds).mean()
+        # g is the gradient of the KL divergence w.r.t to parameters. It is 0 at the starting point.
+        g = flatten(ch.autograd.grad(kl, net.parameters(), create_graph=True))
+        '''
+        Fisher matrix to vector x product. Essentially, a Hessian-vector product of K-L divergence w.r.t network parameter.
+        '''
+        def fisher_product(x, damp_coef=1.):
+            contig_flat = lambda q: ch.cat([y.contiguous().view(-1) for y in q])
+            # z is the gradient-vector product. Take the derivation of it to get Hessian vector product.
+            z = g @ x
+            hv = ch.autograd.grad(z, net.parameters(), retain_graph=True)
+            return contig_flat(hv).detach() + x*params.DAMPING * damp_coef
 
     # Find KL constrained gradient step
     # The Fisher matrix A is unknown, but we can compute the product.
@@ -1696,7 +1937,7 @@ def trpo_step(all_states, actions, old_log_ps, rewards, returns, not_dones, advs
             assign(initial_parameters + s.data, net.parameters())
             test_pds = net(all_states)
             test_action_log_probs = net.get_loglikelihood(test_pds, actions)
-            new_reward = surrogate_reward(advs, new=test_action_log_probs, old=old_log_ps).mean()
+            new_reward = surrogate_reward(advs, new=test_action_log_probs, old=old_log_ps, weights=weights).mean()
             # surr_new is the surrogate before optimization.
             # We need to make sure the loss is improving, and KL between old probabilites are not too large.
             if params.TRPO_KL_REDUCE_FUNC == 'mean':
@@ -1712,9 +1953,16 @@ def trpo_step(all_states, actions, old_log_ps, rewards, returns, not_dones, advs
         # max_trpo_step is the search direction. Backtracking line search will find a scaler for it.
         # expected_improve is the expected decrease in loss estimated by gradient.
         # backtracking_line_search will try a scaler 0.5, 0.25, 0.125, etc to achieve expected improvement.
-        final_step = backtracking_line_search(backtrack_fn, max_trpo_step,
-                                              expected_improve,
-                                              num_tries=params.MAX_BACKTRACK)
+        if "trpo_batched_line_search" in params and params["trpo_batched_line_search"] \
+                and type(net).get_loglikelihood is CtsPolicy.get_loglikelihood:
+            final_step = batched_backtracking_line_search(
+                    batched_backtrack_fn(net, initial_parameters, all_states, actions, old_log_ps, advs, pds, surr_rew, params,
+                                         weights=weights),
+                    max_trpo_step, expected_improve, num_tries=params.MAX_BACKTRACK)
+        else:
+            final_step = backtracking_line_search(backtrack_fn, max_trpo_step,
+                                                  expected_improve,
+                                                  num_tries=params.MAX_BACKTRACK)
 
         assign(initial_parameters + final_step, net.parameters())
 
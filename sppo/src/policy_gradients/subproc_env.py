@@ -0,0 +1,199 @@
+import os
+import random
+import multiprocessing as mp
+import numpy as np
+
+'''
+Worker-process backend for stepping several environments in parallel.
+Each worker owns a slice of the Env objects (including their state and
+reward normalizers) and writes observations, rewards and termination
+flags straight into shared-memory arrays, so the learner reads one
+(num_actors, obs_dim) block per step without any pickling.
+'''
+
+def _as_array(raw, typecode, shape):
+    size = int(np.prod(shape))
+    return np.frombuffer(raw, dtype=np.dtype(typecode))[:size].reshape(shape)
+
+
+def _worker(remote, parent_remote, envs, indices, raw_buffers, seed):
+    parent_remote.close()
+    buffers = [_as_array(*b) for b in raw_buffers]
+    # Forked workers inherit the random state of the learner; reseed them so
+    # that Env.reset() draws different gym seeds in every worker.
+    random.seed(seed)
+    np.random.seed(seed)
+    states, rewards, dones, episode_info, x_velocities, actions, timeouts = buffers
+    try:
+        while True:
+            cmd, data = remote.recv()
+            if cmd == 'step':
+                for i, env in zip(indices, envs):
+                    action = int(actions[i, 0]) if env.is_discrete else actions[i].copy()
+                    new_state, normed_reward, counter, total_true_reward, is_done, info = env.step(action, state_out=states[i])
+                    # Same termination rule as Trainer.multi_actor_step.
+                    is_done = not env.env.is_healthy
+                    x_velocities[i] = info['x_velocity']
+                    episode_info[i] = (counter, total_true_reward)
+                    if is_done or timeouts[i]:
+                        new_state = env.reset(state_out=states[i])
+                    states[i] = new_state
+                    rewards[i] = normed_reward
+                    dones[i] = is_done
+                remote.send(None)
+            elif cmd == 'reset':
+                for i, env in zip(indices, envs):
+                    env.reset(state_out=states[i])
+                remote.send(None)
+            elif cmd == 'get_attr':
+                remote.send([getattr(env, data) for env in envs])
+            elif cmd == 'set_attr':
+                name, values = data
+                for env, v in zip(envs, values):
+                    setattr(env, name, v)
+                remote.send(None)
+            elif cmd == 'load_normalizer_state':
+                for env, state in zip(envs, data):
+                    env.load_normalizer_state(state)
+                remote.send(None)
+            elif cmd == 'normalizer_state':
+                remote.send([env.normalizer_state() for env in envs])
+            elif cmd == 'get_envs':
+                remote.send(envs)
+            elif cmd == 'set_envs':
+                envs = data
+                remote.send(None)
+            elif cmd == 'close':
+                remote.close()
+                break
+            else:
+                raise NotImplementedError(cmd)
+    except KeyboardInterrupt:
+        pass
+
+
+class SubprocEnvPool:
+    '''
+    Steps a list of Env objects in num_workers subprocesses. state_dim is
+    the size of the filtered states returned by the envs.
+    Actor i is always owned by the same worker, so per-actor normalizer
+    statistics stay with their environment. Results of step() and reset()
+    are views into shared memory and are overwritten by the next call;
+    callers should copy them (e.g. by tensorizing) before stepping again.
+    worker_cores optionally gives the core every worker is pinned to.
+    '''
+    def __init__(self, envs, num_workers, state_dim, worker_cores=None):
+        self.num_envs = len(envs)
+        self.num_workers = max(1, min(int(num_workers), self.num_envs))
+        self.num_features = state_dim
+        action_dim = 1 if envs[0].is_discrete else envs[0].num_actions
+        # Set when the workers have stepped since the envs were last fetched.
+        self.dirty = False
+
+        ctx = mp.get_context('fork') if 'fork' in mp.get_all_start_methods() else mp.get_context()
+        raw_buffers, self._buffers = [], []
+        for typecode, shape in [('d', (self.num_envs, self.num_features)),
+                                ('d', (self.num_envs,)),
+                                ('B', (self.num_envs,)),
+                                ('d', (self.num_envs, 2)),
+                                ('d', (self.num_envs,)),
+                                ('d', (self.num_envs, action_dim)),
+                                ('B', (self.num_envs,))]:
+            raw = ctx.RawArray(typecode, max(int(np.prod(shape)), 1))
+            raw_buffers.append((raw, typecode, shape))
+            self._buffers.append(_as_array(raw, typecode, shape))
+        self.states, self.rewards, self.dones, self.episode_info, \
+                self.x_velocities, self._actions, self._timeouts = self._buffers
+
+        self._splits = np.array_split(np.arange(self.num_envs), self.num_workers)
+        self.remotes, self.processes = [], []
+        for indices in self._splits:
+            remote, work_remote = ctx.Pipe()
+            seed = random.getrandbits(31)
+            process = ctx.Process(target=_worker, args=(work_remote, remote,
+                                  [envs[i] for i in indices], indices, raw_buffers, seed))
+            process.daemon = True
+            process.start()
+            if worker_cores is not None and hasattr(os, 'sched_setaffinity'):
+                os.sched_setaffinity(process.pid, {worker_cores[len(self.processes) % len(worker_cores)]})
+            work_remote.close()
+            self.remotes.append(remote)
+            self.processes.append(process)
+
+    def _broadcast(self, cmd, data=None):
+        for remote in self.remotes:
+            remote.send((cmd, data))
+        return [remote.recv() for remote in self.remotes]
+
+    def reset(self):
+        '''
+        Resets every environment, returns a (num_envs, obs_dim) array.
+        '''
+        self._broadcast('reset')
+        self.dirty = True
+        return self.states
+
+    def step(self, actions, timeouts):
+        '''
+        Steps every environment. Actors flagged in timeouts are reset after
+        the step even if they have not terminated.
+        Returns (states, rewards, dones, episode_info, x_velocities), where
+        episode_info holds (length, true reward) of the episode before any reset.
+        '''
+        self._actions[:] = np.asarray(actions).reshape(self._actions.shape)
+        self._timeouts[:] = timeouts
+        self._broadcast('step')
+        self.dirty = True
+        return self.states, self.rewards, self.dones.astype(bool), \
+                self.episode_info, self.x_velocities
+
+    def get_attr(self, name):
+        return sum(self._broadcast('get_attr', name), [])
+
+    def set_attr(self, name, values):
+        for remote, indices in zip(self.remotes, self._splits):
+            remote.send(('set_attr', (name, [values[i] for i in indices])))
+        for remote in self.remotes:
+            remote.recv()
+
+    def load_normalizer_states(self, states):
+        '''
+        Restores the normalizer statistics of the envs in the workers from
+        their compact form (see Env.normalizer_state).
+        '''
+        for remote, indices in zip(self.remotes, self._splits):
+            remote.send(('load_normalizer_state', [states[i] for i in indices]))
+        for remote in self.remotes:
+            remote.recv()
+
+    def get_normalizer_states(self):
+        '''
+        Compact normalizer statistics of the envs in the workers (see
+        Env.normalizer_state), e.g. for checkpointing.
+        '''
+        states = sum(self._broadcast('normalizer_state'), [])
+        self.dirty = False
+        return states
+
+    def get_envs(self):
+        '''
+        Full copies of the Env objects held by the workers, including their
+        gym state. Use get_normalizer_states when only the statistics are needed.
+        '''
+        envs = sum(self._broadcast('get_envs'), [])
+        self.dirty = False
+        return envs
+
+    def set_envs(self, envs):
+        assert len(envs) == self.num_envs
+        for remote, indices in zip(self.remotes, self._splits):
+            remote.send(('set_envs', [envs[i] for i in indices]))
+        for remote in self.remotes:
+            remote.recv()
+        self.dirty = False
+
+    def close(self):
+        for remote in self.remotes:
+            remote.send(('close', None))
+        for process in self.processes:
+            process.join()
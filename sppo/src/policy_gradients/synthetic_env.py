@@ -0,0 +1,134 @@
+import numpy as np
+import gym
+from gym.spaces.box import Box as Continuous
+
+'''
+Built-in stand-ins for the MuJoCo environments, for benchmarking the
+rollout and evaluation code on machines without MuJoCo. They have the
+observation and action spaces of the environment they replace, an
+is_healthy flag and info['x_velocity'], but cheap NumPy dynamics. They are
+created by Env (see make_env) for the game names in SYNTHETIC_ENVS.
+'''
+
+class SyntheticHopper:
+    '''
+    Hopper-v3 shaped environment: 11 observations (torso height and angle,
+    3 joint angles, 6 clipped velocities), 3 torques in [-1, 1] and the
+    Hopper-v3 reward, health check and episode length. The torques drive
+    damped joints, whose motion pushes the torso forward and perturbs an
+    unstable torso angle, so that bad policies fall like on Hopper.
+    '''
+    dt = 0.008
+    max_episode_steps = 1000
+    forward_reward_weight = 1.0
+    ctrl_cost_weight = 1e-3
+    healthy_reward = 1.0
+    healthy_z_range = (0.7, float('inf'))
+    healthy_angle_range = (-0.2, 0.2)
+    healthy_state_range = (-100.0, 100.0)
+    reset_noise_scale = 5e-3
+    init_qpos = np.array([0.0, 1.25, 0.0, 0.0, 0.0, 0.0])
+    # Forward thrust of each joint and rendered frame size.
+    thrust = np.array([0.6, 0.4, 0.2])
+    frame_shape = (64, 64, 3)
+
+    def __init__(self):
+        self.action_space = Continuous(low=-1.0, high=1.0, shape=(3,), dtype=np.float32)
+        self.observation_space = Continuous(low=-np.inf, high=np.inf, shape=(11,), dtype=np.float64)
+        self.seed()
+        self.reset()
+
+    def seed(self, seed=None):
+        self.np_random = np.random.RandomState(seed)
+        return [seed]
+
+    @classmethod
+    def dynamics(cls, qpos, qvel, action):
+        '''
+        One semi-implicit Euler step. Works on arrays with any leading batch
+        dimensions: qpos and qvel (..., 6), action (..., 3).
+        Returns the new qpos and qvel.
+        '''
+        z, angle = qpos[..., 1], qpos[..., 2]
+        joints, joint_vel = qpos[..., 3:], qvel[..., 3:]
+        acc = np.empty_like(qvel)
+        # Torques on damped joints with a spring towards the rest pose.
+        acc[..., 3:] = 100.0 * action - 20.0 * joints - 2.0 * joint_vel
+        # Joint motion pushes the torso forward against friction.
+        acc[..., 0] = (np.tanh(joint_vel) * np.cos(joints)) @ cls.thrust - 0.5 * qvel[..., 0]
+        # Spring around the standing height, lowered by bent joints.
+        acc[..., 1] = -10.0 * (z - cls.init_qpos[1] + 0.05 * np.abs(joints).sum(-1)) - qvel[..., 1]
+        # Unstable torso angle, kicked by the difference of the first and last joint.
+        acc[..., 2] = 3.0 * angle - 0.5 * qvel[..., 2] + 0.5 * (joint_vel[..., 0] - joint_vel[..., 2])
+        qvel = qvel + cls.dt * acc
+        return qpos + cls.dt * qvel, qvel
+
+    @property
+    def is_healthy(self):
+        z, angle = self.qpos[1:3]
+        state = self.state_vector()[2:]
+        min_state, max_state = self.healthy_state_range
+        return bool(np.all(np.logical_and(min_state < state, state < max_state))
+                    and self.healthy_z_range[0] < z < self.healthy_z_range[1]
+                    and self.healthy_angle_range[0] < angle < self.healthy_angle_range[1])
+
+    def state_vector(self):
+        return np.concatenate([self.qpos, self.qvel])
+
+    def _get_obs(self):
+        return np.concatenate([self.qpos[1:], np.clip(self.qvel, -10, 10)])
+
+    def reset(self):
+        noise = self.reset_noise_scale
+        self.qpos = self.init_qpos + self.np_random.uniform(low=-noise, high=noise, size=6)
+        self.qvel = self.np_random.uniform(low=-noise, high=noise, size=6)
+        self.steps = 0
+        return self._get_obs()
+
+    def step(self, action):
+        action = np.clip(action, self.action_space.low, self.action_space.high)
+        x_position_before = self.qpos[0]
+        self.qpos, self.qvel = self.dynamics(self.qpos, self.qvel, action)
+        self.steps += 1
+        x_velocity = (self.qpos[0] - x_position_before) / self.dt
+        ctrl_cost = self.ctrl_cost_weight * np.sum(np.square(action))
+        healthy = self.is_healthy
+        reward = self.forward_reward_weight * x_velocity + self.healthy_reward - ctrl_cost
+        done = not healthy or self.steps >= self.max_episode_steps
+        info = {
+            'x_position': self.qpos[0],
+            'x_velocity': x_velocity,
+        }
+        return self._get_obs(), reward, done, info
+
+    def render(self, mode='human'):
+        '''
+        Frame with the torso as a bar of its height, at its x position
+        (wrapping around). Nothing is shown in human mode.
+        '''
+        if mode != 'rgb_array':
+            return None
+        height, width, _ = self.frame_shape
+        frame = np.full(self.frame_shape, 255, dtype=np.uint8)
+        column = int(self.qpos[0] * 10) % width
+        top = height - int(np.clip(self.qpos[1] / 2.0, 0, 1) * height)
+        frame[top:, max(column - 1, 0):column + 2] = (60, 60, 200)
+        return frame
+
+    def close(self):
+        pass
+
+
+SYNTHETIC_ENVS = {
+    'SyntheticHopper-v0': SyntheticHopper,
+}
+
+
+def make_env(game):
+    '''
+    Creates the environment game: a synthetic environment if game is in
+    SYNTHETIC_ENVS, otherwise gym.make(game).
+    '''
+    if game in SYNTHETIC_ENVS:
+        return SYNTHETIC_ENVS[game]()
+    return gym.make(game)
@@ -1,3 +1,4 @@
+import functools
 import torch as ch
 from torch.distributions.categorical import Categorical
 import numpy as np
@@ -176,7 +177,7 @@ def safe_op_or_neg_one(maybe_empty, op):
 
 ########################
 ### ACTOR-CRITIC HELPERS:
-# discount_path, get_path_indices, select_prob_dists
+# discount_path, get_path_indices, discount_paths, select_prob_dists
 ########################
 
 # Can be used to convert rewards into discounted returns:
@@ -226,6 +227,46 @@ def get_path_indices(not_dones):
             indices.append((actor, last_index, num_timesteps))
     return indices
 
+def _discount_paths_scan(x: ch.Tensor, decay: ch.Tensor) -> ch.Tensor:
+    out = ch.empty_like(x)
+    carry = ch.zeros_like(x[:, 0])
+    for t in range(x.shape[1] - 1, -1, -1):
+        carry = x[:, t] + decay[:, t] * carry
+        out[:, t] = carry
+    return out
+
+@functools.lru_cache(maxsize=None)
+def _scripted_discount_paths_scan():
+    # Scripted on first use, so CPU-only runs never compile it.
+    return ch.jit.script(_discount_paths_scan)
+
+def discount_paths(x, not_dones, h):
+    '''
+    Discounts all the paths of x with rate h in a single reverse scan,
+    giving the same result as discount_path over every path returned by
+    get_path_indices. A path ends at each time step where not_dones is 0:
+    X_t = x_t + h * not_dones_t * X_{t+1}
+    Inputs:
+    - x, tensor of shape (# agents, # time steps)
+    - not_dones, tensor of the same shape, 0 at terminal time steps
+    - h, discount rate
+    Outputs:
+    - Discounted paths, same shape and device as x
+    '''
+    decay = not_dones * h
+    if x.is_cuda:
+        # Avoids a host round trip; the loop runs as TorchScript.
+        return _scripted_discount_paths_scan()(x, decay)
+    # Time-major copies so that each step reads one contiguous row.
+    x_np = np.ascontiguousarray(x.detach().numpy().T)
+    decay_np = np.ascontiguousarray(decay.detach().numpy().T)
+    out = np.empty_like(x_np)
+    carry = np.zeros_like(x_np[0])
+    for t in range(x_np.shape[0] - 1, -1, -1):
+        carry = x_np[t] + decay_np[t] * carry
+        out[t] = carry
+    return ch.from_numpy(out.T.copy())
+
 def select_prob_dists(pds, selected=None, detach=True):
     '''
     Given a tensor/tuple probability distributions, and 
@@ -246,7 +287,7 @@ def select_prob_dists(pds, selected=None, detach=True):
 
 ########################
 ### POLICY GRADIENT HELPERS:
-# vjp, jvp, cg_solve, backtracking_line_search
+# vjp, jvp, cg_solve, backtracking_line_search, batched_backtracking_line_search
 ########################
 
 def vjp(f_x, theta, v, create=True):
@@ -328,9 +369,34 @@ def backtracking_line_search(f, x, expected_improve_rate,
             return scaled
     return 0.
 
+def batched_backtracking_line_search(f, x, expected_improve_rate,
+                                     num_tries=10, accept_ratio=.1):
+    '''
+    Backtracking Line Search, with all the step sizes evaluated at once
+    Inputs:
+    - f, function for the improvements of the objective for a
+    (num_tries, ...) batch of steps
+    - x, biggest step to try (successively halved)
+    - num_tries, number of halvings of x to try
+    - accept_ratio, how much of the expected improve rate we have to
+    improve by
+    Returns:
+    - the largest acceptable step, as backtracking_line_search
+    '''
+    scalings = 2.0 ** -ch.arange(num_tries, dtype=x.dtype, device=x.device)
+    scaled = scalings.view(-1, *([1] * x.dim())) * x
+    improve = f(scaled)
+    expected_improve = expected_improve_rate * scalings
+    accepted = ((improve/expected_improve > accept_ratio) & (improve > 0)).nonzero()
+    if accepted.numel() == 0:
+        return 0.
+    i = accepted[0].item()
+    print("We good! %f" % (scalings[i].item(),))
+    return scaled[i]
+
 ########################
 ### NORMALIZATION HELPERS:
-# RunningStat, ZFilter, StateWithTime
+# RunningStat, ZFilter, StateWithTime, FusedStateFilter, Trajectories, RolloutStorage, MinibatchLoader
 ########################
 
 class RunningStat(object):
@@ -339,6 +405,9 @@ class RunningStat(object):
     of a streaming time series.
      Taken from https://github.com/joschu/modular_rl
      Math in http://www.johndcook.com/blog/standard_deviation/
+    Batches of samples (push_many) and the statistics of other RunningStats
+    (merge) are combined with the parallel formula of Chan et al., see
+    https://en.wikipedia.org/wiki/Algorithms_for_calculating_variance#Parallel_algorithm
     '''
     def __init__(self, shape):
         self._n = 0
@@ -351,9 +420,45 @@ class RunningStat(object):
         if self._n == 1:
             self._M[...] = x
         else:
-            oldM = self._M.copy()
-            self._M[...] = oldM + (x - oldM) / self._n
-            self._S[...] = self._S + (x - oldM) * (x - self._M)
+            delta = x - self._M
+            self._M += delta / self._n
+            self._S += delta * (x - self._M)
+    def push_many(self, xs):
+        '''
+        Pushes a batch of samples, xs of shape (N, *shape).
+        '''
+        xs = np.asarray(xs)
+        assert xs.shape[1:] == self._M.shape
+        if xs.shape[0] == 0:
+            return
+        mean = xs.mean(axis=0)
+        self._combine(xs.shape[0], mean, np.square(xs - mean).sum(axis=0))
+    def merge(self, other):
+        '''
+        Adds the samples pushed to another RunningStat (e.g. of another
+        worker) to this one. The result is the same as pushing them here.
+        '''
+        assert other.shape == self.shape
+        self._combine(other._n, other._M, other._S)
+    def _combine(self, n, M, S):
+        if n == 0:
+            return
+        total = self._n + n
+        delta = M - self._M
+        self._S[...] = self._S + S + np.square(delta) * (self._n * n / total)
+        self._M[...] = self._M + delta * (n / total)
+        self._n = total
+    def state_dict(self):
+        '''
+        Compact form of the statistics (count, mean and sum of squared
+        deviations), e.g. for checkpoints.
+        '''
+        return {'n': self._n, 'mean': self._M.copy(), 'sum_sq': self._S.copy()}
+    def load_state_dict(self, state):
+        assert np.shape(state['mean']) == self.shape
+        self._n = int(state['n'])
+        self._M[...] = state['mean']
+        self._S[...] = state['sum_sq']
     @property
     def n(self):
         return self._n
@@ -387,6 +492,8 @@ class RewardFilter:
     Incorrect in the sense that we 
     1. update return
     2. divide reward by std(return) *without* subtracting and adding back mean
+    A (N, *shape) batch of rewards of N actors can be given at once; the
+    returns of the actors are then kept separately (see reset).
     """
     def __init__(self, prev_filter, shape, gamma, clip=None, read_only=False):
         assert shape is not None
@@ -399,23 +506,42 @@ class RewardFilter:
 
     def __call__(self, x, **kwargs):
         x = self.prev_filter(x, **kwargs)
+        batched = np.ndim(x) > len(self.rs.shape)
+        if np.shape(self.ret) != np.shape(x):
+            # Only a freshly reset unbatched return takes the shape of the first
+            # batch; the returns are never discarded on a change of the batch size.
+            if not batched or np.shape(self.ret) != self.rs.shape or np.any(self.ret):
+                raise ValueError(f'RewardFilter got rewards of shape {np.shape(x)}, '
+                                 f'but keeps returns of shape {np.shape(self.ret)}')
+            self.ret = np.zeros(np.shape(x))
         self.ret = self.ret * self.gamma + x
         # The object might be from a pickle object which does not have this property.
         if not hasattr(self, 'read_only') or not self.read_only:
-            self.rs.push(self.ret)
+            if batched:
+                self.rs.push_many(self.ret)
+            else:
+                self.rs.push(self.ret)
         x = x / (self.rs.std + 1e-8)
         if self.clip:
             x = np.clip(x, -self.clip, self.clip)
         return x
     
-    def reset(self):
-        self.ret = np.zeros_like(self.ret)
+    def reset(self, index=None):
+        '''
+        Resets the return, or only the return of actor index for batched rewards.
+        '''
+        if index is None:
+            self.ret = np.zeros_like(self.ret)
+        else:
+            self.ret[index] = 0
         self.prev_filter.reset()
 
 class ZFilter:
     """
     y = (x-mean)/std
     using running estimates of mean,std
+    A (N, *shape) batch of N samples (e.g. the states of N actors) can be
+    normalized at once; the statistics are updated with all of them.
     """
     def __init__(self, prev_filter, shape, center=True, scale=True, clip=None, read_only=False):
         assert shape is not None
@@ -430,7 +556,10 @@ class ZFilter:
         x = self.prev_filter(x, **kwargs)
         # The object might be from a pickle object which does not have this property.
         if not hasattr(self, 'read_only') or not self.read_only:
-            self.rs.push(x)
+            if np.ndim(x) > len(self.rs.shape):
+                self.rs.push_many(x)
+            else:
+                self.rs.push(x)
         if self.center:
             x = x - self.rs.mean
         if self.scale:
@@ -444,7 +573,7 @@ class ZFilter:
             x = np.clip(x, -self.clip, self.clip)
         return x
 
-    def reset(self):
+    def reset(self, index=None):
         self.prev_filter.reset()
 
 class StateWithTime:
@@ -467,10 +596,98 @@ class StateWithTime:
     def reset(self):
         self.prev_filter.reset()
 
+class FusedStateFilter:
+    '''
+    The Identity -> ZFilter -> StateWithTime state filter chain of an Env
+    (each stage optional) as one call. The filter objects keep the
+    statistics and counters, so they stay the source of truth (and what is
+    pickled); this only reads them. The state is written into an output
+    array, with the last slot for t/T when time is in the state. Chains of
+    other filters are called as they are.
+    '''
+    def __init__(self, state_filter):
+        self.source = state_filter
+        f = state_filter
+        self.time_filter = f if isinstance(f, StateWithTime) else None
+        if self.time_filter is not None:
+            f = f.prev_filter
+        self.zfilter = f if isinstance(f, ZFilter) else None
+        if self.zfilter is not None:
+            f = f.prev_filter
+        self.fused = isinstance(f, Identity)
+        self._std = None
+
+    def _std_buffer(self, rs):
+        if self._std is None or self._std.shape != rs.shape:
+            self._std = np.empty(rs.shape)
+        return self._std
+
+    def __call__(self, x, reset=False, out=None):
+        '''
+        Filters state x (updating the normalizer and time counter like the
+        chain would) into out, a new array if None.
+        '''
+        if not self.fused:
+            x = self.source(x, reset=reset)
+            if out is None:
+                return x
+            out[...] = x
+            return out
+        x = np.asarray(x)
+        n = x.shape[-1]
+        if out is None:
+            out = np.empty(n + (self.time_filter is not None))
+        state = out[:n]
+        z = self.zfilter
+        if z is None:
+            state[...] = x
+        else:
+            rs = z.rs
+            if not getattr(z, 'read_only', False):
+                rs.push(x)
+            if z.scale:
+                # Same as rs.std + 1e-8, without temporaries.
+                std = self._std_buffer(rs)
+                if rs.n > 1:
+                    np.divide(rs._S, rs.n - 1, out=std)
+                else:
+                    np.square(rs.mean, out=std)
+                np.sqrt(std, out=std)
+                std += 1e-8
+            if z.center or z.scale:
+                np.subtract(x, rs.mean, out=state)
+                if z.scale:
+                    state /= std
+                if z.scale and not z.center:
+                    state += rs.mean
+            else:
+                state[...] = x
+            if z.clip:
+                # Much faster than np.clip for small arrays.
+                np.minimum(state, z.clip, out=state)
+                np.maximum(state, -z.clip, out=state)
+        t = self.time_filter
+        if t is not None:
+            t.counter = 0 if reset else t.counter + 1
+            out[n] = t.counter / t.horizon
+        return out
+
 class Trajectories:
+    '''
+    A rollout of # actors x T steps (or, once unrolled, of # actors * T
+    state-action pairs). The fields of a rollout collected by
+    RolloutStorage are views into a single float32 block (self.block), each
+    laid out contiguously in (# actors, T, ...) order, so that unroll only
+    reshapes them and minibatches gather from one allocation.
+    '''
+    # Per step fields, in the order they are packed into the block.
+    FIELDS = ('states', 'rewards', 'returns', 'values', 'not_dones', 'actions',
+              'action_log_probs', 'advantages', 'action_means')
+
     def __init__(self, states=None, rewards=None, returns=None, not_dones=None,
                  actions=None, action_log_probs=None, advantages=None,
-                 unrolled=False, values=None, action_means=None, action_std=None):
+                 unrolled=False, values=None, action_means=None, action_std=None,
+                 block=None):
 
         self.states = states
         self.rewards = rewards
@@ -483,6 +700,12 @@ class Trajectories:
         self.action_means = action_means # A batch of vectors.
         self.action_std = action_std # A single vector.
         self.unrolled = unrolled
+        self.block = block # Storage the fields are packed into (if any).
+        # Log probabilities and distributions of the actions under the policy
+        # being optimized, when it differs from the one that sampled them
+        # (pipelined rollouts, see Trainer.set_proximal_policy).
+        self.proximal_log_probs = None
+        self.proximal_pds = None
 
         """
         # this is disgusting and we should fix it
@@ -499,8 +722,48 @@ class Trajectories:
 
             self.size = num_saps
         """
-            
-        
+
+    @staticmethod
+    def packed_layout(num_actors, T, state_shape, action_shape):
+        '''
+        Offsets and shapes of the fields packed into one block.
+        Returns:
+        - dict of field name -> (offset, shape)
+        - total number of elements
+        '''
+        shapes = {
+            'states': (num_actors, T) + tuple(state_shape),
+            'actions': (num_actors, T) + tuple(action_shape),
+            'action_means': (num_actors, T) + tuple(action_shape),
+        }
+        layout, offset = {}, 0
+        for name in Trajectories.FIELDS:
+            shape = shapes.get(name, (num_actors, T))
+            layout[name] = (offset, shape)
+            offset += int(np.prod(shape))
+        return layout, offset
+
+    @staticmethod
+    def from_block(block, layout, **kwargs):
+        '''
+        Trajectories whose fields are the views of block given by layout.
+        '''
+        fields = {name: block[offset:offset+int(np.prod(shape))].view(shape)
+                  for name, (offset, shape) in layout.items() if name in Trajectories.FIELDS}
+        return Trajectories(block=block, **fields, **kwargs)
+
+    def set_field(self, name, value):
+        '''
+        Writes value into the packed slot of field name, or just sets the
+        attribute if this rollout is not packed (or the shapes differ).
+        '''
+        slot = getattr(self, name)
+        if self.block is not None and slot is not None and slot.shape == value.shape \
+                and slot.device == value.device:
+            slot.copy_(value)
+        else:
+            setattr(self, name, value)
+
     def unroll(self):
         assert not self.unrolled
         return self.tensor_op(unroll, should_wrap=False)
@@ -516,13 +779,94 @@ class Trajectories:
         tt2 = op(self.actions, self.action_log_probs, self.advantages, self.action_means)
         values, = op(self.values)
 
+        # Packed fields are contiguous, so unroll returns views of the same block.
         ts = Trajectories(states=tt[0], rewards=tt[1], returns=tt[2],
                           not_dones=tt[3], actions=tt2[0],
                           action_log_probs=tt2[1], advantages=tt2[2], action_means=tt2[3], action_std=self.action_std,
-                          values=values, unrolled=True)
+                          values=values, unrolled=True, block=self.block)
 
         return ts
 
+class RolloutStorage:
+    '''
+    Preallocated float32 storage for a rollout of num_actors x T steps.
+    All fields of Trajectories, and the final state of every actor (which is
+    never acted on), are packed into one contiguous block; each field is a
+    (# actors, T, ...) view of it, exposed both as a numpy array
+    (self.arrays) and as a zero-copy torch tensor with the same name (e.g.
+    storage.rewards). Environments write rewards, not_dones and next states
+    in place, into the views returned by step_buffers.
+    '''
+    def __init__(self, num_actors, T, state_shape, action_shape):
+        self.num_actors = num_actors
+        self.T = T
+        state_shape, action_shape = tuple(state_shape), tuple(action_shape)
+        self.layout, size = Trajectories.packed_layout(num_actors, T, state_shape, action_shape)
+        self.layout['final_states'] = (size, (num_actors,) + state_shape)
+        size += int(np.prod((num_actors,) + state_shape))
+        self.block = ch.zeros(size, dtype=ch.float32)
+        block = self.block.numpy()
+        self.arrays = {name: block[offset:offset+int(np.prod(shape))].reshape(shape)
+                       for name, (offset, shape) in self.layout.items()}
+        for name, array in self.arrays.items():
+            setattr(self, name, ch.from_numpy(array))
+
+    def step_buffers(self, t):
+        '''
+        Numpy views (rewards, not_dones, next states) of timestep t, indexed
+        by actor. The next states go to slot t+1, or to final_states after
+        the last step.
+        '''
+        next_states = self.arrays['states'][:, t+1] if t+1 < self.T else self.arrays['final_states']
+        return self.arrays['rewards'][:, t], self.arrays['not_dones'][:, t], next_states
+
+    def to_trajectories(self, action_std=None, device_op=None):
+        '''
+        Wraps the storage into Trajectories without copying (unless
+        device_op moves the block to another device, in a single transfer).
+        '''
+        block = self.block if device_op is None else device_op(self.block)
+        return Trajectories.from_block(block, self.layout, action_std=action_std)
+
+class MinibatchLoader:
+    '''
+    Shuffled minibatches of tensors sharing their first dimension, e.g. the
+    fields of unrolled Trajectories. Once per epoch (i.e. per iteration over
+    the loader) all tensors are permuted into contiguous staging buffers with
+    one index_select each; the minibatches are then zero-copy slices of those
+    buffers, with the same sizes as np.array_split(indices, num_minibatches).
+    Iterating yields (indices, [minibatch of every tensor]), where indices
+    are the positions of the minibatch in the original tensors.
+    With shuffle=False the tensors are sliced in order, without any copy.
+    '''
+    def __init__(self, *tensors, num_minibatches, shuffle=True):
+        self.tensors = tensors
+        self.size = tensors[0].shape[0]
+        assert all(t.shape[0] == self.size for t in tensors)
+        self.shuffle = shuffle
+        self.device = tensors[0].device
+        sizes = [len(s) for s in np.array_split(np.arange(self.size), num_minibatches)]
+        self.bounds = np.cumsum([0] + sizes)
+        self.staging = None
+
+    def __len__(self):
+        return len(self.bounds) - 1
+
+    def __iter__(self):
+        if self.shuffle:
+            indices = ch.randperm(self.size, device=self.device)
+            if self.staging is None:
+                self.staging = [ch.empty_like(t, memory_format=ch.contiguous_format) for t in self.tensors]
+            # Tensors that require grad cannot be written into a preallocated output.
+            batches = [t.index_select(0, indices.to(t.device)) if t.requires_grad else
+                       ch.index_select(t, 0, indices.to(t.device), out=buf)
+                       for t, buf in zip(self.tensors, self.staging)]
+        else:
+            indices = ch.arange(self.size, device=self.device)
+            batches = self.tensors
+        for start, end in zip(self.bounds[:-1], self.bounds[1:]):
+            yield indices[start:end], [b[start:end] for b in batches]
+
 ########################
 ### NEURAL NETWORK HELPERS:
 # orthogonal_init
@@ -88,6 +88,7 @@ def main(params):
             'val_model': store.PYTORCH_STATE,
             'policy_model': store.PYTORCH_STATE,
             'envs': store.PICKLE,
+            'normalizers': store.PICKLE,
             'policy_opt': store.PYTORCH_STATE,
             'val_opt': store.PYTORCH_STATE,
             'iteration': int,
@@ -109,6 +110,7 @@ def main(params):
         pretrained_model = torch.load(params['load_model'])
         if 'policy_model' in pretrained_model:
             p.policy_model.load_state_dict(pretrained_model['policy_model'])
+            p.policy_updated()
         if params['deterministic']:
             print('Policy runs in deterministic mode. Ignoring Gaussian noise.')
             p.policy_model.log_stdev.data[:] = -100
@@ -139,7 +141,8 @@ def main(params):
         if 'envs' in pretrained_model:
             p.envs = pretrained_model['envs']
         for e in p.envs:
-            e.setup_visualization(params['show_env'], params['save_frames'], params['save_frames_path'])
+            e.setup_visualization(params['show_env'], params['save_frames'], params['save_frames_path'],
+                                  params.get('save_frames_stride'), params.get('save_frames_downscale'), params.get('save_frames_format'))
     rewards = []
 
     # Table for final results
@@ -150,6 +153,7 @@ def main(params):
         'val_model': store.PYTORCH_STATE,
         'policy_model': store.PYTORCH_STATE,
         'envs': store.PICKLE,
+        'normalizers': store.PICKLE,
         'policy_opt': store.PYTORCH_STATE,
         'val_opt': store.PYTORCH_STATE,
     }
@@ -174,7 +178,8 @@ def main(params):
             'policy_model': p.policy_model.state_dict(),
             'policy_opt': p.POLICY_ADAM.state_dict(),
             'val_opt': p.val_opt.state_dict(),
-            'envs': p.envs
+            'envs': p.envs,
+            'normalizers': [e.normalizer_state() for e in p.envs],
         }
         final_dict = add_adversary_to_table(p, final_dict)
         final_table.append_row(final_dict)
@@ -194,6 +199,7 @@ def main(params):
                     'policy_opt': p.POLICY_ADAM.state_dict(),
                     'val_opt': p.val_opt.state_dict(),
                     'envs': p.envs,
+                    'normalizers': [e.normalizer_state() for e in p.envs],
                     '5_rewards': final_5_rewards,
                 }
                 checkpoint_dict = add_adversary_to_table(p, checkpoint_dict)
@@ -245,7 +251,7 @@ def str2bool(v):
 
 def add_common_parser_opts(parser):
     # Basic setup
-    parser.add_argument('--game', type=str, help='gym game')
+    parser.add_argument('--game', type=str, help='gym game, or SyntheticHopper-v0 for a MuJoCo-free stand-in of Hopper-v3')
     parser.add_argument('--mode', type=str, choices=['ppo', 'trpo', 'robust_ppo', 'adv_ppo', 'adv_trpo', 'adv_sa_ppo'],
                         help='pg alg')
     parser.add_argument('--out-dir', type=str,
@@ -261,6 +267,13 @@ def add_common_parser_opts(parser):
     parser.add_argument('--train-steps', type=int,
                         help='num agent training steps')
     parser.add_argument('--cpu', type=str2bool, const=True, nargs='?')
+    parser.add_argument('--inference-precision', type=str, choices=['none', 'auto', 'float32', 'bfloat16', 'int8'],
+                        help='act in rollouts and tests with a frozen export of the CtsPolicy mean network at this precision (CPU only); '
+                             'auto picks the fastest (or none) at the actor batch size. bfloat16/int8 only pay off on CPUs with native kernels for them')
+    parser.add_argument('--cpu-cores', type=int,
+                        help='core budget of this run; if nonzero, threads are switched between rollouts (1) and optimization (all cores)')
+    parser.add_argument('--cpu-slot', type=int,
+                        help='index of this run on the node, to pin it to its own cpu-cores cores (-1 for no pinning)')
 
     # Which value loss to use
     parser.add_argument('--value-calc', type=str,
@@ -268,8 +281,14 @@ def add_common_parser_opts(parser):
     parser.add_argument('--initialization', type=str)
 
     # General Policy Gradient parameters
-    parser.add_argument('--num-actors', type=int, help='num actors (serial)',
-                        choices=[1])
+    parser.add_argument('--num-actors', type=int,
+                        help='num actors, stepped together with one batched policy forward')
+    parser.add_argument('--num-env-workers', type=int,
+                        help='number of worker processes stepping the actors (0 steps them in the learner process)')
+    parser.add_argument('--pipeline-lag', type=int,
+                        help='collect rollouts in the background with a policy this many updates old while optimizing (0 disables pipelining)')
+    parser.add_argument('--pipeline-weight-clip', type=float,
+                        help='truncation of the importance weights of pipelined rollouts (current / behavior policy)')
     parser.add_argument('--t', type=int,
                         help='num timesteps to run each actor for')
     parser.add_argument('--gamma', type=float, help='discount on reward')
@@ -302,6 +321,8 @@ def add_common_parser_opts(parser):
                         help='share weights in valnet and polnet')
     parser.add_argument('--clip-grad-norm', type=float,
                         help='gradient norm clipping (-1 for no clipping)')
+    parser.add_argument('--fused-ppo-loss', type=str2bool,
+                        help='compute the PPO loss of Gaussian policies with one fused (TorchScript) function')
     parser.add_argument('--policy-activation', type=str,
                         help='activation function for countinous policy network')
     
@@ -313,13 +334,19 @@ def add_common_parser_opts(parser):
     parser.add_argument('--cg-steps', type=int,
                         help='num cg steps in fisher vp estimate')
     parser.add_argument('--damping', type=float, help='damping to use in cg')
+    parser.add_argument('--fvp-impl', type=str, choices=['double_backward', 'gauss_newton'],
+                        help='fisher vp implementation: double backward through the KL, or Gauss-Newton JVP/VJP (Gaussian policies with state independent std)')
     parser.add_argument('--max-backtrack', type=int, help='max bt steps in fvp')
     parser.add_argument('--trpo-kl-reduce-func', type=str, help='reduce function for KL divergence used in line search. mean or max.')
+    parser.add_argument('--trpo-batched-line-search', type=str2bool, help='evaluate all line search step sizes in one batched forward (Gaussian policies)')
 
     # Robust PPO parameters.
     parser.add_argument('--robust-ppo-eps', type=float, help='max eps for robust PPO training')
-    parser.add_argument('--robust-ppo-method', type=str, choices=['convex-relax', 'sgld', 'pgd'], help='robustness regularization methods')
+    parser.add_argument('--robust-ppo-method', type=str, choices=['convex-relax', 'sgld', 'pgd', 'native-convex-relax', 'native-ibp'], help='robustness regularization methods')
     parser.add_argument('--robust-ppo-pgd-steps', type=int, help='number of PGD optimization steps')
+    parser.add_argument('--robust-ppo-bound-budget', type=float, help='if nonzero, fraction (< 1) or number (>= 1) of states per minibatch to evaluate the robustness regularizer on')
+    parser.add_argument('--robust-ppo-bound-sampling', type=str, choices=['uniform', 'kl'], help='how to sample the states under a bound budget: uniformly, or weighted by their last KL bound')
+    parser.add_argument('--sgld-warm-steps', type=int, help='if nonzero, SGLD steps after the first PPO epoch, warm-started from the previous perturbation of each state')
     parser.add_argument('--robust-ppo-detach-stdev', type=str2bool, help='detach gradient of standard deviation term')
     parser.add_argument('--robust-ppo-reg', type=float, help='robust PPO regularization')
     parser.add_argument('--robust-scheduler',  type=str, help='scheduler type')
@@ -345,6 +372,7 @@ def add_common_parser_opts(parser):
 
     parser.add_argument('--attack-ratio', type=float, help='attack only a ratio of steps.')
     parser.add_argument('--attack-steps', type=int, help='number of PGD optimization steps.')
+    parser.add_argument('--attack-restarts', type=int, help='number of random starts per state for PGD attacks, optimized as one batch.')
     parser.add_argument('--attack-eps', type=str, help='epsilon for attack. If set to "same", we will use value of robust-ppo-eps.')
     parser.add_argument('--attack-step-eps', type=str, help='step size for each iteration. If set to "auto", we will use attack-eps / attack-steps')
     parser.add_argument('--attack-sarsa-network', type=str, help='sarsa network to load for attack.')
@@ -371,6 +399,9 @@ def add_common_parser_opts(parser):
     parser.add_argument('--show-env', type=str2bool, help='Show environment visualization')
     parser.add_argument('--save-frames', type=str2bool, help='Save environment frames')
     parser.add_argument('--save-frames-path', type=str, help='Path to save environment frames')
+    parser.add_argument('--save-frames-stride', type=int, help='Save every n-th environment frame')
+    parser.add_argument('--save-frames-downscale', type=int, help='Subsample saved frames by this factor in both dimensions')
+    parser.add_argument('--save-frames-format', type=str, choices=['npz', 'png'], help='Save frames as compressed npz chunks per episode or as png files')
 
     # For grid searches only
     # parser.add_argument('--cox-experiment-path', type=str, default='')
@@ -380,6 +411,7 @@ def add_common_parser_opts(parser):
     parser.add_argument('--smoothing', type=str2bool, help='smoothing')
     parser.add_argument('--training-m', type=int, help='training-m')
     parser.add_argument('--testing-m', type=int, help='testing-m')
+    parser.add_argument('--smoothing-chunk', type=int, help='max noise draws per smoothed forward pass (0 for all at once)')
     
     return parser
 
@@ -7,8 +7,12 @@ import os
 import copy
 import random
 import argparse
+import multiprocessing as mp
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from policy_gradients import models
 from policy_gradients.torch_utils import ZFilter
+from policy_gradients.checkpoints import CheckpointCatalog
+from policy_gradients.custom_env import EnvInstancePool
 import sys
 import json
 import torch
@@ -22,6 +26,255 @@ import pandas as pd
 logging.disable(logging.INFO)
 
 
+EXCLUDED_PARAMS = ['config_path', 'out_dir_prefix', 'num_episodes', 'row_id', 'exp_id',
+        'load_model', 'seed', 'deterministic', 'noise_factor', 'compute_kl_cert', 'use_full_backward', 'sqlite_path', 'early_terminate',
+        'num_eval_workers', 'episodes_per_unit']
+SARSA_PARAMS = ['sarsa_enable', 'sarsa_steps', 'sarsa_eps', 'sarsa_reg', 'sarsa_model_path']
+IMIT_PARAMS = ['imit_enable', 'imit_epochs', 'imit_model_path', 'imit_lr']
+DYNAMICS_PARAMS = ['load_dynamical_model', 'dynamics_enable', 'dynamics_epochs', 'dynamics_lr']
+
+
+def prepare_params(params):
+    '''
+    Applies the output path prefix and the JSON config to the command line
+    params. Returns the resulting params and the command line params that
+    override the ones stored with the agents.
+    '''
+    override_params = copy.deepcopy(params)
+    # original_params contains all flags in config files that are overridden via command.
+    for k in list(override_params.keys()):
+        if k in EXCLUDED_PARAMS:
+            del override_params[k]
+
+    # Append a prefix for output path.
+    if params['out_dir_prefix']:
+        params['out_dir'] = os.path.join(params['out_dir_prefix'], params['out_dir'])
+        print(f"setting output dir to {params['out_dir']}")
+
+    if params['config_path']:
+        # Load from a pretrained model using existing config.
+        # First we need to create the model using the given config file.
+        json_params = json.load(open(params['config_path']))
+
+        params = override_json_params(params, json_params, EXCLUDED_PARAMS + SARSA_PARAMS + IMIT_PARAMS + DYNAMICS_PARAMS)
+    return params, override_params
+
+
+def open_catalog(params, override_params, env_instances=None):
+    '''
+    Opens the checkpoints table of experiment params['exp_id']. The agent
+    is built once and the checkpoints are swapped into it by load_agent.
+    Its environments are taken from env_instances (an EnvInstancePool) if
+    given, and given back when the catalog is closed.
+    '''
+    if params['cpu'] == None:
+        cpu = False
+    else:
+        cpu = params['cpu']
+    # Load from experiment directory. No need to use a config.
+    store = Store(params['out_dir'], params['exp_id'], mode='r')
+    return CheckpointCatalog(Trainer, store, cpu, extra_params=params, override_params=override_params,
+                             excluded_params=EXCLUDED_PARAMS, env_instances=env_instances)
+
+
+def load_agent(catalog, params, row_id):
+    '''
+    Loads row row_id of a checkpoint catalog into its agent, with read-only
+    normalizers and the evaluation noise settings applied.
+    Returns the agent and the log stdev of its policy before the noise
+    adjustment (None if the stdev depends on the state).
+    '''
+    print("row to test: ", catalog.row(row_id))
+    p = catalog.load(row_id)
+    for e in p.envs:
+        e.normalizer_read_only = True
+        e.setup_visualization(params['show_env'], params['save_frames'], params['save_frames_path'],
+                              params.get('save_frames_stride'), params.get('save_frames_downscale'), params.get('save_frames_format'))
+
+    ## pass if stdv dependent on state
+    original_stdev = None
+    if hasattr(p.policy_model, 'log_stdev'):
+        print('Gaussian noise in policy:')
+        print(torch.exp(p.policy_model.log_stdev))
+        original_stdev = p.policy_model.log_stdev.clone().detach()
+        if params['noise_factor'] != 1.0:
+            p.policy_model.log_stdev.data[:] += np.log(params['noise_factor'])
+        if params['deterministic']:
+            print('Policy runs in deterministic mode. Ignoring Gaussian noise.')
+            p.policy_model.log_stdev.data[:] = -100
+        print('Gaussian noise in policy (after adjustment):')
+        print(torch.exp(p.policy_model.log_stdev))
+    else:
+        if params['deterministic']:
+            print('Policy runs in deterministic mode. Ignoring Gaussian noise.')
+            p.policy_model.final_logstdv.bias.data[:] = -1000
+    return p, original_stdev
+
+
+# State of a sweep worker process: the evaluation params, the catalog of the
+# current model, the last checkpoint it loaded and the environments kept
+# alive across models.
+_worker_state = {}
+
+
+def _init_sweep_worker(params, override_params):
+    # One thread per worker; the parallelism comes from the worker processes.
+    torch.set_num_threads(1)
+    _worker_state['params'] = params
+    _worker_state['override_params'] = override_params
+    _worker_state['catalog'] = None
+    _worker_state['agent'] = None
+    _worker_state['env_instances'] = EnvInstancePool()
+
+
+def _evaluate_unit(unit):
+    '''
+    Runs episodes [first_episode, first_episode + num_episodes) of a
+    checkpoint in a sweep worker. The agent is built once per model, and a
+    checkpoint is swapped into it only when it differs from the one of the
+    previous unit of this worker.
+    '''
+    model, row_id, first_episode, num_episodes, seed = unit
+    params = _worker_state['params']
+    if _worker_state['catalog'] is None or _worker_state['catalog'][0] != model:
+        if _worker_state['catalog'] is not None:
+            _worker_state['catalog'][1].close()
+        params['exp_id'] = model
+        _worker_state['catalog'] = (model, open_catalog(params, _worker_state['override_params'],
+                                                        _worker_state['env_instances']))
+        _worker_state['agent'] = None
+    if _worker_state['agent'] is None or _worker_state['agent'][0] != (model, row_id):
+        p, original_stdev = load_agent(_worker_state['catalog'][1], params, row_id)
+        _worker_state['agent'] = ((model, row_id), p, original_stdev)
+    _, p, original_stdev = _worker_state['agent']
+
+    torch.manual_seed(seed)
+    random.seed(seed)
+    np.random.seed(seed)
+    episodes = []
+    for i in range(first_episode, first_episode + num_episodes):
+        ## original_stdv = None with stdv dependent on state
+        ep_length, ep_reward, ep_avg_adiv, actions, action_means, states, kl_certificates, steps, velocities = p.run_test(compute_bounds=params['compute_kl_cert'], use_full_backward=params['use_full_backward'], original_stdev=original_stdev)
+        episodes.append({
+            'episode': i,
+            'length': ep_length,
+            'reward': ep_reward,
+            'adiv': ep_avg_adiv,
+            'kl_certificates': kl_certificates,
+            'steps': steps,
+            'velocity': sum(velocities) / len(velocities),
+            'actions': actions,
+            'states': states,
+        })
+    return model, row_id, episodes
+
+
+def save_results(params, all_actions, all_states, all_rewards, all_lens):
+    '''
+    Saves the evaluation results of a checkpoint of model params['exp_id'],
+    with the evaluation params, to out_dir/exp_id/attack-.../ (the results of
+    a later checkpoint of the same model replace them). The same layout is
+    written by the serial and the parallel sweep.
+    '''
+    attack_dir = 'attack-{}-eps-{}'.format(params['attack_method'], params['attack_eps'])
+    if 'sarsa' in params['attack_method']:
+        attack_dir += '-sarsa_steps-{}-sarsa_eps-{}-sarsa_reg-{}'.format(params['sarsa_steps'], params['sarsa_eps'], params['sarsa_reg'])
+        if 'action' in params['attack_method']:
+            attack_dir += '-attack_sarsa_action_ratio-{}'.format(params['attack_sarsa_action_ratio'])
+    save_path = os.path.join(params['out_dir'], params['exp_id'], attack_dir)
+    if not os.path.exists(save_path):
+        os.makedirs(save_path)
+    for name, value in [('actions',all_actions), ('states', all_states), ('rewards', all_rewards), ('length', all_lens)]:
+        with open(os.path.join(save_path, '{}.pkl'.format(name)), 'wb') as f:
+            pickle.dump(value, f)
+    with open(os.path.join(save_path, 'params.json'), 'w') as f:
+        json.dump(params, f, indent=4)
+
+
+def parallel_sweep(params, override_params, models, evaluate_folder):
+    '''
+    Evaluates every checkpoint of every model with a pool of
+    params['num_eval_workers'] processes. The work units are blocks of
+    params['episodes_per_unit'] episodes of one checkpoint (0: all episodes
+    of the checkpoint in one unit). Results are aggregated as units finish.
+    '''
+    assert not (params['sarsa_enable'] or params['imit_enable'] or params['dynamics_enable']), \
+            "--num-eval-workers only supports evaluation, not sarsa/imit/dynamics training"
+    assert not params['sqlite_path'] and not params['early_terminate'], \
+            "--num-eval-workers does not support --sqlite-path and --early-terminate"
+    num_episodes = params['num_episodes']
+    block = params['episodes_per_unit'] if params['episodes_per_unit'] > 0 else num_episodes
+
+    units = []
+    num_rows = {}
+    for model in models:
+        params['exp_id'] = model
+        catalog = open_catalog(params, override_params)
+        num_rows[model] = len(catalog)
+        catalog.close()
+        for row_id in range(num_rows[model]):
+            for first_episode in range(0, num_episodes, block):
+                seed = params['seed'] + len(units)
+                units.append((model, row_id, first_episode, min(block, num_episodes - first_episode), seed))
+    print(f'Evaluating {len(units)} units of up to {block} episodes with {params["num_eval_workers"]} workers')
+
+    # spawn, since the agents may use CUDA.
+    ctx = mp.get_context('spawn')
+    results = {}
+    with ProcessPoolExecutor(params['num_eval_workers'], mp_context=ctx, initializer=_init_sweep_worker,
+                             initargs=(params, override_params)) as executor:
+        futures = [executor.submit(_evaluate_unit, unit) for unit in units]
+        for done, future in enumerate(as_completed(futures)):
+            model, row_id, episodes = future.result()
+            for e in episodes:
+                print('Model %s row %d episode %d / %d, Reward: %f' % (model, row_id, e['episode']+1, num_episodes, e['reward']))
+            print(f'{done+1} / {len(units)} units done')
+            results.setdefault((model, row_id), []).extend(episodes)
+
+    all_steps = []
+    all_velocities = []
+    all_episodes = []
+    all_row_id = []
+    all_models = []
+    for model in models:
+        for row_id in range(num_rows[model]):
+            episodes = sorted(results[(model, row_id)], key=lambda e: e['episode'])
+            for e in episodes:
+                all_steps.extend(e['steps'])
+                all_velocities.append(e['velocity'])
+                all_episodes.extend([e['episode']] * len(e['steps']))
+                all_row_id.extend([row_id] * len(e['steps']))
+                all_models.extend([model] * len(e['steps']))
+            all_rewards = [e['reward'] for e in episodes]
+            all_lens = [e['length'] for e in episodes]
+            all_actions = np.concatenate([e['actions'] for e in episodes], axis=0)
+            all_states = np.concatenate([e['states'] for e in episodes], axis=0)
+
+            params['exp_id'] = model
+            save_results(params, all_actions, all_states, all_rewards, all_lens)
+
+            print(f'\nModel {model} row {row_id}')
+            print('all rewards:', all_rewards)
+            if params['compute_kl_cert']:
+                all_kl_certificates = [e['kl_certificates'] for e in episodes]
+                print('KL certificates stats: mean: {}, std: {}, min: {}, max: {}'.format(np.mean(all_kl_certificates), np.std(all_kl_certificates), np.min(all_kl_certificates), np.max(all_kl_certificates)))
+            if params['smoothing']:
+                print('ADiv:', np.mean([e['adiv'] for e in episodes]))
+            print('rewards stats:\nmean: {}, std:{}, min:{}, max:{}'.format(np.mean(all_rewards), np.std(all_rewards), np.min(all_rewards), np.max(all_rewards)))
+
+    data = {
+        'Step': all_steps,
+        'Velocity': all_velocities,
+        'Episode': all_episodes,
+        'RowId': all_row_id,
+        'Model': all_models
+    }
+    df = pd.DataFrame(data)
+    # Save the DataFrame to an Excel file
+    excel_file_path = f"{evaluate_folder}/{params['excel_name']}.xlsx"
+    df.to_excel(excel_file_path, index=False)
+
+
 def main(params):
     all_steps = []
     all_velocities = []
@@ -32,23 +285,17 @@ def main(params):
     evaluate_folder = params['evaluate_folder']
     if not os.path.exists(evaluate_folder):
         os.mkdir(evaluate_folder)
+    params, override_params = prepare_params(params)
+    if params['num_eval_workers'] > 0:
+        return parallel_sweep(params, override_params, modelArray, evaluate_folder)
+    # The environments of the first model are reused by the following ones.
+    env_instances = EnvInstancePool()
     for model in modelArray:
         params['exp_id'] = model
 
-        for model_row_id in range(20):
+        catalog = open_catalog(params, override_params, env_instances)
+        for model_row_id in range(len(catalog)):
 #            model_row_id = 19
-            override_params = copy.deepcopy(params)
-            excluded_params = ['config_path', 'out_dir_prefix', 'num_episodes', 'row_id', 'exp_id',
-                    'load_model', 'seed', 'deterministic', 'noise_factor', 'compute_kl_cert', 'use_full_backward', 'sqlite_path', 'early_terminate']
-            sarsa_params = ['sarsa_enable', 'sarsa_steps', 'sarsa_eps', 'sarsa_reg', 'sarsa_model_path']
-            imit_params =  ['imit_enable', 'imit_epochs', 'imit_model_path', 'imit_lr']
-            dynamics_params = ['load_dynamical_model', 'dynamics_enable', 'dynamics_epochs', 'dynamics_lr']
-
-            # original_params contains all flags in config files that are overridden via command.
-            for k in list(override_params.keys()):
-                if k in excluded_params:
-                    del override_params[k]
-
             if params['sqlite_path']:
                 print(f"Will save results in sqlite database in {params['sqlite_path']}")
                 connection = sqlite3.connect(params['sqlite_path'])
@@ -68,59 +315,15 @@ def main(params):
                 # We will set this flag to True we break early.
                 early_terminate = False
 
-            # Append a prefix for output path.
-            if params['out_dir_prefix']:
-                params['out_dir'] = os.path.join(params['out_dir_prefix'], params['out_dir'])
-                print(f"setting output dir to {params['out_dir']}")
-
-            if params['config_path']:
-                # Load from a pretrained model using existing config.
-                # First we need to create the model using the given config file.
-                json_params = json.load(open(params['config_path']))
-
-                params = override_json_params(params, json_params, excluded_params + sarsa_params + imit_params+dynamics_params)
-
             if params['sarsa_enable']:
                 assert params['attack_method'] == "none" or params['attack_method'] is None, \
                         "--train-sarsa is only available when --attack-method=none, but got {}".format(params['attack_method'])
 
-            # Load from experiment directory. No need to use a config.
-            base_directory = params['out_dir']
-            store = Store(base_directory, params['exp_id'], mode='r')
-            checkpoints = store['checkpoints'].df
             row_id = model_row_id
-            row = checkpoints.iloc[row_id:row_id+1]
-            print("row to test: ", row)
-            if params['cpu'] == None:
-                cpu = False
-            else:
-                cpu = params['cpu']
-            p, _ = Trainer.agent_from_data(store, row, cpu, extra_params=params, override_params=override_params, excluded_params=excluded_params)
-            for e in p.envs:
-                e.normalizer_read_only = True
-                e.setup_visualization(params['show_env'], params['save_frames'], params['save_frames_path'])
-            store.close()
+            p, original_stdev = load_agent(catalog, params, row_id)
 
             rewards = []
 
-            ## pass if stdv dependent on state
-
-            if hasattr(p.policy_model, 'log_stdev'):
-                print('Gaussian noise in policy:')
-                print(torch.exp(p.policy_model.log_stdev))
-                original_stdev = p.policy_model.log_stdev.clone().detach()
-                if params['noise_factor'] != 1.0:
-                    p.policy_model.log_stdev.data[:] += np.log(params['noise_factor'])
-                if params['deterministic']:
-                    print('Policy runs in deterministic mode. Ignoring Gaussian noise.')
-                    p.policy_model.log_stdev.data[:] = -100
-                print('Gaussian noise in policy (after adjustment):')
-                print(torch.exp(p.policy_model.log_stdev))
-            else:
-                if params['deterministic']:
-                    print('Policy runs in deterministic mode. Ignoring Gaussian noise.')
-                    p.policy_model.final_logstdv.bias.data[:] = -1000
-
             if params['sarsa_enable']:
                 num_steps = params['sarsa_steps']
                 # learning rate scheduler: linearly annealing learning rate after
@@ -267,20 +470,8 @@ def main(params):
                             early_terminate = True
                             break
 
-                attack_dir = 'attack-{}-eps-{}'.format(params['attack_method'], params['attack_eps'])
-                if 'sarsa' in params['attack_method']:
-                    attack_dir += '-sarsa_steps-{}-sarsa_eps-{}-sarsa_reg-{}'.format(params['sarsa_steps'], params['sarsa_eps'], params['sarsa_reg'])
-                    if 'action' in params['attack_method']:
-                        attack_dir += '-attack_sarsa_action_ratio-{}'.format(params['attack_sarsa_action_ratio'])
-                save_path = os.path.join(params['out_dir'], params['exp_id'], attack_dir)
-                if not os.path.exists(save_path):
-                    os.makedirs(save_path)
-                for name, value in [('actions',all_actions), ('states', all_states), ('rewards', all_rewards), ('length', all_lens)]:
-                    with open(os.path.join(save_path, '{}.pkl'.format(name)), 'wb') as f:
-                        pickle.dump(value, f)
                 print(params)
-                with open(os.path.join(save_path, 'params.json'), 'w') as f:
-                    json.dump(params, f, indent=4)
+                save_results(params, all_actions, all_states, all_rewards, all_lens)
 
                 mean_reward, std_reward, min_reward, max_reward = np.mean(all_rewards), np.std(all_rewards), np.min(all_rewards), np.max(all_rewards)
                 if params['compute_kl_cert']:
@@ -319,6 +510,7 @@ def main(params):
                 if params['smoothing']:
                     print('ADiv:', np.mean(all_adiv))
                 print('rewards stats:\nmean: {}, std:{}, min:{}, max:{}'.format(mean_reward, std_reward, min_reward, max_reward))
+        catalog.close()
 
     data = {
         'Step': all_steps,
@@ -368,6 +560,8 @@ def get_parser():
     parser.add_argument('--excel-name', type=str, help='save results to an excel given name.', default='')
     parser.add_argument('--sqlite-path', type=str, help='save results to a sqlite database.', default='')
     parser.add_argument('--early-terminate', action='store_true', help='terminate attack early if low attack reward detected in sqlite.')
+    parser.add_argument('--num-eval-workers', type=int, default=0, help='evaluate checkpoints in this many worker processes (0 evaluates them serially).')
+    parser.add_argument('--episodes-per-unit', type=int, default=0, help='episodes of a checkpoint evaluated per work unit with --num-eval-workers (0 for all of them).')
 
     # parser.add_argument('--compound_step', type=int, default=10, help='number of compound attack steps')
     # parser.add_argument('--compound_step', type=int, default=10, help='number of compound attack steps')